@@ -29,7 +29,6 @@ from unitary.alpha import (
     PhasedMove,
     Split,
     PhasedSplit,
-    SparseSimulator,
 )
 
 
@@ -275,7 +274,7 @@ class QuantumGame(Game):
         for i in range(self.number_of_holes):
             hole = QuantumObject(f"Hole-{i}", Hole.FOX if i == index else Hole.EMPTY)
             holes.append(hole)
-        self.state = (QuantumWorld(holes, sampler=SparseSimulator()), holes)
+        self.state = (QuantumWorld(holes, seed=self.rng), holes)
 
     def state_to_string(self):
         return str(self.state[0].get_binary_probabilities(objects=self.state[1]))
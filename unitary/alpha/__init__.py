@@ -19,11 +19,27 @@ from unitary.alpha.qudit_state_transform import (
     qudit_to_qubit_unitary,
 )
 
+from unitary.alpha.auto_sampler import (
+    AutoSampler,
+)
+
+from unitary.alpha.mps_simulator import (
+    MPSSimulator,
+)
+
+from unitary.alpha.profiler import (
+    Profiler,
+)
+
 from unitary.alpha.quantum_world import (
+    Query,
+    QueryType,
     QuantumWorld,
+    run_worlds,
 )
 
 from unitary.alpha.quantum_effect import (
+    clear_operation_cache,
     quantum_if,
     QuantumEffect,
     QuantumIf,
@@ -52,4 +68,15 @@ from unitary.alpha.quantum_object import (
 
 from unitary.alpha.sparse_vector_simulator import (
     SparseSimulator,
+    SparseStateView,
+)
+
+from unitary.alpha.stabilizer_simulator import (
+    StabilizerSimulator,
+)
+
+from unitary.alpha.world_serialization import (
+    load_world,
+    save_world,
+    WorldReader,
 )
@@ -0,0 +1,330 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sampler dispatching each circuit to the cheapest suitable simulator."""
+
+from typing import Dict, List, Optional, Tuple
+import collections
+import logging
+import math
+
+import cirq
+import numpy as np
+
+from unitary.alpha.profiler import Profiler
+from unitary.alpha.sparse_vector_simulator import (
+    InvalidPostSelectionError,
+    PostSelectOperation,
+    SparseSimulator,
+    _EPSILON,
+    _random_state,
+)
+from unitary.alpha.stabilizer_simulator import StabilizerSimulator
+
+
+_LOGGER = logging.getLogger(__name__)
+
+# Maximum number of consecutive rejected repetitions when post-selecting by
+# rejection sampling.
+_MAX_REJECTED_REPS = 1_000_000
+
+# Minimum number of repetitions sampled at once when post-selecting by
+# rejection sampling.
+_MIN_REPS = 100
+
+# Prefix of the keys of measurements added to replace post-selections.
+_POST_SELECT_KEY = "__post_select_"
+
+SPARSE = "sparse"
+DENSE = "dense"
+CLIFFORD = "clifford"
+DENSITY_MATRIX = "density_matrix"
+
+
+def _is_measurement(op: cirq.Operation) -> bool:
+    return isinstance(op, PostSelectOperation) or cirq.is_measurement(op)
+
+
+def _branching(op: cirq.Operation) -> int:
+    """Maximum number of basis states a basis state is mapped to by `op`."""
+    unitary = cirq.unitary(op)
+    return int(np.max(np.count_nonzero(abs(unitary) > _EPSILON, axis=0)))
+
+
+def _seed_sequences(seed, num_seeds: int) -> List[np.random.SeedSequence]:
+    if isinstance(seed, np.random.Generator):
+        seed = seed.integers(0, 2**32, size=4)
+    elif isinstance(seed, np.random.RandomState):
+        seed = seed.randint(0, 2**32, size=4)
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(num_seeds)
+
+
+def _defer_post_selections(
+    circuit: cirq.AbstractCircuit,
+) -> Optional[Tuple[cirq.Circuit, List[Tuple[str, int, int]]]]:
+    """Replaces post-selections by measurements at the end of the circuit.
+
+    This is only possible if no operation other than a measurement acts on
+    a post-selected qubit after its post-selection.  Measurements of the
+    qubit after the post-selection are reused, other qubits are measured in
+    a new moment at the end.
+
+    Returns:
+        None if that is not the case.  Otherwise, the new circuit and a
+        list of (measurement key, index of the qubit in the measurement,
+        value) of the checks to do on the results.
+    """
+    post_selections: Dict[cirq.Qid, List[int]] = {}
+    measured: Dict[cirq.Qid, Tuple[str, int]] = {}
+    deferred = cirq.Circuit()
+    for moment in circuit:
+        ops = []
+        for op in moment:
+            if isinstance(op, PostSelectOperation):
+                post_selections.setdefault(op.qubit, []).append(op.value)
+                continue
+            if not cirq.is_measurement(op):
+                if post_selections.keys() & set(op.qubits):
+                    return None
+            elif (
+                isinstance(op.gate, cirq.MeasurementGate)
+                and not any(op.gate.full_invert_mask())
+                and not op.gate.confusion_map
+            ):
+                for idx, qubit in enumerate(op.qubits):
+                    if qubit in post_selections:
+                        measured[qubit] = (op.gate.key, idx)
+            ops.append(op)
+        deferred.append(cirq.Moment(ops))
+    checks = []
+    extra_measurements = []
+    for qubit, values in post_selections.items():
+        if qubit not in measured:
+            measured[qubit] = (f"{_POST_SELECT_KEY}{len(extra_measurements)}", 0)
+            extra_measurements.append(cirq.measure(qubit, key=measured[qubit][0]))
+        checks.extend((*measured[qubit], value) for value in values)
+    if extra_measurements:
+        deferred.append(cirq.Moment(extra_measurements))
+    return deferred, checks
+
+
+class AutoSampler(cirq.Sampler):
+    """Sampler choosing a simulator for every circuit it runs.
+
+    The choice is made from the structure of the circuit:
+
+     - circuits with noise (non-unitary operations) are simulated with
+       density matrices, or with `cirq.Simulator` (using trajectories) if
+       they have more than `max_density_matrix_qubits` qubits,
+     - circuits with qudits are simulated with `cirq.Simulator`,
+     - Clifford circuits with at least `min_clifford_qubits` qubits are
+       simulated with `StabilizerSimulator`,
+     - the remaining circuits are simulated with `SparseSimulator`, unless
+       they have at most `max_dense_qubits` qubits and the estimated number
+       of nonzero amplitudes is close to the size of the dense state
+       vector, in which case `cirq.Simulator` is used.
+
+    The number of nonzero amplitudes is estimated from how many basis states
+    each operation maps a basis state to.
+
+    Circuits with a `PostSelectOperation` that is not the last operation
+    (other than measurements) on its qubit are always simulated with
+    `SparseSimulator` or `StabilizerSimulator`, which apply post-selections
+    to the state.  Other simulators measure post-selected qubits at the end
+    of the circuit instead and sample until enough repetitions pass.
+
+    Each choice is logged at INFO level by the `unitary.alpha.auto_sampler`
+    logger and stored in `last_choice`.
+
+    Args:
+        seed: Seed of the simulators.  Anything accepted by
+            `SparseSimulator` can be used.
+        max_dense_qubits: Maximum number of qubits simulated with dense
+            state vectors.
+        max_density_matrix_qubits: Maximum number of qubits of noisy
+            circuits simulated with density matrices.
+        min_clifford_qubits: Minimum number of qubits of Clifford circuits
+            simulated with the stabilizer simulator.
+        profiler: If set, passed on to the `SparseSimulator`.
+    """
+
+    # Post-selections are enforced when running circuits, so `QuantumWorld`
+    # can add `PostSelectOperation`s to circuits.
+    supports_post_selection = True
+
+    def __init__(
+        self,
+        seed=None,
+        max_dense_qubits: int = 20,
+        max_density_matrix_qubits: int = 10,
+        min_clifford_qubits: int = 16,
+        profiler: Optional[Profiler] = None,
+    ):
+        seeds = _seed_sequences(seed, 4)
+        self.max_dense_qubits = max_dense_qubits
+        self.max_density_matrix_qubits = max_density_matrix_qubits
+        self.min_clifford_qubits = min_clifford_qubits
+        self.samplers: Dict[str, cirq.Sampler] = {
+            SPARSE: SparseSimulator(seed=seeds[0], profiler=profiler),
+            DENSE: cirq.Simulator(seed=_random_state(seeds[1])),
+            CLIFFORD: StabilizerSimulator(seed=seeds[2]),
+            DENSITY_MATRIX: cirq.DensityMatrixSimulator(seed=_random_state(seeds[3])),
+        }
+        self.last_choice: Optional[str] = None
+
+    def choose(self, circuit: cirq.AbstractCircuit) -> str:
+        """Returns the name of the simulator to use for the circuit.
+
+        The name is a key of `samplers`.
+
+        Raises:
+            ValueError: if the circuit has noise or qudits, and post-selections
+                that cannot be moved to the end of the circuit.
+        """
+        qubits = circuit.all_qubits()
+        num_qubits = len(qubits)
+        ops = [op for op in circuit.all_operations() if not _is_measurement(op)]
+        noisy = not all(cirq.has_unitary(op) for op in ops)
+        has_qudits = any(q.dimension != 2 for q in qubits)
+        clifford = (
+            num_qubits >= self.min_clifford_qubits
+            and not noisy
+            and not has_qudits
+            and all(cirq.has_stabilizer_effect(op) for op in ops)
+        )
+        if any(isinstance(op, PostSelectOperation) for op in circuit.all_operations()):
+            if _defer_post_selections(circuit) is None:
+                if clifford:
+                    return CLIFFORD
+                if noisy or has_qudits:
+                    raise ValueError(
+                        "Post-selections followed by other operations are only "
+                        "supported in noiseless qubit circuits."
+                    )
+                return SPARSE
+        if noisy:
+            if num_qubits <= self.max_density_matrix_qubits:
+                return DENSITY_MATRIX
+            return DENSE
+        if has_qudits:
+            return DENSE
+        if clifford:
+            return CLIFFORD
+        if num_qubits > self.max_dense_qubits:
+            return SPARSE
+        # Upper bound of log2 of the number of nonzero amplitudes.
+        log_size = 0.0
+        branching_qubits = set()
+        for op in ops:
+            branching = _branching(op)
+            if branching > 1:
+                log_size += math.log2(branching)
+                branching_qubits.update(op.qubits)
+        log_size = min(log_size, len(branching_qubits))
+        # The sparse simulator has a larger cost per amplitude, so it is only
+        # used if the state is expected to be well below the dense size.
+        return SPARSE if log_size <= num_qubits - 3 else DENSE
+
+    def simulate_state(self, program, qubit_order=cirq.QubitOrder.DEFAULT):
+        """Simulates a circuit without measurements and returns the final state.
+
+        Clifford circuits chosen for `StabilizerSimulator` are simulated with
+        it, other circuits with `SparseSimulator`.  Circuits with qudits or
+        noise are simulated with dense simulators by `run`, which have no
+        such state, so None is returned for them.
+        """
+        ops = [op for op in program.all_operations() if not _is_measurement(op)]
+        if any(q.dimension != 2 for q in program.all_qubits()) or not all(
+            cirq.has_unitary(op) for op in ops
+        ):
+            return None
+        sampler = self.samplers[
+            CLIFFORD if self.choose(program) == CLIFFORD else SPARSE
+        ]
+        return sampler.simulate_state(program, qubit_order)
+
+    def run_sweep(
+        self,
+        program: cirq.AbstractCircuit,
+        params: cirq.Sweepable,
+        repetitions: int = 1,
+    ) -> List[cirq.Result]:
+        results = []
+        for resolver in cirq.to_resolvers(params):
+            circuit = cirq.resolve_parameters(program, resolver)
+            choice = self.choose(circuit)
+            self.last_choice = choice
+            _LOGGER.info(
+                "Simulating circuit with %d qubits and %d operations with the "
+                "%s simulator.",
+                len(circuit.all_qubits()),
+                len(list(circuit.all_operations())),
+                choice,
+            )
+            sampler = self.samplers[choice]
+            if getattr(sampler, "supports_post_selection", False):
+                result = sampler.run(circuit, repetitions=repetitions)
+                results.append(cirq.ResultDict(params=resolver, records=result.records))
+            else:
+                results.append(
+                    self._run_post_selected(sampler, circuit, resolver, repetitions)
+                )
+        return results
+
+    def _run_post_selected(
+        self,
+        sampler: cirq.Sampler,
+        circuit: cirq.Circuit,
+        resolver: cirq.ParamResolver,
+        repetitions: int,
+    ) -> cirq.Result:
+        """Runs the circuit, post-selecting by rejection sampling."""
+        deferred = _defer_post_selections(circuit)
+        assert deferred is not None
+        circuit, checks = deferred
+        batches: Dict[str, List[np.ndarray]] = collections.defaultdict(list)
+        num_found = 0
+        num_rejected = 0
+        num_reps = repetitions
+        while True:
+            result = sampler.run(circuit, repetitions=num_reps)
+            accepted = np.ones(num_reps, dtype=bool)
+            for key, idx, value in checks:
+                accepted &= result.measurements[key][:, idx] == value
+            num_accepted = int(np.count_nonzero(accepted))
+            for key, bits in result.measurements.items():
+                if not key.startswith(_POST_SELECT_KEY):
+                    batches[key].append(bits[accepted])
+            num_found += num_accepted
+            if num_found >= repetitions:
+                break
+            if num_accepted == 0:
+                num_rejected += num_reps
+                if num_rejected >= _MAX_REJECTED_REPS:
+                    raise InvalidPostSelectionError(
+                        f"No repetition out of {num_rejected} passed post-selection."
+                    )
+                num_reps *= 2
+            else:
+                num_rejected = 0
+                num_reps = math.ceil(
+                    (repetitions - num_found) * num_reps / num_accepted
+                )
+            num_reps = min(max(num_reps, _MIN_REPS), _MAX_REJECTED_REPS)
+        measurements = {
+            key: np.concatenate(bits)[:repetitions] for key, bits in batches.items()
+        }
+        return cirq.ResultDict(params=resolver, measurements=measurements)
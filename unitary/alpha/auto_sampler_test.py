@@ -0,0 +1,201 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import enum
+import logging
+
+import cirq
+import numpy as np
+import pytest
+
+import unitary.alpha as alpha
+from unitary.alpha import auto_sampler
+from unitary.alpha.qudit_gates import QuditPlusGate
+from unitary.alpha.sparse_vector_simulator import (
+    InvalidPostSelectionError,
+    PostSelectOperation,
+    SparseSimulationState,
+)
+from unitary.alpha.stabilizer_simulator import StabilizerSimulationState
+
+
+class Light(enum.Enum):
+    RED = 0
+    GREEN = 1
+
+
+class StopLight(enum.Enum):
+    RED = 0
+    YELLOW = 1
+    GREEN = 2
+
+
+@pytest.mark.parametrize(
+    ("circuit", "expected"),
+    [
+        # Too many qubits for a dense state vector.
+        (
+            cirq.Circuit(
+                cirq.H.on_each(*cirq.LineQubit.range(25)),
+                cirq.T.on_each(*cirq.LineQubit.range(25)),
+            ),
+            "sparse",
+        ),
+        # Few branching operations.
+        (
+            cirq.Circuit(
+                cirq.X.on_each(*cirq.LineQubit.range(12)), cirq.H(cirq.LineQubit(0))
+            ),
+            "sparse",
+        ),
+        # Fully superposed.
+        (cirq.Circuit(cirq.H.on_each(*cirq.LineQubit.range(12))), "dense"),
+        (cirq.Circuit(cirq.H.on_each(*cirq.LineQubit.range(30))), "clifford"),
+        (
+            cirq.Circuit(cirq.depolarize(0.1).on_each(*cirq.LineQubit.range(3))),
+            "density_matrix",
+        ),
+        (
+            cirq.Circuit(cirq.depolarize(0.1).on_each(*cirq.LineQubit.range(12))),
+            "dense",
+        ),
+        (cirq.Circuit(QuditPlusGate(3).on(cirq.LineQid(0, dimension=3))), "dense"),
+        # Post-selection that cannot be deferred.
+        (
+            cirq.Circuit(
+                cirq.H.on_each(*cirq.LineQubit.range(4)),
+                PostSelectOperation(cirq.LineQubit(0), 1),
+                cirq.X(cirq.LineQubit(0)),
+            ),
+            "sparse",
+        ),
+        (
+            cirq.Circuit(
+                cirq.H.on_each(*cirq.LineQubit.range(20)),
+                PostSelectOperation(cirq.LineQubit(0), 1),
+                cirq.X(cirq.LineQubit(0)),
+            ),
+            "clifford",
+        ),
+    ],
+)
+def test_choose(circuit, expected):
+    assert alpha.AutoSampler().choose(circuit) == expected
+
+
+def test_choose_unsupported_post_selection():
+    q0 = cirq.LineQubit(0)
+    circuit = cirq.Circuit(PostSelectOperation(q0, 0), cirq.depolarize(0.1).on(q0))
+    with pytest.raises(ValueError, match="Post-selections"):
+        alpha.AutoSampler().choose(circuit)
+
+
+@pytest.mark.parametrize("choice", ["sparse", "dense", "clifford", "density_matrix"])
+def test_post_selection(choice):
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    circuit = cirq.Circuit(
+        cirq.H(q0),
+        cirq.CNOT(q0, q1),
+        cirq.H(q2),
+        PostSelectOperation(q0, 1),
+        PostSelectOperation(q2, 0),
+        cirq.measure(q0, q1, key="m"),
+    )
+    sampler = alpha.AutoSampler(seed=1)
+    sampler.choose = lambda circuit: choice
+    result = sampler.run(circuit, repetitions=50)
+    assert list(result.measurements) == ["m"]
+    assert (result.measurements["m"] == 1).all()
+    assert result.repetitions == 50
+    assert sampler.last_choice == choice
+
+
+def test_post_selection_impossible(monkeypatch):
+    monkeypatch.setattr(auto_sampler, "_MAX_REJECTED_REPS", 1000)
+    q0 = cirq.LineQubit(0)
+    circuit = cirq.Circuit(PostSelectOperation(q0, 1), cirq.measure(q0, key="m"))
+    sampler = alpha.AutoSampler()
+    sampler.choose = lambda circuit: "dense"
+    with pytest.raises(InvalidPostSelectionError):
+        sampler.run(circuit)
+
+
+@pytest.mark.parametrize(
+    ("min_clifford_qubits", "state_type"),
+    [(1, StabilizerSimulationState), (16, SparseSimulationState)],
+)
+def test_simulate_state(min_clifford_qubits, state_type):
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    circuit = cirq.Circuit(
+        cirq.H(q0), cirq.CNOT(q0, q1), cirq.H(q2), PostSelectOperation(q1, 1)
+    )
+    sampler = alpha.AutoSampler(min_clifford_qubits=min_clifford_qubits)
+    state = sampler.simulate_state(circuit)
+    assert isinstance(state, state_type)
+    assert state.definite_value(q0) == 1
+    assert state.definite_value(q2) is None
+
+
+def test_simulate_state_dense_circuits():
+    q0 = cirq.LineQid(0, dimension=3)
+    q1 = cirq.LineQubit(1)
+    sampler = alpha.AutoSampler()
+    circuit = cirq.Circuit(QuditPlusGate(3)(q0))
+    assert sampler.choose(circuit) == "dense"
+    assert sampler.simulate_state(circuit) is None
+    circuit = cirq.Circuit(cirq.H(q1), cirq.bit_flip(0.1)(q1))
+    assert sampler.simulate_state(circuit) is None
+
+    light = alpha.QuantumObject("l1", StopLight.RED)
+    world = alpha.QuantumWorld([light], sampler="auto", compile_to_qubits=False)
+    alpha.QuditFlip(3, StopLight.RED.value, StopLight.GREEN.value)(light)
+    assert not world.reset_if_classical()
+    assert world.peek() == [[StopLight.GREEN]]
+
+
+def test_world(caplog):
+    lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(4)]
+    world = alpha.QuantumWorld(lights, sampler="auto", seed=5)
+    assert isinstance(world.sampler, alpha.AutoSampler)
+    assert world.use_sparse
+    assert world.compile_to_qubits
+    alpha.Superposition()(lights[0])
+    alpha.Move()(lights[0], lights[1])
+    world.force_measurement(lights[1], Light.GREEN)
+    with caplog.at_level(logging.INFO, logger="unitary.alpha.auto_sampler"):
+        assert (
+            world.peek(count=10)
+            == [[Light.RED, Light.GREEN, Light.RED, Light.RED]] * 10
+        )
+    assert "simulator" in caplog.text
+
+    copy = world.copy()
+    assert isinstance(copy.sampler, alpha.AutoSampler)
+    assert copy.sampler is not world.sampler
+
+    with pytest.raises(ValueError, match="Unknown sampler"):
+        alpha.QuantumWorld(sampler="dense")
+
+
+def test_large_clifford_world():
+    lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(40)]
+    world = alpha.QuantumWorld(lights, sampler="auto", seed=5)
+    for light in lights:
+        alpha.Superposition()(light)
+    for first, second in zip(lights[::2], lights[1::2]):
+        alpha.quantum_if(first).apply(alpha.Flip())(second)
+    results = np.array(world.peek(count=20, convert_to_enum=False))
+    assert world.sampler.last_choice == "clifford"
+    assert results.shape == (20, 40)
+    assert len(set(map(tuple, results))) > 1
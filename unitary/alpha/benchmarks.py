@@ -0,0 +1,364 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks of the alpha simulation stack.
+
+To run this:
+  python -m unitary.alpha.benchmarks [--output results.json] [--quick]
+
+The following is measured:
+  - adding random mixes of effects to worlds of qubit and qutrit objects,
+    and peeking the resulting worlds (`random_effects`),
+  - the latency of `peek` and `pop` against the length of the effect
+    history (`history_length`),
+  - `SparseSimulator` against `cirq.Simulator` for growing numbers of
+    objects (`crossover`),
+  - the overhead of `compile_to_qubits` for qutrits (`compile_to_qubits`),
+  - the cost of `undo_last_effect` and `restore_last_snapshot`
+    (`undo_snapshot`).
+
+The effects applied and the samplers are seeded, so every run simulates the
+same circuits.  The results are written as JSON: one record per measurement,
+with the benchmark name, its parameters and the minimum, median and mean
+time in seconds over the repeats.  `--quick` uses small sizes, e.g. to check
+that the suite still runs.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import argparse
+import enum
+import json
+import platform
+import statistics
+import sys
+import time
+
+import cirq
+import numpy as np
+
+import unitary.alpha as alpha
+from unitary._version import __version__
+from unitary.alpha.qudit_gates import QuditHadamardGate
+
+
+class Qubit(enum.Enum):
+    EMPTY = 0
+    FULL = 1
+
+
+class Qutrit(enum.Enum):
+    EMPTY = 0
+    LOW = 1
+    HIGH = 2
+
+
+_SAMPLERS: Dict[str, Callable[[int], cirq.Sampler]] = {
+    "sparse": lambda seed: alpha.SparseSimulator(seed=seed),
+    "cirq": lambda seed: cirq.Simulator(seed=seed),
+}
+
+
+def _measure(
+    fn: Callable[[Any], Any],
+    repeats: int,
+    setup: Optional[Callable[[], Any]] = None,
+) -> Dict[str, float]:
+    """Times `fn` over a number of repeats.
+
+    If given, `setup` is called (untimed) before every repeat and its
+    result is passed to `fn`.
+    """
+    spans = []
+    for _ in range(repeats):
+        arg = setup() if setup is not None else None
+        t0 = time.perf_counter()
+        fn(arg)
+        spans.append(time.perf_counter() - t0)
+    return {
+        "min": min(spans),
+        "median": statistics.median(spans),
+        "mean": statistics.mean(spans),
+        "repeats": repeats,
+    }
+
+
+def make_world(
+    num_objects: int,
+    dimension: int = 2,
+    sampler: str = "sparse",
+    compile_to_qubits: Optional[bool] = None,
+    seed: int = 0,
+) -> alpha.QuantumWorld:
+    """Creates a world in which every fourth object starts out non-empty."""
+    enum_type = Qubit if dimension == 2 else Qutrit
+    objects = [
+        alpha.QuantumObject(f"o{idx}", enum_type(1 if idx % 4 == 0 else 0))
+        for idx in range(num_objects)
+    ]
+    return alpha.QuantumWorld(
+        objects,
+        sampler=_SAMPLERS[sampler](seed),
+        compile_to_qubits=compile_to_qubits,
+    )
+
+
+def apply_random_effects(
+    world: alpha.QuantumWorld, num_effects: int, rng: np.random.Generator
+) -> None:
+    """Applies a random mix of effects to the objects of the world.
+
+    Qubits get `Split`, `Move`, `PhasedMove` and `quantum_if` effects.
+    Qutrits have no splitting effects, so they get Hadamard gates, `Cycle`,
+    `Flip` and `quantum_if` effects instead.
+    """
+    objects = world.public_objects
+    qutrits = objects[0].num_states == 3
+    for _ in range(num_effects):
+        kind = rng.integers(4)
+        picked = [objects[idx] for idx in rng.choice(len(objects), 3, replace=False)]
+        if qutrits:
+            if kind == 0:
+                world.add_effect([QuditHadamardGate(3).on(picked[0].qubit)])
+            elif kind == 1:
+                alpha.Cycle(int(rng.integers(1, 3)))(picked[0])
+            elif kind == 2:
+                alpha.Flip(state0=0, state1=2)(picked[0])
+            else:
+                condition = int(rng.integers(3))
+                alpha.quantum_if(picked[0]).equals(condition).apply(alpha.Cycle())(
+                    picked[1]
+                )
+        else:
+            if kind == 0:
+                alpha.Split()(*picked)
+            elif kind == 1:
+                alpha.Move()(picked[0], picked[1])
+            elif kind == 2:
+                alpha.PhasedMove()(picked[0], picked[1])
+            else:
+                alpha.quantum_if(picked[0]).apply(alpha.Flip())(picked[1])
+
+
+def bench_random_effects(
+    sizes: Sequence[int], num_effects: int, repeats: int, seed: int
+) -> List[Dict[str, Any]]:
+    records = []
+    for dimension in (2, 3):
+        for num_objects in sizes:
+            params = {
+                "dimension": dimension,
+                "num_objects": num_objects,
+                "num_effects": num_effects,
+            }
+
+            def new_world():
+                return make_world(num_objects, dimension, seed=seed)
+
+            def add_effects(world):
+                apply_random_effects(world, num_effects, np.random.default_rng(seed))
+
+            records.append(
+                {
+                    "name": "random_effects.add_effect",
+                    "params": params,
+                    **_measure(add_effects, repeats, new_world),
+                }
+            )
+            world = new_world()
+            add_effects(world)
+            records.append(
+                {
+                    "name": "random_effects.peek",
+                    "params": params,
+                    **_measure(lambda _: world.peek(count=100), repeats),
+                }
+            )
+    return records
+
+
+def bench_history_length(
+    lengths: Sequence[int], num_objects: int, repeats: int, seed: int
+) -> List[Dict[str, Any]]:
+    records = []
+    for length in lengths:
+        params = {"num_objects": num_objects, "history_length": length}
+        world = make_world(num_objects, seed=seed)
+        apply_random_effects(world, length, np.random.default_rng(seed))
+        records.append(
+            {
+                "name": "history_length.peek",
+                "params": params,
+                **_measure(lambda _: world.peek(), repeats),
+            }
+        )
+        records.append(
+            {
+                "name": "history_length.pop",
+                "params": params,
+                **_measure(lambda w: w.pop(), repeats, world.copy),
+            }
+        )
+    return records
+
+
+def bench_crossover(
+    sizes: Sequence[int], num_effects: int, repeats: int, seed: int
+) -> List[Dict[str, Any]]:
+    records = []
+    for num_objects in sizes:
+        for sampler in _SAMPLERS:
+            world = make_world(
+                num_objects, sampler=sampler, compile_to_qubits=False, seed=seed
+            )
+            apply_random_effects(world, num_effects, np.random.default_rng(seed))
+            records.append(
+                {
+                    "name": "crossover.peek",
+                    "params": {
+                        "sampler": sampler,
+                        "num_objects": num_objects,
+                        "num_effects": num_effects,
+                    },
+                    **_measure(lambda _: world.peek(count=100), repeats),
+                }
+            )
+    return records
+
+
+def bench_compile_to_qubits(
+    sizes: Sequence[int], num_effects: int, repeats: int, seed: int
+) -> List[Dict[str, Any]]:
+    records = []
+    for num_objects in sizes:
+        for compile_to_qubits in (False, True):
+            params = {
+                "compile_to_qubits": compile_to_qubits,
+                "num_objects": num_objects,
+                "num_effects": num_effects,
+            }
+
+            def new_world():
+                return make_world(
+                    num_objects,
+                    dimension=3,
+                    sampler="cirq",
+                    compile_to_qubits=compile_to_qubits,
+                    seed=seed,
+                )
+
+            def add_effects(world):
+                apply_random_effects(world, num_effects, np.random.default_rng(seed))
+
+            records.append(
+                {
+                    "name": "compile_to_qubits.add_effect",
+                    "params": params,
+                    **_measure(add_effects, repeats, new_world),
+                }
+            )
+            world = new_world()
+            add_effects(world)
+            records.append(
+                {
+                    "name": "compile_to_qubits.peek",
+                    "params": params,
+                    **_measure(lambda _: world.peek(count=100), repeats),
+                }
+            )
+    return records
+
+
+def bench_undo_snapshot(
+    lengths: Sequence[int], num_objects: int, repeats: int, seed: int
+) -> List[Dict[str, Any]]:
+    records = []
+    for length in lengths:
+        params = {"num_objects": num_objects, "history_length": length}
+        world = make_world(num_objects, seed=seed)
+        rng = np.random.default_rng(seed)
+        world.save_snapshot()
+        for _ in range(length):
+            apply_random_effects(world, 1, rng)
+            world.save_snapshot()
+        records.append(
+            {
+                "name": "undo_snapshot.undo_last_effect",
+                "params": params,
+                **_measure(lambda w: w.undo_last_effect(), repeats, world.copy),
+            }
+        )
+        records.append(
+            {
+                "name": "undo_snapshot.restore_last_snapshot",
+                "params": params,
+                **_measure(lambda w: w.restore_last_snapshot(), repeats, world.copy),
+            }
+        )
+        records.append(
+            {
+                "name": "undo_snapshot.copy",
+                "params": params,
+                **_measure(lambda _: world.copy(), repeats),
+            }
+        )
+    return records
+
+
+def run_all(quick: bool = False, repeats: int = 5, seed: int = 0) -> Dict[str, Any]:
+    """Runs all benchmarks.
+
+    Returns:
+        A JSON-compatible dictionary with the versions of the environment
+        and a list of records, one for each measurement.
+    """
+    if quick:
+        sizes, num_effects, lengths = [3, 4], 5, [1, 5]
+    else:
+        sizes, num_effects, lengths = [4, 8, 12, 16], 50, [10, 50, 200]
+    records = [
+        *bench_random_effects(sizes, num_effects, repeats, seed),
+        *bench_history_length(lengths, sizes[-1], repeats, seed),
+        *bench_crossover(sizes, num_effects, repeats, seed),
+        *bench_compile_to_qubits(sizes[:2], num_effects, repeats, seed),
+        *bench_undo_snapshot(lengths, sizes[-1], repeats, seed),
+    ]
+    return {
+        "unitary": __version__,
+        "cirq": cirq.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "seed": seed,
+        "repeats": repeats,
+        "records": records,
+    }
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--quick", action="store_true", help="use small sizes")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    results = run_all(quick=args.quick, repeats=args.repeats, seed=args.seed)
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
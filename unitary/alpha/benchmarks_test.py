@@ -0,0 +1,49 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import numpy as np
+import pytest
+
+from unitary.alpha import benchmarks
+
+
+@pytest.mark.parametrize("dimension", [2, 3])
+def test_random_effects_are_reproducible(dimension):
+    world1 = benchmarks.make_world(5, dimension)
+    world2 = benchmarks.make_world(5, dimension)
+    num_initial_effects = len(world1.effect_history)
+    benchmarks.apply_random_effects(world1, 10, np.random.default_rng(3))
+    benchmarks.apply_random_effects(world2, 10, np.random.default_rng(3))
+    assert len(world1.effect_history) == num_initial_effects + 10
+    assert world1.circuit == world2.circuit
+
+
+def test_main(tmp_path):
+    path = tmp_path / "results.json"
+    benchmarks.main(["--quick", "--repeats", "1", "--output", str(path)])
+    with open(path) as handle:
+        results = json.load(handle)
+    names = {record["name"].split(".")[0] for record in results["records"]}
+    assert names == {
+        "random_effects",
+        "history_length",
+        "crossover",
+        "compile_to_qubits",
+        "undo_snapshot",
+    }
+    for record in results["records"]:
+        assert record["repeats"] == 1
+        assert record["min"] == record["median"] == record["mean"] >= 0
@@ -0,0 +1,353 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Simulator using a matrix product state.
+
+The memory used scales with the entanglement of the state rather than with
+the number of basis states in its support, so boards with many qubits and
+local entanglement (a few split pieces) remain tractable.
+
+Supports unitary Cirq gates on qubits and qudits, measurements and the
+post-selection operator.
+"""
+
+from typing import List, Optional
+import copy
+
+import cirq
+import numpy as np
+
+from unitary.alpha.sparse_vector_simulator import (
+    InvalidPostSelectionError,
+    PostSelectOperation,
+    SparseSimulatorStep,
+    _EPSILON,
+    _random_state,
+)
+
+# Singular values smaller than this fraction of the largest one are dropped.
+_SVD_CUTOFF = 1e-10
+
+
+class MPSSimulationState(cirq.SimulationState):
+    """Implements matrix product state evolution and sampling.
+
+    The state is a chain of tensors, one per qid, of shape (left bond,
+    qid dimension, right bond).  The chain is kept in mixed canonical form
+    around a center tensor, so that truncating the bond dimension after a
+    gate keeps the largest Schmidt coefficients.
+
+    Gates on several qids first move them next to each other in the chain
+    with swaps, so the position of a qid in the chain changes over time.
+
+    Args:
+        qubits: The qids of the state.
+        prng: Random state used for measurements in the middle of circuits.
+        classical_data: Shared classical data of the simulation.
+        max_bond_dimension: If set, bonds are truncated to this dimension.
+            This bounds memory and time, at the cost of accuracy (see
+            `truncation_error`).
+        initial_state: Index of the initial basis state (big endian).
+    """
+
+    def __init__(
+        self,
+        qubits,
+        prng=None,
+        classical_data=None,
+        max_bond_dimension: Optional[int] = None,
+        initial_state: int = 0,
+    ):
+        super().__init__(
+            qubits=qubits, prng=prng, classical_data=classical_data, state=None
+        )
+        self.max_bond_dimension = max_bond_dimension
+        # Total weight of the discarded Schmidt coefficients, summed over all
+        # truncations.
+        self.truncation_error = 0.0
+        shape = [q.dimension for q in qubits]
+        self._tensors = []
+        for dimension, digit in zip(
+            shape, cirq.big_endian_int_to_digits(initial_state, base=shape)
+        ):
+            tensor = np.zeros((1, dimension, 1), dtype=np.complex128)
+            tensor[0, digit, 0] = 1
+            self._tensors.append(tensor)
+        self._sites = list(qubits)
+        self._site_of = {q: idx for idx, q in enumerate(qubits)}
+        self._center = 0
+
+    def copy(self, deep_copy_buffers: bool = True):
+        # Tensors are replaced rather than modified in place, so copies can
+        # share them.
+        state = copy.copy(self)
+        state._classical_data = self._classical_data.copy()
+        state._tensors = list(self._tensors)
+        state._sites = list(self._sites)
+        state._site_of = dict(self._site_of)
+        return state
+
+    def bond_dimensions(self) -> List[int]:
+        """Dimensions of the bonds between neighboring tensors of the chain."""
+        return [tensor.shape[2] for tensor in self._tensors[:-1]]
+
+    def _move_center(self, site: int) -> None:
+        """Moves the center of the canonical form to the given site."""
+        while self._center < site:
+            tensor = self._tensors[self._center]
+            left, dimension, right = tensor.shape
+            q, r = np.linalg.qr(tensor.reshape(left * dimension, right))
+            self._tensors[self._center] = q.reshape(left, dimension, -1)
+            self._tensors[self._center + 1] = np.einsum(
+                "ab,bdc->adc", r, self._tensors[self._center + 1]
+            )
+            self._center += 1
+        while self._center > site:
+            tensor = self._tensors[self._center]
+            left, dimension, right = tensor.shape
+            q, r = np.linalg.qr(tensor.reshape(left, dimension * right).T)
+            self._tensors[self._center] = q.T.reshape(-1, dimension, right)
+            self._tensors[self._center - 1] = np.einsum(
+                "adb,cb->adc", self._tensors[self._center - 1], r
+            )
+            self._center -= 1
+
+    def _merge(self, start: int, num_sites: int) -> np.ndarray:
+        """Contracts the tensors of consecutive sites.
+
+        Returns:
+            A tensor of shape (left bond, dimensions of the sites..., right bond).
+        """
+        block = self._tensors[start]
+        for tensor in self._tensors[start + 1 : start + num_sites]:
+            block = np.tensordot(block, tensor, axes=1)
+        return block
+
+    def _split(self, start: int, block: np.ndarray) -> None:
+        """Splits a merged block back into tensors, truncating the bonds.
+
+        The center must be at `start`.  It is moved to the last site of the
+        block.
+        """
+        num_sites = block.ndim - 2
+        for offset in range(num_sites - 1):
+            left, dimension = block.shape[:2]
+            rest = block.shape[2:]
+            u, s, vh = np.linalg.svd(
+                block.reshape(left * dimension, -1), full_matrices=False
+            )
+            keep = int(np.count_nonzero(s > _SVD_CUTOFF * s[0]))
+            if self.max_bond_dimension is not None:
+                keep = min(keep, self.max_bond_dimension)
+            weights = s**2
+            discarded = weights[keep:].sum()
+            if discarded:
+                self.truncation_error += discarded / weights.sum()
+            s = s[:keep] * np.linalg.norm(s) / np.linalg.norm(s[:keep])
+            self._tensors[start + offset] = u[:, :keep].reshape(left, dimension, keep)
+            block = (s[:, None] * vh[:keep]).reshape(keep, *rest)
+        self._tensors[start + num_sites - 1] = block
+        self._center = start + num_sites - 1
+
+    def _swap_sites(self, site: int) -> None:
+        """Exchanges the qids at the given site and the next one."""
+        self._move_center(site)
+        block = self._merge(site, 2).transpose(0, 2, 1, 3)
+        self._split(site, block)
+        first, second = self._sites[site], self._sites[site + 1]
+        self._sites[site], self._sites[site + 1] = second, first
+        self._site_of[first], self._site_of[second] = site + 1, site
+
+    def _gather(self, qubits) -> int:
+        """Moves the qids to consecutive sites, in order.
+
+        Returns:
+            The site of the first qid.
+        """
+        start = min(self._site_of[q] for q in qubits)
+        for offset, qubit in enumerate(qubits):
+            # All qids not placed yet are to the right of the placed ones.
+            while self._site_of[qubit] > start + offset:
+                self._swap_sites(self._site_of[qubit] - 1)
+        return start
+
+    def _act_on_fallback_(self, action, qubits, allow_decompose):
+        unitary = cirq.unitary(action, None)
+        if unitary is None:
+            return NotImplemented
+        if len(qubits) == 1:
+            site = self._site_of[qubits[0]]
+            self._tensors[site] = np.einsum("ij,ajb->aib", unitary, self._tensors[site])
+            return True
+        start = self._gather(qubits)
+        self._move_center(start)
+        block = self._merge(start, len(qubits))
+        shape = block.shape
+        block = np.einsum(
+            "ij,ajb->aib", unitary, block.reshape(shape[0], -1, shape[-1])
+        )
+        self._split(start, block.reshape(shape))
+        return True
+
+    def _perform_measurement(self, qubits):
+        values = []
+        for qubit in qubits:
+            probs = self._probabilities(self._site_of[qubit])
+            value = int(self.prng.choice(len(probs), p=probs))
+            self.post_select(qubit, value)
+            values.append(value)
+        return values
+
+    def _probabilities(self, site: int) -> np.ndarray:
+        self._move_center(site)
+        probs = np.sum(abs(self._tensors[site]) ** 2, axis=(0, 2))
+        return probs / probs.sum()
+
+    def marginal_probabilities(self, qubits) -> List[np.ndarray]:
+        """Returns the probabilities of the values of each of the qids.
+
+        Returns:
+            One array per qid, holding the probability of each of its values.
+        """
+        return [self._probabilities(self._site_of[q]) for q in qubits]
+
+    def definite_value(self, qubit):
+        """Returns the value of the qid if it is in a basis state, else None."""
+        if qubit not in self._site_of:
+            return 0
+        probabilities = self._probabilities(self._site_of[qubit])
+        (values,) = np.nonzero(probabilities > _EPSILON * np.sum(probabilities))
+        if len(values) != 1:
+            return None
+        return int(values[0])
+
+    def post_select(self, qubit, value):
+        site = self._site_of[qubit]
+        self._move_center(site)
+        tensor = np.zeros_like(self._tensors[site])
+        tensor[:, value, :] = self._tensors[site][:, value, :]
+        norm = np.linalg.norm(tensor)
+        if norm**2 < _EPSILON:
+            raise InvalidPostSelectionError(f"No states where {qubit} equals {value}")
+        self._tensors[site] = tensor / norm
+
+    # abstract method of OperationTarget
+    def sample(self, qubits, repetitions, prng):
+        prng = cirq.value.parse_random_state(prng)
+        # With the center at the first site, all other tensors are right
+        # canonical, so values can be sampled site by site from left to
+        # right, and sites after the last measured one can be ignored.
+        self._move_center(0)
+        columns = [self._site_of[q] for q in qubits]
+        num_sites = max(columns, default=-1) + 1
+        values = np.zeros((repetitions, num_sites), dtype=np.uint8)
+        vectors = np.ones((repetitions, 1), dtype=np.complex128)
+        rows = np.arange(repetitions)
+        for site in range(num_sites):
+            candidates = np.einsum("ra,adb->rdb", vectors, self._tensors[site])
+            probs = np.sum(abs(candidates) ** 2, axis=2)
+            cumulative = np.cumsum(probs, axis=1)
+            draws = prng.random_sample(repetitions) * cumulative[:, -1]
+            choice = np.minimum(
+                np.sum(cumulative < draws[:, None], axis=1), probs.shape[1] - 1
+            )
+            values[:, site] = choice
+            vectors = candidates[rows, choice]
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return values[:, columns]
+
+
+class MPSSimulator(cirq.SimulatorBase):
+    """Simulator using a matrix product state.
+
+    Args:
+        seed: Seed of the random state used for sampling.  Can be anything
+            accepted by `SparseSimulator`.
+        max_bond_dimension: If set, bonds of the matrix product state are
+            truncated to this dimension.
+    """
+
+    # `PostSelectOperation`s are applied to the state, so `QuantumWorld`
+    # can add them to circuits.
+    supports_post_selection = True
+
+    def __init__(self, seed=None, max_bond_dimension: Optional[int] = None):
+        super().__init__(seed=_random_state(seed), split_untangled_states=False)
+        self.max_bond_dimension = max_bond_dimension
+
+    def simulate_state(self, program, qubit_order=cirq.QubitOrder.DEFAULT):
+        """Simulates a circuit without measurements and returns the final state.
+
+        Args:
+            program: The circuit to simulate.  It may contain post-selections
+                but no measurements.
+            qubit_order: Determines the canonical ordering of the qids.
+
+        Returns:
+            The `MPSSimulationState` at the end of the circuit.
+        """
+        qubits = cirq.QubitOrder.as_qubit_order(qubit_order).order_for(
+            program.all_qubits()
+        )
+        state = self._create_partial_simulation_state(
+            0, qubits, cirq.ClassicalDataDictionaryStore()
+        )
+        for op in program.all_operations():
+            cirq.act_on(op, state)
+        return state
+
+    def marginal_probabilities(
+        self, program, qubits, qubit_order=cirq.QubitOrder.DEFAULT
+    ) -> List[np.ndarray]:
+        """Returns the probabilities of the values of the qids after the circuit.
+
+        See `MPSSimulationState.marginal_probabilities`.
+        """
+        return self.simulate_state(program, qubit_order).marginal_probabilities(qubits)
+
+    # override
+    def _can_be_in_run_prefix(self, val):
+        return super()._can_be_in_run_prefix(val) or isinstance(
+            val, PostSelectOperation
+        )
+
+    # abstract method of SimulatorBase
+    def _create_partial_simulation_state(self, initial_state, qubits, classical_data):
+        if isinstance(initial_state, MPSSimulationState):
+            return initial_state
+        return MPSSimulationState(
+            qubits=qubits,
+            prng=self._prng,
+            classical_data=classical_data,
+            max_bond_dimension=self.max_bond_dimension,
+            initial_state=initial_state,
+        )
+
+    # abstract method of SimulatorBase
+    def _create_step_result(self, sim_state):
+        return MPSSimulatorStep(sim_state=sim_state)
+
+    # abstract method of SimulatorBase
+    def _create_simulator_trial_result(
+        self, params, measurements, final_simulator_state
+    ):
+        return cirq.SimulationTrialResult(
+            params=params,
+            measurements=measurements,
+            final_simulator_state=final_simulator_state,
+        )
+
+
+class MPSSimulatorStep(SparseSimulatorStep):
+    """Step result of `MPSSimulator`."""
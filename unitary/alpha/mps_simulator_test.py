@@ -0,0 +1,224 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import enum
+
+import cirq
+import numpy as np
+import pytest
+from cirq.testing import random_circuit
+
+import unitary.alpha as alpha
+import unitary.quantum_chess.bit_utils as u
+import unitary.quantum_chess.enums as enums
+import unitary.quantum_chess.move as move
+import unitary.quantum_chess.quantum_board as qb
+from unitary.alpha.mps_simulator import MPSSimulator
+from unitary.alpha.qudit_gates import QuditHadamardGate, QuditPlusGate
+from unitary.alpha.sparse_vector_simulator import (
+    InvalidPostSelectionError,
+    PostSelectOperation,
+)
+
+
+class Light(enum.Enum):
+    RED = 0
+    GREEN = 1
+
+
+def _distribution(samples):
+    counts = collections.Counter(map(tuple, samples))
+    return {outcome: count / len(samples) for outcome, count in counts.items()}
+
+
+def test_simulation_fidelity():
+    """Check that the outcome distribution is the same as the Cirq simulator's."""
+    qubits = cirq.LineQubit.range(6)
+    circuit = random_circuit(
+        qubits=qubits, n_moments=15, op_density=0.8, random_state=3
+    )
+    circuit.append(cirq.measure(*qubits, key="m"))
+    repetitions = 20000
+    test_data = MPSSimulator(seed=1).run(circuit, repetitions=repetitions)
+    expected = abs(cirq.final_state_vector(circuit[:-1], qubit_order=qubits)) ** 2
+    distribution = _distribution(test_data.measurements["m"])
+    for outcome, probability in distribution.items():
+        index = cirq.big_endian_bits_to_int(outcome)
+        assert abs(probability - expected[index]) < 0.02
+
+
+def test_qudits():
+    q0, q1 = cirq.LineQid.range(2, dimension=3)
+    circuit = cirq.Circuit(
+        QuditHadamardGate(3).on(q0),
+        cirq.ControlledGate(
+            QuditPlusGate(3), control_values=[2], control_qid_shape=[3]
+        )(q0, q1),
+        cirq.measure(q0, q1, key="m"),
+    )
+    samples = MPSSimulator(seed=2).run(circuit, repetitions=1000)
+    distribution = _distribution(samples.measurements["m"])
+    assert set(distribution) == {(0, 0), (1, 0), (2, 1)}
+
+
+def test_marginal_probabilities():
+    qubits = cirq.LineQubit.range(5)
+    circuit = random_circuit(
+        qubits=qubits, n_moments=10, op_density=0.8, random_state=7
+    )
+    expected = (
+        abs(
+            cirq.final_state_vector(circuit, qubit_order=qubits, dtype=np.complex128)
+        ).reshape((2,) * 5)
+        ** 2
+    )
+    marginals = MPSSimulator().marginal_probabilities(circuit, qubits[::-1])
+    for idx, probs in enumerate(marginals):
+        axis = 4 - idx
+        others = tuple(a for a in range(5) if a != axis)
+        np.testing.assert_allclose(probs, expected.sum(axis=others), atol=1e-8)
+
+
+def test_post_selection():
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    circuit = cirq.Circuit(
+        cirq.H(q0),
+        cirq.CNOT(q0, q2),
+        cirq.H(q1),
+        PostSelectOperation(q0, 1),
+        cirq.H(q0),
+        cirq.CNOT(q1, q0),
+        PostSelectOperation(q1, 1),
+        cirq.measure(q0, q1, q2, key="m"),
+    )
+    samples = MPSSimulator(seed=2).run(circuit, repetitions=1000)
+    distribution = _distribution(samples.measurements["m"])
+    assert set(distribution) == {(0, 1, 1), (1, 1, 1)}
+    assert abs(distribution[(0, 1, 1)] - 0.5) < 0.1
+
+
+def test_definite_value():
+    q0, q1, q2, q3 = cirq.LineQubit.range(4)
+    circuit = cirq.Circuit(
+        cirq.X(q0), cirq.H(q1), cirq.CNOT(q1, q2), PostSelectOperation(q2, 1)
+    )
+    state = MPSSimulator().simulate_state(circuit)
+    assert state.definite_value(q0) == 1
+    assert state.definite_value(q1) == 1
+    assert state.definite_value(q2) == 1
+    assert state.definite_value(q3) == 0
+
+    state = MPSSimulator().simulate_state(cirq.Circuit(cirq.H(q1), cirq.CNOT(q1, q2)))
+    assert state.definite_value(q1) is None
+    assert state.definite_value(q2) is None
+
+
+def test_invalid_post_selection():
+    q0 = cirq.LineQubit(0)
+    circuit = cirq.Circuit(
+        cirq.X(q0), PostSelectOperation(q0, 0), cirq.measure(q0, key="m")
+    )
+    with pytest.raises(InvalidPostSelectionError):
+        MPSSimulator().run(circuit)
+
+
+def test_mid_circuit_measurement():
+    q0, q1 = cirq.LineQubit.range(2)
+    circuit = cirq.Circuit(
+        cirq.H(q0),
+        cirq.CNOT(q0, q1),
+        cirq.measure(q0, key="a"),
+        cirq.X(q0),
+        cirq.measure(q0, q1, key="b"),
+    )
+    samples = MPSSimulator(seed=3).run(circuit, repetitions=100)
+    a = samples.measurements["a"][:, 0]
+    b = samples.measurements["b"]
+    np.testing.assert_array_equal(b[:, 0], 1 - a)
+    np.testing.assert_array_equal(b[:, 1], a)
+    assert 0 < a.sum() < 100
+
+
+def test_seed():
+    qubits = cirq.LineQubit.range(10)
+    circuit = cirq.Circuit(cirq.H.on_each(*qubits), cirq.measure(*qubits, key="m"))
+    results = [
+        MPSSimulator(seed=np.random.SeedSequence(4))
+        .run(circuit, repetitions=5)
+        .measurements["m"]
+        for _ in range(2)
+    ]
+    np.testing.assert_array_equal(*results)
+
+
+def test_max_bond_dimension():
+    qubits = cirq.LineQubit.range(8)
+    circuit = random_circuit(qubits=qubits, n_moments=30, op_density=1, random_state=5)
+    state = MPSSimulator().simulate_state(circuit)
+    assert max(state.bond_dimensions()) > 2
+    assert state.truncation_error < 1e-8
+
+    truncated = MPSSimulator(max_bond_dimension=2).simulate_state(circuit)
+    assert max(truncated.bond_dimensions()) <= 2
+    assert truncated.truncation_error > 0
+    for probs in truncated.marginal_probabilities(qubits):
+        assert abs(probs.sum() - 1) < 1e-8
+
+
+def test_distant_qubits():
+    """Gates on distant qubits of a long chain keep bond dimensions small."""
+    qubits = cirq.LineQubit.range(60)
+    order = np.random.default_rng(6).permutation(60)
+    circuit = cirq.Circuit(cirq.H(qubits[order[0]]))
+    for control, target in zip(order[:-1], order[1:]):
+        circuit.append(cirq.CNOT(qubits[control], qubits[target]))
+    circuit.append(cirq.measure(*qubits, key="m"))
+    simulator = MPSSimulator(seed=6)
+    assert max(simulator.simulate_state(circuit[:-1]).bond_dimensions()) == 2
+    samples = simulator.run(circuit, repetitions=100).measurements["m"]
+    assert set(map(tuple, samples)) == {(0,) * 60, (1,) * 60}
+
+
+def test_world():
+    lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(40)]
+    world = alpha.QuantumWorld(lights, sampler=MPSSimulator(seed=5))
+    assert world.use_sparse
+    for a, b in zip(lights[::2], lights[1::2]):
+        alpha.Superposition()(a)
+        alpha.quantum_if(a).apply(alpha.Flip())(b)
+    alpha.PhasedMove()(lights[0], lights[1])
+    world.force_measurement(lights[2], Light.GREEN)
+
+    results = np.array(world.peek(count=50, convert_to_enum=False))
+    assert results.shape == (50, 40)
+    np.testing.assert_array_equal(results[:, 2:40:2], results[:, 3:40:2])
+    assert (results[:, 2] == 1).all()
+    assert sorted(set(results[:, 4])) == [0, 1]
+    assert world.pop([lights[3]]) == [Light.GREEN]
+
+
+def test_cirq_board():
+    board = qb.CirqBoard(u.squares_to_bitboard(["a1"]), sampler=MPSSimulator(seed=7))
+    board.do_move(
+        move.Move(
+            "a1",
+            "a3",
+            target2="c1",
+            move_type=enums.MoveType.SPLIT_JUMP,
+            move_variant=enums.MoveVariant.BASIC,
+        )
+    )
+    samples = set(board.sample(100))
+    assert samples == {u.squares_to_bitboard(["a3"]), u.squares_to_bitboard(["c1"])}
@@ -0,0 +1,125 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in instrumentation of `QuantumWorld` and `SparseSimulator`."""
+
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Optional
+import contextlib
+import json
+import time
+
+
+class Profiler:
+    """Collects timings and counters of the hot paths of a game.
+
+    Pass a profiler to `QuantumWorld` (and to `SparseSimulator`, if the
+    world is given its own sampler) to record:
+
+     - the time spent in each phase ("add_effect", "circuit_copy", "run",
+       "post_select" in the world and "sample" in the simulator),
+     - the number of nonzero amplitudes of the sparse state after each
+       gate, by gate type, and the peak number over all gates,
+     - the number of accepted and rejected repetitions of post-selection,
+     - the hits and misses of the operation cache of `QuantumEffect`s.
+
+    Without a profiler none of this is recorded, and the instrumented code
+    only checks whether a profiler is set.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        """Resets all timings and counters."""
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+        self.state_sizes: Dict[str, List[int]] = defaultdict(list)
+        self.peak_state_size = 0
+        self.accepted_shots = 0
+        self.rejected_shots = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def record_time(self, phase: str, t0: float, t1: Optional[float] = None) -> None:
+        """Records the time span from t0 to t1 (or now) as spent in `phase`."""
+        if t1 is None:
+            t1 = time.perf_counter()
+        self.timings[phase].append(t1 - t0)
+
+    @contextlib.contextmanager
+    def time(self, phase: str) -> Iterator[None]:
+        """Context manager recording the time spent in its body."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_time(phase, t0)
+
+    def record_state_size(self, gate: str, size: int) -> None:
+        """Records the number of nonzero amplitudes after applying a gate."""
+        self.state_sizes[gate].append(size)
+        if size > self.peak_state_size:
+            self.peak_state_size = size
+
+    def record_shots(self, accepted: int, rejected: int) -> None:
+        """Records the outcome of post-selecting sampled repetitions."""
+        self.accepted_shots += accepted
+        self.rejected_shots += rejected
+
+    def record_cache_lookup(self, hit: bool) -> None:
+        """Records a lookup in the operation cache of `QuantumEffect`s."""
+        if hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns a JSON-compatible snapshot of the collected statistics."""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "timings": {
+                phase: {
+                    "count": len(spans),
+                    "total": sum(spans),
+                    "mean": sum(spans) / len(spans),
+                    "max": max(spans),
+                }
+                for phase, spans in self.timings.items()
+            },
+            "state_sizes": {
+                gate: {
+                    "count": len(sizes),
+                    "mean": sum(sizes) / len(sizes),
+                    "max": max(sizes),
+                }
+                for gate, sizes in self.state_sizes.items()
+            },
+            "peak_state_size": self.peak_state_size,
+            "shots": {
+                "accepted": self.accepted_shots,
+                "rejected": self.rejected_shots,
+            },
+            "cache": {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / lookups if lookups else None,
+            },
+        }
+
+    def to_json(self, **kwargs) -> str:
+        """Returns the snapshot of `to_dict` as JSON.
+
+        Keyword arguments are passed on to `json.dumps`.
+        """
+        return json.dumps(self.to_dict(), **kwargs)
@@ -0,0 +1,83 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import enum
+import json
+
+import cirq
+
+import unitary.alpha as alpha
+
+
+class Light(enum.Enum):
+    RED = 0
+    GREEN = 1
+
+
+def test_world_profiler():
+    alpha.clear_operation_cache()
+    profiler = alpha.Profiler()
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    world = alpha.QuantumWorld([light1, light2, light3], profiler=profiler)
+    alpha.Split()(light1, light2, light3)
+    alpha.Split()(light2, light1, light3)
+    world.force_measurement(light1, Light.GREEN)
+    world.peek(count=10)
+
+    stats = profiler.to_dict()
+    assert set(stats["timings"]) == {
+        "add_effect",
+        "circuit_copy",
+        "run",
+        "sample",
+        "post_select",
+    }
+    # Flips of the initial value and of the forced measurement, and the splits.
+    assert stats["timings"]["add_effect"]["count"] == 4
+    assert stats["cache"] == {"hits": 2, "misses": 2, "hit_rate": 0.5}
+    assert stats["state_sizes"]["SwapPowGate"]["max"] == 3
+    assert stats["state_sizes"]["PostSelectOperation"]["max"] == 1
+    assert stats["peak_state_size"] == 3
+    assert stats["shots"]["accepted"] == 10
+    assert json.loads(profiler.to_json()) == stats
+
+    profiler.clear()
+    assert profiler.to_dict()["timings"] == {}
+    assert profiler.to_dict()["cache"]["hit_rate"] is None
+
+
+def test_dense_post_selection():
+    profiler = alpha.Profiler()
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    world = alpha.QuantumWorld([light], sampler=cirq.Simulator(), profiler=profiler)
+    alpha.Superposition()(light)
+    world.force_measurement(light, Light.RED)
+    world.peek(count=10)
+    assert profiler.accepted_shots >= 10
+    assert profiler.rejected_shots > 0
+    assert profiler.accepted_shots + profiler.rejected_shots == sum(
+        world._acceptance_stats[1:]
+    )
+    assert profiler.peak_state_size == 0
+
+
+def test_no_profiler():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    world = alpha.QuantumWorld([light])
+    alpha.Flip()(light)
+    assert world.profiler is None
+    assert world.sampler.profiler is None
+    assert world.peek() == [[Light.RED]]
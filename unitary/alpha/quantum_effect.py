@@ -12,20 +12,55 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Iterator, Optional, Sequence, Union, TYPE_CHECKING
+from typing import (
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    TYPE_CHECKING,
+    cast,
+)
 import abc
 import enum
 
 import cirq
 
 if TYPE_CHECKING:
+    from unitary.alpha.profiler import Profiler
     from unitary.alpha.quantum_object import QuantumObject
 
 
+# Maximum number of operation templates kept by `QuantumEffect`.
+_MAX_CACHE_SIZE = 1024
+
+# Maps (effect type, cache key, qid dimensions) to a list of operations
+# acting on placeholder qids `cirq.LineQid(0..n-1)`.
+_CacheKey = Tuple[type, Hashable, Tuple[int, ...]]
+_OPERATION_CACHE: Dict[_CacheKey, List[cirq.Operation]] = {}
+
+
 def _to_int(value: Union[enum.Enum, int]) -> int:
     return value.value if isinstance(value, enum.Enum) else value
 
 
+def clear_operation_cache() -> None:
+    """Removes all cached operation templates of cacheable effects."""
+    _OPERATION_CACHE.clear()
+
+
+class _PlaceholderObject:
+    """Stand-in for a `QuantumObject` used to build operation templates."""
+
+    def __init__(self, qubit: cirq.Qid):
+        self.name = str(qubit)
+        self.qubit = qubit
+        self.num_states = qubit.dimension
+
+
 class QuantumEffect(abc.ABC):
     @abc.abstractmethod
     def effect(self, *objects: "QuantumObject") -> Iterator[cirq.Operation]:
@@ -42,6 +77,19 @@ class QuantumEffect(abc.ABC):
         """
         return None
 
+    def cache_key(self) -> Optional[Hashable]:
+        """Key that determines the operations produced by this effect.
+
+        Effects whose operations only depend on their parameters and on the
+        dimensions of the objects they are applied to can return a hashable
+        key here.  The operations are then generated once per key and object
+        dimensions and re-targeted to the qubits of the objects on every
+        later application.
+
+        If None is returned (the default), `effect()` is called every time.
+        """
+        return None
+
     def _verify_objects(self, *objects: "QuantumObject"):
         if self.num_objects() is not None and len(objects) != self.num_objects():
             raise ValueError(f"Cannot apply effect to {len(objects)} qubits.")
@@ -63,7 +111,48 @@ class QuantumEffect(abc.ABC):
         """Apply the Quantum Effect to the objects."""
         self._verify_objects(*objects)
         world = objects[0].world
-        world.add_effect(list(self.effect(*objects)))
+        world.add_effect(self._operations(*objects, profiler=world.profiler))
+
+    def _template_objects(
+        self, objects: Sequence["QuantumObject"]
+    ) -> Sequence["QuantumObject"]:
+        """All objects whose qubits are acted on by the effect."""
+        return objects
+
+    def _template_effect(
+        self, *objects: "_PlaceholderObject"
+    ) -> Iterator[cirq.Operation]:
+        """Generates operations on the placeholders from `_template_objects`."""
+        return self.effect(*objects)
+
+    def _operations(
+        self, *objects: "QuantumObject", profiler: Optional["Profiler"] = None
+    ) -> List[cirq.Operation]:
+        """Returns the operations of this effect, using the cache if possible.
+
+        Lookups in the cache are recorded in `profiler`, if given.
+        """
+        key = self.cache_key()
+        if key is None:
+            return list(self.effect(*objects))
+        qubits = [obj.qubit for obj in self._template_objects(objects)]
+        cache_key = (type(self), key, tuple(q.dimension for q in qubits))
+        template = _OPERATION_CACHE.get(cache_key)
+        if profiler is not None:
+            profiler.record_cache_lookup(template is not None)
+        if template is None:
+            placeholders = [
+                _PlaceholderObject(cirq.LineQid(idx, dimension=q.dimension))
+                for idx, q in enumerate(qubits)
+            ]
+            template = list(self._template_effect(*placeholders))
+            if len(_OPERATION_CACHE) >= _MAX_CACHE_SIZE:
+                _OPERATION_CACHE.clear()
+            _OPERATION_CACHE[cache_key] = template
+        return [
+            op.with_qubits(*[qubits[cast(cirq.LineQid, q).x] for q in op.qubits])
+            for op in template
+        ]
 
     def __str__(self):
         return self.__class__.__name__
@@ -105,12 +194,12 @@ class QuantumThen(QuantumEffect):
     def equals(
         self, *conditions: Union[enum.Enum, int, Sequence[Union[enum.Enum, int]]]
     ) -> "QuantumThen":
-        """Allows a quantum if condition for qubits to equal certain states.
+        """Allows a quantum if condition for qudits to equal certain states.
 
         Adding an equals after a quantum if can produce an anti-control
-        instead of a control if the condition is set to zero.
+        instead of a control if the condition is set to zero.  For qudits,
+        any of their states can be used as the condition.
         """
-        # TODO: add qutrit support
         if isinstance(conditions, (enum.Enum, int)):
             conditions = [conditions]
         if len(conditions) != len(self.control_objects):
@@ -130,21 +219,40 @@ class QuantumThen(QuantumEffect):
         self.then_effect = effect
         return self
 
+    def cache_key(self) -> Optional[Hashable]:
+        if self.then_effect is None:
+            return None
+        then_key = self.then_effect.cache_key()
+        if then_key is None:
+            return None
+        return (
+            tuple(self.condition),
+            len(self.control_objects),
+            type(self.then_effect),
+            then_key,
+        )
+
+    def _template_objects(
+        self, objects: Sequence["QuantumObject"]
+    ) -> Sequence["QuantumObject"]:
+        return [*self.control_objects, *objects]
+
+    def _template_effect(
+        self, *objects: "_PlaceholderObject"
+    ) -> Iterator[cirq.Operation]:
+        num_controls = len(self.control_objects)
+        return self._controlled_effect(objects[:num_controls], objects[num_controls:])
+
     def effect(self, *objects: "QuantumObject"):
         """A Quantum if/then produces a controlled operation."""
-        # For anti-controls, add an X before the controlled operation
-        for idx, cond in enumerate(self.condition):
-            if cond == 0 and self.control_objects[idx].num_states == 2:
-                yield cirq.X(self.control_objects[idx].qubit)
+        return self._controlled_effect(self.control_objects, objects)
 
+    def _controlled_effect(self, control_objects, objects):
+        # Anti-controls and qudit conditions are expressed directly as
+        # control values of the controlled operation.
+        control_qubits = [q.qubit for q in control_objects]
         for op in self.then_effect.effect(*objects):
-            yield op.controlled_by(*[q.qubit for q in self.control_objects])
-
-        # For anti-controls, add an X after the controlled operation
-        # to revert its state back to what it was.
-        for idx, cond in enumerate(self.condition):
-            if cond == 0 and self.control_objects[idx].num_states == 2:
-                yield cirq.X(self.control_objects[idx].qubit)
+            yield op.controlled_by(*control_qubits, control_values=self.condition)
 
 
 quantum_if = QuantumIf()
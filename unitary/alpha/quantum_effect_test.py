@@ -56,9 +56,7 @@ def test_anti_control(simulator, compile_to_qubits):
 
     # Test that circuit is constructed as expected
     expected_circuit = cirq.Circuit()
-    expected_circuit.append(cirq.X(Q0))
-    expected_circuit.append(cirq.CNOT(Q0, Q1))
-    expected_circuit.append(cirq.X(Q0))
+    expected_circuit.append(cirq.X(Q1).controlled_by(Q0, control_values=[0]))
     assert board.circuit == expected_circuit
 
     # Test that results are as expected
@@ -85,6 +83,19 @@ def test_bad_length(compile_to_qubits):
         alpha.Split()(piece)
 
 
+def test_qutrit_control():
+    # Compiling mixed-dimension operations to qubits is not supported (#77).
+    board = alpha.QuantumWorld(sampler=cirq.Simulator(), compile_to_qubits=False)
+    control = alpha.QuantumObject("c", 2)
+    targets = [alpha.QuantumObject(f"t{idx}", 0) for idx in range(3)]
+    board.add_object(control)
+    for target in targets:
+        board.add_object(target)
+    for state, target in enumerate(targets):
+        alpha.quantum_if(control).equals(state).apply(alpha.Flip())(target)
+    assert board.peek(targets, count=10, convert_to_enum=False) == [[0, 0, 1]] * 10
+
+
 @pytest.mark.parametrize("compile_to_qubits", [False, True])
 def test_no_qutrits(compile_to_qubits):
     board = alpha.QuantumWorld(compile_to_qubits=compile_to_qubits)
@@ -92,3 +103,72 @@ def test_no_qutrits(compile_to_qubits):
     board.add_object(piece)
     with pytest.raises(ValueError, match="Cannot apply effect to qids"):
         alpha.Phase()(piece)
+
+
+class CountingEffect(alpha.QuantumEffect):
+    """Test effect that records how often its operations are generated."""
+
+    def __init__(self, exponent: float = 1.0):
+        self.exponent = exponent
+        self.num_calls = 0
+
+    def effect(self, *objects):
+        self.num_calls += 1
+        yield cirq.CNOT(objects[0].qubit, objects[1].qubit) ** self.exponent
+
+    def cache_key(self):
+        return (self.exponent,)
+
+
+def test_cached_effect():
+    alpha.clear_operation_cache()
+    board = alpha.QuantumWorld(sampler=cirq.Simulator())
+    pieces = [alpha.QuantumObject(f"q{idx}", 0) for idx in range(4)]
+    for piece in pieces:
+        board.add_object(piece)
+    counting_effect = CountingEffect()
+    counting_effect(pieces[0], pieces[1])
+    counting_effect(pieces[2], pieces[3])
+    counting_effect(pieces[3], pieces[0])
+    assert counting_effect.num_calls == 1
+    qubits = [piece.qubit for piece in pieces]
+    assert board.circuit == cirq.Circuit(
+        cirq.CNOT(qubits[0], qubits[1]),
+        cirq.CNOT(qubits[2], qubits[3]),
+        cirq.CNOT(qubits[3], qubits[0]),
+    )
+
+    # A different key generates new operations.
+    CountingEffect(0.5)(pieces[0], pieces[1])
+    assert board.circuit[-1] == cirq.Moment(cirq.CNOT(qubits[0], qubits[1]) ** 0.5)
+
+
+@pytest.mark.parametrize("compile_to_qubits", [False, True])
+def test_cached_quantum_if(compile_to_qubits):
+    alpha.clear_operation_cache()
+    board = alpha.QuantumWorld(
+        sampler=cirq.Simulator(), compile_to_qubits=compile_to_qubits
+    )
+    pieces = [alpha.QuantumObject(f"q{idx}", 0) for idx in range(3)]
+    for piece in pieces:
+        board.add_object(piece)
+    alpha.quantum_if(pieces[0]).equals(0).apply(alpha.Flip())(pieces[1])
+    alpha.quantum_if(pieces[1]).equals(0).apply(alpha.Flip())(pieces[2])
+    q0, q1, q2 = (piece.qubit for piece in pieces)
+    assert board.circuit == cirq.Circuit(
+        cirq.X(q1).controlled_by(q0, control_values=[0]),
+        cirq.X(q2).controlled_by(q1, control_values=[0]),
+    )
+    assert board.peek(count=10, convert_to_enum=False) == [[0, 1, 0]] * 10
+
+
+def test_uncacheable_effect():
+    board = alpha.QuantumWorld(sampler=cirq.Simulator())
+    pieces = [alpha.QuantumObject(f"q{idx}", 0) for idx in range(2)]
+    for piece in pieces:
+        board.add_object(piece)
+    counting_effect = CountingEffect()
+    counting_effect.cache_key = lambda: None
+    counting_effect(pieces[0], pieces[1])
+    counting_effect(pieces[0], pieces[1])
+    assert counting_effect.num_calls == 2
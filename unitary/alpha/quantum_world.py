@@ -12,17 +12,275 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import collections
+import concurrent.futures
 import copy
 import enum
-from typing import cast, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+import functools
+import math
+import time
+from typing import (
+    Any,
+    Callable,
+    cast,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import cirq
+import duet
 import numpy as np
 
+from unitary.alpha.auto_sampler import AutoSampler
+from unitary.alpha.profiler import Profiler
 from unitary.alpha.quantum_object import QuantumObject
 from unitary.alpha.sparse_vector_simulator import PostSelectOperation, SparseSimulator
+from unitary.alpha.qudit_gates import QuditPlusGate
 from unitary.alpha.qudit_state_transform import qudit_to_qubit_unitary, num_bits
 
+# Maximum number of repetitions sampled by a single peek.
+_MAX_PEEK_REPS = 1_000_000
+
+# Number of standard deviations by which peeks over-sample to make up
+# for post-selection (about 99% one-sided confidence).
+_CONFIDENCE_Z = 2.33
+
+# Tolerance for deciding that an operation maps a basis state to a basis state.
+_CLASSICAL_ATOL = 1e-8
+
+# Maximum Hilbert space dimension of operations considered by `compact_circuit`.
+_MAX_COMPACTION_DIMENSION = 64
+
+
+def _is_identity(op: cirq.Operation) -> bool:
+    """Whether the operation is the identity, up to global phase."""
+    if isinstance(op, PostSelectOperation) or cirq.is_parameterized(op):
+        return False
+    if np.prod(cirq.qid_shape(op)) > _MAX_COMPACTION_DIMENSION:
+        return False
+    unitary = cirq.unitary(op, None)
+    if unitary is None:
+        return False
+    return cirq.equal_up_to_global_phase(unitary, np.eye(len(unitary)))
+
+
+def _combine(first: cirq.Operation, second: cirq.Operation) -> Optional[cirq.Operation]:
+    """Combines two operations on the same qids into a single matrix operation.
+
+    Returns None if either operation is not a (non-parameterized) unitary.
+    """
+    if set(first.qubits) != set(second.qubits):
+        return None
+    if cirq.inverse(first, None) == second:
+        return cirq.IdentityGate(qid_shape=cirq.qid_shape(first)).on(*first.qubits)
+    for op in (first, second):
+        if isinstance(op, PostSelectOperation) or cirq.is_parameterized(op):
+            return None
+        if not cirq.has_unitary(op):
+            return None
+    if np.prod(cirq.qid_shape(first)) > _MAX_COMPACTION_DIMENSION:
+        return None
+    unitary = cirq.Circuit(first, second).unitary(
+        qubit_order=first.qubits, qubits_that_should_be_present=first.qubits
+    )
+    return cirq.MatrixGate(unitary, qid_shape=cirq.qid_shape(first)).on(*first.qubits)
+
+
+def _seed_sequence(
+    seed: Union[None, int, np.random.SeedSequence, np.random.Generator],
+) -> Optional[np.random.SeedSequence]:
+    if seed is None or isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return np.random.SeedSequence(seed.integers(0, 2**32, size=4))
+    return np.random.SeedSequence(seed)
+
+
+def _histogram(
+    objects: Sequence[QuantumObject], samples: np.ndarray
+) -> List[Dict[int, int]]:
+    """Counts the results of each object in an array of samples."""
+    return [
+        dict(enumerate(np.bincount(samples[:, idx], minlength=obj.num_states).tolist()))
+        for idx, obj in enumerate(objects)
+    ]
+
+
+def _correlated_histogram(samples: np.ndarray) -> Dict[Tuple[int], int]:
+    """Counts the joint results of all objects in an array of samples."""
+    return dict(collections.Counter(map(tuple, samples.tolist())))
+
+
+def _probabilities(
+    histogram: List[Dict[int, int]], count: int
+) -> List[Dict[int, float]]:
+    return [
+        {state: obj_hist[state] / count for state in range(len(obj_hist))}
+        for obj_hist in histogram
+    ]
+
+
+class QueryType(enum.Enum):
+    """Kinds of statistics that can be requested from `QuantumWorld.query`.
+
+    Each kind returns the same result as the `QuantumWorld` method of the
+    same name (`peek`, `get_histogram`, and so on).
+    """
+
+    PEEK = "peek"
+    HISTOGRAM = "histogram"
+    CORRELATED_HISTOGRAM = "correlated_histogram"
+    PROBABILITIES = "probabilities"
+    BINARY_PROBABILITIES = "binary_probabilities"
+
+
+class Query:
+    """A request for measurement statistics of some objects.
+
+    Args:
+        kind: The kind of statistic, as a `QueryType` or its value.
+        objects: Objects (or their names) to measure.  Defaults to all
+            public objects of the world.
+        count: Number of measurements.  Defaults to 1 for peeks and to 100
+            for the other kinds, like the corresponding methods.
+        convert_to_enum: Whether peek results are converted to the enum
+            type of the objects.
+    """
+
+    def __init__(
+        self,
+        kind: Union[QueryType, str],
+        objects: Optional[Sequence[Union[QuantumObject, str]]] = None,
+        count: Optional[int] = None,
+        convert_to_enum: bool = True,
+    ):
+        self.kind = QueryType(kind)
+        self.objects = objects
+        if count is None:
+            count = 1 if self.kind == QueryType.PEEK else 100
+        self.count = count
+        self.convert_to_enum = convert_to_enum
+
+
+def _post_selection_possible(
+    ops: Sequence[cirq.Operation], qids: Sequence[cirq.Qid], value: int
+) -> bool:
+    """Whether the operations give a nonzero amplitude to `value` on the qids.
+
+    Returns False if the operations are not all unitary.
+    """
+    if any(isinstance(op, PostSelectOperation) for op in ops):
+        return False
+    if any(cirq.is_parameterized(op) or not cirq.has_unitary(op) for op in ops):
+        return False
+    state = cirq.final_state_vector(
+        cirq.Circuit(ops), qubit_order=qids, dtype=np.complex128
+    )
+    return abs(state[value]) ** 2 > _CLASSICAL_ATOL
+
+
+def _concatenate_samples(batches: Sequence[np.ndarray], num_objects: int) -> np.ndarray:
+    if not batches:
+        return np.zeros((0, num_objects), dtype=np.int64)
+    return np.concatenate(batches)
+
+
+def _reseeded(sampler: cirq.Sampler) -> cirq.Sampler:
+    """Returns a copy of the sampler seeded from its random state.
+
+    Samplers sent to worker processes are pickled with their random state,
+    so they would all draw the same samples.  The random state of the
+    sampler advances, so later copies get different seeds.  Samplers
+    without a random state are returned as is.
+    """
+    prng = getattr(sampler, "_prng", None)
+    if prng is not None:
+        copied = copy.copy(sampler)
+        copied._prng = np.random.RandomState(prng.randint(2**32))
+        return copied
+    samplers = getattr(sampler, "samplers", None)
+    if isinstance(samplers, dict):
+        copied = copy.copy(sampler)
+        copied.samplers = {key: _reseeded(value) for key, value in samplers.items()}
+        return copied
+    return sampler
+
+
+class _SampleCollector:
+    """Collects samples of objects of a world that pass post-selection.
+
+    Deciding how many repetitions to sample is separated from running the
+    sampler, so that the same logic drives synchronous, asynchronous and
+    batched sampling:
+
+        while not collector.done:
+            num_reps = collector.num_reps()
+            results = sampler.run(collector.circuit, repetitions=num_reps)
+            batch = collector.add_results(results, num_reps)
+
+    `circuit` is None if nothing needs to be measured, in which case
+    `add_results` should be called with None.
+    """
+
+    def __init__(
+        self,
+        world: "QuantumWorld",
+        quantum_objects: Sequence[QuantumObject],
+        count: Optional[int],
+        batch_size: Optional[int] = None,
+    ):
+        self.world = world
+        self.quantum_objects = quantum_objects
+        self.count = count
+        self.batch_size = batch_size
+        self.circuit = world._measurement_circuit(quantum_objects)
+        self.num_found = 0
+        self.num_rejected = 0
+
+    @property
+    def done(self) -> bool:
+        return self.count is not None and self.num_found >= self.count
+
+    def num_reps(self) -> int:
+        """Number of repetitions to sample for the next batch."""
+        wanted = self.batch_size
+        if self.count is not None:
+            missing = self.count - self.num_found
+            if wanted is None or wanted > missing:
+                wanted = missing
+        return min(self.world._suggest_num_reps(wanted), _MAX_PEEK_REPS)
+
+    def add_results(self, results: Optional[cirq.Result], num_reps: int) -> np.ndarray:
+        """Post-selects sampled results and returns the accepted samples.
+
+        Returns:
+            A possibly empty array with one row for each accepted repetition
+            (up to the number of samples still missing) and one column for
+            each object.
+        """
+        batch = self.world._post_select(self.quantum_objects, results, num_reps)
+        if self.count is not None:
+            batch = batch[: self.count - self.num_found]
+        if len(batch) == 0:
+            self.num_rejected += num_reps
+            if self.num_rejected >= _MAX_PEEK_REPS:
+                raise RecursionError(
+                    f"{self.num_rejected} repetitions sampled without sufficient "
+                    "results. Likely post-selection error"
+                )
+        else:
+            self.num_rejected = 0
+            self.num_found += len(batch)
+        return batch
+
 
 class QuantumWorld:
     """A collection of `QuantumObject`s with effects.
@@ -41,23 +299,74 @@ class QuantumWorld:
     defaults to a noiseless simulator optimized for sparse state vectors.
     You may also use e.g. cirq.Simulator, a noiseless simulator using
     dense state vectors, which natively supports qudits unlike the sparse
-    simulator.
+    simulator.  With the sampler "auto", an `AutoSampler` chooses the
+    simulator for every circuit that is run.
+
+    Samplers with a true `supports_post_selection` attribute (such as
+    `SparseSimulator` and `AutoSampler`) get `PostSelectOperation`s for
+    forced measurements in the circuit.  For other samplers, repetitions
+    are only post-selected after they are sampled.
+
+    The `seed` option seeds the default sampler, so that peeks and pops
+    are reproducible.  It can be an int, a `np.random.SeedSequence` or a
+    `np.random.Generator` (from which a seed is drawn).  Copies of a seeded
+    world get their own independent random streams, spawned from the seed
+    in the order in which the copies are made.
 
     Setting the `compile_to_qubits` option results in an internal state
     representation of ancilla qubits for every qudit in the world. That
     also results in the effects being applied to the corresponding qubits
     instead of the original qudits.
+
+    Setting the `compact_every` option compacts the circuit (see
+    `compact_circuit`) after that many effects have been added.
+
+    Setting the `track_classical` option keeps objects that are in a
+    definite basis state out of the circuit.  Their values are tracked
+    classically in `classical_values` and effects that map basis states
+    to basis states (such as `Flip` or `Cycle`) only update these values.
+    An object is added to the circuit once an effect puts it into
+    superposition or entangles it with objects that are already there.
+
+    Setting the `auto_reset` option calls `reset_if_classical` after
+    every `pop`, so that the circuit does not keep growing once all
+    objects have been measured.
+
+    The `profiler` option records timings and counters of adding effects
+    and sampling (see `Profiler`).  It is also passed to the default
+    sampler; a given `SparseSimulator` needs its own `profiler` argument
+    to record the sizes of the sparse state.
     """
 
     def __init__(
         self,
         objects: Optional[List[QuantumObject]] = None,
-        sampler: cirq.Sampler = SparseSimulator(),
+        sampler: Union[None, str, cirq.Sampler] = None,
         compile_to_qubits: Optional[bool] = None,
+        compact_every: Optional[int] = None,
+        track_classical: bool = False,
+        auto_reset: bool = False,
+        seed: Union[None, int, np.random.SeedSequence, np.random.Generator] = None,
+        profiler: Optional[Profiler] = None,
     ):
         self.clear()
+        self.seed_sequence = _seed_sequence(seed)
+        self.profiler = profiler
+        if sampler is None:
+            sampler = SparseSimulator(seed=self.seed_sequence, profiler=profiler)
+        elif isinstance(sampler, str):
+            if sampler != "auto":
+                raise ValueError(f"Unknown sampler {sampler!r}.")
+            sampler = AutoSampler(seed=self.seed_sequence, profiler=profiler)
+        elif seed is not None:
+            raise ValueError(
+                "Cannot use a seed with a given sampler; seed the sampler."
+            )
         self.sampler = sampler
-        self.use_sparse = isinstance(sampler, SparseSimulator)
+        self.compact_every = compact_every
+        self.track_classical = track_classical
+        self.auto_reset = auto_reset
+        self.use_sparse = getattr(sampler, "supports_post_selection", False)
         if compile_to_qubits is None:
             compile_to_qubits = self.use_sparse
         self.compile_to_qubits = compile_to_qubits
@@ -68,13 +377,25 @@ class QuantumWorld:
             for obj in objects:
                 self.add_object(obj)
 
+    @property
+    def circuit(self) -> cirq.Circuit:
+        return self._circuit
+
+    @circuit.setter
+    def circuit(self, circuit: cirq.Circuit) -> None:
+        self._circuit = circuit
+        # Accepted and total repetitions of peeks of the current circuit.
+        self._acceptance_stats = [0, 0]
+
     def clear(self) -> None:
         """Removes all objects and effects from this QuantumWorld.
 
         This will reset the QuantumWorld to an empty state.
         """
         self.circuit = cirq.Circuit()
-        self.effect_history: List[Tuple[cirq.Circuit, Dict[QuantumObject, int]]] = []
+        self.effect_history: List[
+            Tuple[cirq.Circuit, Dict[QuantumObject, int], Dict[cirq.Qid, int]]
+        ] = []
         # This variable is used to save the length of current effect history
         # before each move is made, so that if we later undo we know
         # how many effects we need to pop out, since each move could
@@ -82,10 +403,21 @@ class QuantumWorld:
         self.effect_history_length: List[int] = []
         self.object_name_dict: Dict[str, QuantumObject] = {}
         self.ancilla_names: Set[str] = set()
+        # Next index to try for the name of an ancilla in each namespace.
+        self.ancilla_counts: Dict[str, int] = {}
         # When `compile_to_qubits` is True, this tracks the mapping of the
         # original qudits to the compiled qubits.
         self.compiled_qubits: Dict[cirq.Qid, List[cirq.Qid]] = {}
+        # Ancillas removed by resets, with their compiled qubits and the
+        # length of the effect history at the reset, so that undoing the
+        # reset restores them.
+        self.dropped_ancillas: List[
+            Tuple[int, List[QuantumObject], Dict[cirq.Qid, List[cirq.Qid]]]
+        ] = []
         self.post_selection: Dict[QuantumObject, int] = {}
+        # When `track_classical` is True, this holds the values of the qids
+        # of objects that are in a basis state and not part of the circuit.
+        self.classical_values: Dict[cirq.Qid, int] = {}
         # This variable is used to save the qubit remapping dictionary
         # before each move, so that if we later undo we know how to reverse the mapping.
         self.qubit_remapping_dict: List[Dict[cirq.Qid, cirq.Qid]] = []
@@ -93,6 +425,7 @@ class QuantumWorld:
         # before each move is made,
         # so that if we later undo we know how to remap the qubits.
         self.qubit_remapping_dict_length: List[int] = []
+        self.effects_since_compaction = 0
 
     def copy(self) -> "QuantumWorld":
         new_objects = []
@@ -102,18 +435,44 @@ class QuantumWorld:
             new_objects.append(new_obj)
             if obj in self.post_selection:
                 new_post_selection[new_obj] = self.post_selection[obj]
+        if self.seed_sequence is None:
+            sampler_kwargs = {"sampler": self.sampler}
+        else:
+            sampler_kwargs = {
+                "sampler": "auto" if isinstance(self.sampler, AutoSampler) else None,
+                "seed": self.seed_sequence.spawn(1)[0],
+            }
         new_world = self.__class__(
             objects=new_objects,
-            sampler=self.sampler,
+            **sampler_kwargs,
             compile_to_qubits=self.compile_to_qubits,
+            compact_every=self.compact_every,
+            track_classical=self.track_classical,
+            auto_reset=self.auto_reset,
+            profiler=self.profiler,
         )
         new_world.circuit = self.circuit.copy()
+        new_world.classical_values = self.classical_values.copy()
         new_world.ancilla_names = self.ancilla_names.copy()
+        new_world.ancilla_counts = self.ancilla_counts.copy()
         new_world.effect_history = [
-            (circuit.copy(), copy.copy(post_selection))
-            for circuit, post_selection in self.effect_history
+            (circuit.copy(), copy.copy(post_selection), classical_values.copy())
+            for circuit, post_selection, classical_values in self.effect_history
         ]
         new_world.effect_history_length = self.effect_history_length.copy()
+        for history_length, ancillas, compiled_qubits in self.dropped_ancillas:
+            new_ancillas = []
+            for obj in ancillas:
+                new_obj = copy.copy(obj)
+                new_obj.world = new_world
+                new_ancillas.append(new_obj)
+            new_world.dropped_ancillas.append(
+                (
+                    history_length,
+                    new_ancillas,
+                    {qid: list(qubits) for qid, qubits in compiled_qubits.items()},
+                )
+            )
         new_world.post_selection = new_post_selection
         # copy qubit_remapping_dict
         for remap in self.qubit_remapping_dict:
@@ -146,6 +505,10 @@ class QuantumWorld:
                 for _ in range(num_bits(qudit_dim)):
                     new_obj = self._add_ancilla(obj.qubit.name)
                     self.compiled_qubits[obj.qubit].append(new_obj.qubit)
+                    # Compiled qubits are only ever acted on through `obj`.
+                    self.classical_values.pop(new_obj.qubit, None)
+        if self.track_classical:
+            self.classical_values[obj.qubit] = 0
         obj.initial_effect()
 
     @property
@@ -188,9 +551,11 @@ class QuantumWorld:
         self.ancilla_names.update(other_world.ancilla_names)
         self.compiled_qubits.update(other_world.compiled_qubits)
         self.post_selection.update(other_world.post_selection)
+        self.classical_values.update(other_world.classical_values)
         self.circuit = self.circuit.zip(other_world.circuit)
         # Clear effect history, since undoing would undo the combined worlds
         self.effect_history.clear()
+        self.dropped_ancillas.clear()
         # Clear the other world so that objects cannot be used from that world.
         other_world.clear()
 
@@ -206,11 +571,12 @@ class QuantumWorld:
         Returns:
             The added ancilla object.
         """
-        count = 0
+        count = self.ancilla_counts.get(namespace, 0)
         ancilla_name = f"ancilla_{namespace}_{count}"
         while ancilla_name in self.object_name_dict:
             count += 1
             ancilla_name = f"ancilla_{namespace}_{count}"
+        self.ancilla_counts[namespace] = count + 1
         new_obj = QuantumObject(ancilla_name, value)
         self.add_object(new_obj)
         self.ancilla_names.add(ancilla_name)
@@ -220,8 +586,16 @@ class QuantumWorld:
         """Add the operation in a way designed to speed execution.
 
         For the sparse simulator post-selections should be as early as possible to cut
-        down the state size. Also X's since they don't increase the size.
+        down the state size (see `_insert_post_selection`). Also X's since they don't
+        increase the size.
         """
+        if self.use_sparse and isinstance(op, PostSelectOperation):
+            if self.compile_to_qubits:
+                op = self._compile_op(op)
+            for post_selection in cirq.flatten_to_ops(op):
+                self._insert_post_selection(post_selection)
+            self._acceptance_stats = [0, 0]
+            return
 
         if (
             not self.use_sparse
@@ -236,6 +610,44 @@ class QuantumWorld:
             op = self._compile_op(op)
 
         self.circuit.append(op, strategy=strategy)
+        self._acceptance_stats = [0, 0]
+
+    def _insert_post_selection(self, op: PostSelectOperation) -> None:
+        """Inserts a post-selection as early as possible in the circuit.
+
+        Rather than only after the last operation on its qubit, the
+        post-selection goes before the last operations on its qubit that
+        commute with it: other post-selections and operations that are
+        diagonal on the qubit, such as phases or controls on it.  It also
+        goes before `cirq.X`s on the qubit, with the opposite value.  It is
+        then placed in the earliest moment after the remaining operations on
+        the qubit.
+        """
+        qubit, value = op.qubit, op.value
+        if qubit.dimension != 2:
+            self.circuit.append(op, strategy=cirq.InsertStrategy.EARLIEST)
+            return
+        # Index of the first moment that the post-selection has to precede.
+        first = len(self.circuit)
+        for idx in reversed(range(len(self.circuit))):
+            moment_op = self.circuit[idx].operation_at(qubit)
+            if moment_op is None:
+                continue
+            if moment_op.gate == cirq.X:
+                value = 1 - value
+            elif not isinstance(moment_op, PostSelectOperation) and not cirq.commutes(
+                moment_op, cirq.Z(qubit), default=False
+            ):
+                break
+            first = idx
+        else:
+            idx = -1
+        op = PostSelectOperation(qubit, value)
+        if idx + 1 < first:
+            # The moments between idx and first do not act on the qubit.
+            self.circuit[idx + 1] = self.circuit[idx + 1].with_operation(op)
+        else:
+            self.circuit.insert(first, cirq.Moment(op))
 
     def _compile_op(self, op: cirq.Operation) -> Union[cirq.Operation, cirq.OP_TREE]:
         """Compiles the operation down to qubits, if needed."""
@@ -276,13 +688,138 @@ class QuantumWorld:
             matrix=compiled_unitary, qid_shape=(2,) * len(compiled_qubits)
         ).on(*compiled_qubits)
 
-    def add_effect(self, op_list: List[cirq.Operation]):
-        """Adds an operation to the current circuit."""
+    def _save_effect_history(self) -> None:
         self.effect_history.append(
-            (self.circuit.copy(), copy.copy(self.post_selection))
+            (
+                self.circuit.copy(),
+                copy.copy(self.post_selection),
+                self.classical_values.copy(),
+            )
+        )
+
+    def _apply_classically(self, op: cirq.Operation) -> bool:
+        """Applies the operation to classically tracked qids, if possible.
+
+        Returns:
+            True if all qids of the operation are tracked classically and
+            the operation maps their basis state to another basis state.
+            The tracked values are updated in that case.  Otherwise, the
+            values are left unchanged and False is returned.
+        """
+        values = [self.classical_values.get(q) for q in op.qubits]
+        if not values or None in values:
+            return False
+        if op.gate is cirq.X:
+            self.classical_values[op.qubits[0]] ^= 1
+            return True
+        if isinstance(op, PostSelectOperation) or cirq.is_parameterized(op):
+            return False
+        unitary = cirq.unitary(op, None)
+        if unitary is None:
+            return False
+        qid_shape = cirq.qid_shape(op)
+        column = unitary[:, cirq.big_endian_digits_to_int(values, base=qid_shape)]
+        (nonzero,) = np.nonzero(abs(column) > _CLASSICAL_ATOL)
+        if len(nonzero) != 1:
+            return False
+        new_values = cirq.big_endian_int_to_digits(int(nonzero[0]), base=qid_shape)
+        for qid, value in zip(op.qubits, new_values):
+            self.classical_values[qid] = value
+        return True
+
+    def _materialize(self, qid: cirq.Qid) -> None:
+        """Moves a classically tracked qid into the circuit."""
+        value = self.classical_values.pop(qid, None)
+        if not value:
+            return
+        if qid.dimension == 2:
+            self._append_op(cirq.X(qid))
+        else:
+            self._append_op(QuditPlusGate(dimension=qid.dimension, addend=value)(qid))
+
+    def _remap_qubits(self, qubit_remapping_dict: Dict[cirq.Qid, cirq.Qid]) -> None:
+        """Swaps qids in the circuit and in the classically tracked values."""
+        self.circuit = self.circuit.transform_qubits(
+            lambda q: qubit_remapping_dict.get(q, q)
         )
+        if self.classical_values:
+            self.classical_values = {
+                qubit_remapping_dict.get(q, q): value
+                for q, value in self.classical_values.items()
+            }
+
+    def add_effect(self, op_list: List[cirq.Operation]):
+        """Adds an operation to the current circuit."""
+        if self.profiler is not None:
+            t0 = time.perf_counter()
+        self._save_effect_history()
         for op in op_list:
+            if self.classical_values:
+                if self._apply_classically(op):
+                    continue
+                for qid in op.qubits:
+                    self._materialize(qid)
             self._append_op(op)
+        self.effects_since_compaction += 1
+        if self.compact_every and self.effects_since_compaction >= self.compact_every:
+            self.compact_circuit()
+        if self.profiler is not None:
+            self.profiler.record_time("add_effect", t0)
+
+    def compact_circuit(self) -> int:
+        """Simplifies the circuit without changing the state it prepares.
+
+        The following rewrites are done, in order of the operations:
+         - operations that are the identity (up to global phase) are dropped,
+         - adjacent operations on the same objects that cancel are dropped,
+         - adjacent single-object operations are merged into one, unless
+           they are both Clifford,
+         - the remaining operations are re-packed into as few moments
+           as possible.
+
+        Post-selections are never merged or moved past operations on the
+        same objects.  The effect history is not modified, so undoing
+        effects still works as before.
+
+        Returns:
+            The number of operations removed from the circuit.
+        """
+        kept: List[Optional[cirq.Operation]] = []
+        # For every qid, the indices into `kept` of the operations on it.
+        qid_history: Dict[cirq.Qid, List[int]] = {}
+        num_ops = 0
+        for op in self.circuit.all_operations():
+            num_ops += 1
+            if _is_identity(op):
+                continue
+            previous = [(qid_history.get(q) or [None])[-1] for q in op.qubits]
+            prev_idx = previous[0]
+            if prev_idx is not None and all(idx == prev_idx for idx in previous):
+                combined = _combine(cast(cirq.Operation, kept[prev_idx]), op)
+                if combined is not None and _is_identity(combined):
+                    kept[prev_idx] = None
+                    for q in op.qubits:
+                        qid_history[q].pop()
+                    continue
+                # Clifford operations are not merged into matrices, so that
+                # Clifford circuits can still use the stabilizer simulator.
+                if (
+                    combined is not None
+                    and len(op.qubits) == 1
+                    and not (
+                        cirq.has_stabilizer_effect(kept[prev_idx])
+                        and cirq.has_stabilizer_effect(op)
+                    )
+                ):
+                    kept[prev_idx] = combined
+                    continue
+            for q in op.qubits:
+                qid_history.setdefault(q, []).append(len(kept))
+            kept.append(op)
+        compacted_ops = [op for op in kept if op is not None]
+        self.circuit = cirq.Circuit(compacted_ops)
+        self.effects_since_compaction = 0
+        return num_ops - len(compacted_ops)
 
     def undo_last_effect(self):
         """Restores the circuit and post selection dictionary of `QuantumWorld` to the
@@ -296,7 +833,19 @@ class QuantumWorld:
         """
         if not self.effect_history:
             raise IndexError("No effects to undo")
-        self.circuit, self.post_selection = self.effect_history.pop()
+        (
+            self.circuit,
+            self.post_selection,
+            self.classical_values,
+        ) = self.effect_history.pop()
+        while self.dropped_ancillas and self.dropped_ancillas[-1][0] > len(
+            self.effect_history
+        ):
+            _, ancillas, compiled_qubits = self.dropped_ancillas.pop()
+            for obj in ancillas:
+                self.object_name_dict[obj.name] = obj
+                self.ancilla_names.add(obj.name)
+            self.compiled_qubits.update(compiled_qubits)
 
     def save_snapshot(self) -> None:
         """Saves the current length of the effect history and qubit_remapping_dict.
@@ -333,9 +882,7 @@ class QuantumWorld:
             if len(qubit_remapping_dict) == 0:
                 continue
             # Reverse the mapping.
-            self.circuit = self.circuit.transform_qubits(
-                lambda q: qubit_remapping_dict.get(q, q)
-            )
+            self._remap_qubits(qubit_remapping_dict)
             # Clear relevant qubits from the post selection dictionary.
             # TODO(): rethink if this is necessary, given that undo_last_effect()
             # will also restore post selection dictionary.
@@ -350,43 +897,280 @@ class QuantumWorld:
         while len(self.effect_history) > last_length:
             self.undo_last_effect()
 
+    def _definite_values(self) -> Optional[Dict[QuantumObject, int]]:
+        """Returns the values of all public objects if they are all definite.
+
+        Objects tracked classically are definite by construction.  The other
+        objects are checked exactly on the final state of the circuit, if the
+        sampler has a `simulate_state` method returning a state with a
+        `definite_value` method (such as `SparseSimulator`, `MPSSimulator`,
+        `StabilizerSimulator` and `AutoSampler`, which returns no state for
+        some circuits).  Otherwise, None is returned as soon as any public
+        object is not tracked classically.
+        """
+        values: Dict[QuantumObject, int] = {}
+        quantum_objects = []
+        for obj in self.public_objects:
+            if obj.qubit in self.classical_values:
+                values[obj] = self.classical_values[obj.qubit]
+            else:
+                quantum_objects.append(obj)
+        if not quantum_objects:
+            return values
+        simulate_state = getattr(self.sampler, "simulate_state", None)
+        if simulate_state is None:
+            return None
+        circuit = self.circuit
+        if self.post_selection and not self.use_sparse:
+            circuit = circuit.copy()
+            for obj, value in self.post_selection.items():
+                op = PostSelectOperation(obj.qubit, value)
+                circuit.append(self._compile_op(op) if self.compile_to_qubits else op)
+        state = simulate_state(circuit)
+        definite_value = getattr(state, "definite_value", None)
+        if definite_value is None:
+            return None
+        for obj in quantum_objects:
+            compiled = self.compiled_qubits.get(obj.qubit, [obj.qubit])
+            if compiled == [obj.qubit]:
+                # The value of a qid that is not compiled, which may be a qudit.
+                value = definite_value(obj.qubit)
+                if value is None:
+                    return None
+                values[obj] = value
+                continue
+            bits = []
+            for qubit in compiled:
+                bit = definite_value(qubit)
+                if bit is None:
+                    return None
+                bits.append(bit)
+            values[obj] = cirq.big_endian_bits_to_int(bits)
+        return values
+
+    def _reset_to_values(self, values: Dict[QuantumObject, int]) -> None:
+        """Replaces the circuit by one preparing the given basis state.
+
+        Ancillas other than the compiled qubits of public objects are no
+        longer used, so they are removed from the world until the reset is
+        undone.
+        """
+        self.circuit = cirq.Circuit()
+        self.post_selection = {}
+        used_qubits = {
+            q for obj in values for q in self.compiled_qubits.get(obj.qubit, [])
+        }
+        ancillas = [
+            self.object_name_dict[name]
+            for name in self.ancilla_names
+            if self.object_name_dict[name].qubit not in used_qubits
+        ]
+        if ancillas:
+            compiled_qubits = {}
+            for obj in ancillas:
+                del self.object_name_dict[obj.name]
+                self.ancilla_names.remove(obj.name)
+                if obj.qubit in self.compiled_qubits:
+                    compiled_qubits[obj.qubit] = self.compiled_qubits.pop(obj.qubit)
+            self.dropped_ancillas.append(
+                (len(self.effect_history), ancillas, compiled_qubits)
+            )
+        self.classical_values = {obj.qubit: value for obj, value in values.items()}
+        if not self.track_classical:
+            for obj in values:
+                self._materialize(obj.qubit)
+
+    def reset_if_classical(self) -> bool:
+        """Rebuilds the circuit if all public objects are in a basis state.
+
+        Once every object has a definite value, for instance after all of
+        them were popped, the operations and ancillas that led to this
+        state are no longer needed.  They are replaced by a minimal
+        circuit preparing the basis state (or by classically tracked
+        values if `track_classical` is set).
+
+        This counts as an effect, so `undo_last_effect` restores the
+        previous circuit.
+
+        Returns:
+            Whether the world was reset.
+        """
+        values = self._definite_values()
+        if values is None:
+            return False
+        self._save_effect_history()
+        self._reset_to_values(values)
+        return True
+
+    def collect_ancillas(self) -> int:
+        """Removes post-selected ancillas that no longer affect the results.
+
+        Every `pop` moves the measured objects to new ancillas which are
+        then post-selected in every later peek.  This pass removes them:
+         - Ancillas that were only acted on by themselves are not entangled
+           with anything else.  Their post-selection only changes the
+           acceptance rate, so their operations are removed from the circuit.
+           (Ancillas whose post-selected value is impossible are kept, so
+           that peeks still fail.)
+         - With the sparse simulator, ancillas whose post-selection is the
+           last operation on them are already enforced by the circuit, so
+           they no longer need to be measured by peeks.
+
+        Collected ancillas are removed from `post_selection`.  The effect
+        history is not modified, so undoing effects still works as before.
+
+        Returns:
+            The number of ancillas collected.
+        """
+        ops_by_qid: Dict[cirq.Qid, List[Tuple[int, cirq.Operation]]] = {}
+        for moment_idx, moment in enumerate(self.circuit):
+            for op in moment:
+                for q in op.qubits:
+                    ops_by_qid.setdefault(q, []).append((moment_idx, op))
+        removed_ops: List[Tuple[int, cirq.Operation]] = []
+        num_collected = 0
+        for obj, value in list(self.post_selection.items()):
+            qids = self.compiled_qubits.get(obj.qubit, [obj.qubit])
+            indexed_ops = sorted(
+                {
+                    (moment_idx, id(op)): (moment_idx, op)
+                    for q in qids
+                    for moment_idx, op in ops_by_qid.get(q, [])
+                }.values(),
+                key=lambda indexed_op: indexed_op[0],
+            )
+            ops = [op for _, op in indexed_ops]
+            num_post_selections = 0
+            while num_post_selections < len(ops) and isinstance(
+                ops[-1 - num_post_selections], PostSelectOperation
+            ):
+                num_post_selections += 1
+            unitary_ops = ops[: len(ops) - num_post_selections]
+            if all(
+                set(op.qubits).issubset(qids) for op in ops
+            ) and _post_selection_possible(unitary_ops, qids, value):
+                removed_ops.extend(indexed_ops)
+            elif not (self.use_sparse and num_post_selections):
+                continue
+            del self.post_selection[obj]
+            num_collected += 1
+        if removed_ops:
+            self.circuit.batch_remove(removed_ops)
+        self._acceptance_stats = [0, 0]
+        return num_collected
+
     def _suggest_num_reps(self, sample_size: int) -> int:
         """Guess the number of raw samples needed to get sample_size results.
-        Assume that each post-selection is about 50/50.
+
+        The acceptance rate of the post-selections is estimated from earlier
+        peeks of the current circuit.  Before there are any, each
+        post-selection is assumed to be about 50/50.  The suggested number
+        yields at least `sample_size` accepted results with high confidence.
         Noise and error mitigation will discard reps, so increase the total
         number of repetitions to compensate.
         """
         if self.use_sparse:
             return sample_size
-        if len(self.post_selection) >= 1:
-            sample_size <<= len(self.post_selection) + 1
+        if self.post_selection:
+            accepted, total = self._acceptance_stats
+            if total:
+                rate = max(accepted, 1) / total
+            else:
+                rate = 2.0 ** -(len(self.post_selection) + 1)
+            # Smallest n with n * rate - z * sqrt(n * rate * (1 - rate)) >= size.
+            spread = _CONFIDENCE_Z * math.sqrt(rate * (1 - rate))
+            sqrt_reps = (spread + math.sqrt(spread**2 + 4 * rate * sample_size)) / (
+                2 * rate
+            )
+            sample_size = math.ceil(sqrt_reps**2)
         if sample_size < 100:
             sample_size = 100
         return sample_size
 
-    def _interpret_result(self, result: Union[int, Iterable[int]]) -> int:
-        """Canonicalize an entry from the measurement results array to int.
-
-        When `compile_to_qubit` is set, the results are expected to be a
-        sequence of bits that are the binary representation of the measurement
-        of the original key. Returns the `int` represented by the bits.
+    def _measured_values(self, results: cirq.Result, obj: QuantumObject) -> np.ndarray:
+        """Returns the measurement results of an object as an array of ints.
 
-        If the input is a single-element Iterable, returns the first element.
+        When `compile_to_qubit` is set, the results of each repetition are the
+        bits of the binary representation of the measurement of the object.
         """
+        bits = results.measurements[obj.name]
         if self.compile_to_qubits:
             # For a compiled qudit, the results will be a bit array
             # representing an integer outcome.
-            return cirq.big_endian_bits_to_int(result)
-        if isinstance(result, Iterable):
-            # If it is a single-element iterable, return the first element.
-            result_list = list(result)
-            if len(result_list) != 1:
-                raise ValueError(
-                    f"Cannot interpret a multivalued iterable {result} as a "
-                    "single result for a non-compiled world."
+            return bits.astype(np.int64) @ (1 << np.arange(bits.shape[1])[::-1])
+        if bits.shape[1] != 1:
+            raise ValueError(
+                f"Cannot interpret multivalued results for {obj.name} as a "
+                "single result for a non-compiled world."
+            )
+        return bits[:, 0].astype(np.int64)
+
+    def _measurement_circuit(
+        self, quantum_objects: Sequence[QuantumObject]
+    ) -> Optional[cirq.Circuit]:
+        """The circuit measuring the objects and the post-selected ancillas.
+
+        Returns None if nothing needs to be measured.
+        """
+        measure_set = set(
+            obj for obj in quantum_objects if obj.qubit not in self.classical_values
+        )
+        measure_set.update(self.post_selection.keys())
+        if not measure_set:
+            return None
+        if self.profiler is not None:
+            t0 = time.perf_counter()
+        measure_circuit = self.circuit.copy()
+        measure_circuit.append(
+            [
+                cirq.measure(
+                    self.compiled_qubits.get(p.qubit, p.qubit), key=p.qubit.name
                 )
-            return result_list[0]
-        return result
+                for p in measure_set
+            ]
+        )
+        if self.profiler is not None:
+            self.profiler.record_time("circuit_copy", t0)
+        return measure_circuit
+
+    def _post_select(
+        self,
+        quantum_objects: Sequence[QuantumObject],
+        results: Optional[cirq.Result],
+        num_reps: int,
+    ) -> np.ndarray:
+        """Returns the results of the repetitions that pass post-selection.
+
+        Returns:
+            An array with one row for each accepted repetition and one column
+            for each of the objects.
+        """
+        if self.profiler is not None:
+            t0 = time.perf_counter()
+        accepted = np.ones(num_reps, dtype=bool)
+        for obj, value in self.post_selection.items():
+            accepted &= self._measured_values(results, obj) == value
+        num_accepted = int(np.count_nonzero(accepted))
+        if self.post_selection:
+            self._acceptance_stats[0] += num_accepted
+            self._acceptance_stats[1] += num_reps
+        columns = [
+            (
+                np.full(num_accepted, self.classical_values[obj.qubit], dtype=np.int64)
+                if obj.qubit in self.classical_values
+                else self._measured_values(results, obj)[accepted]
+            )
+            for obj in quantum_objects
+        ]
+        if self.profiler is not None:
+            self.profiler.record_shots(num_accepted, num_reps - num_accepted)
+        if not columns:
+            samples = np.zeros((num_accepted, 0), dtype=np.int64)
+        else:
+            samples = np.stack(columns, axis=1)
+        if self.profiler is not None:
+            self.profiler.record_time("post_select", t0)
+        return samples
 
     def unhook(self, obj: QuantumObject) -> None:
         """Replace all usages of the given object in the circuit with a new ancilla,
@@ -405,9 +1189,7 @@ class QuantumWorld:
             new_ancilla.qubit: obj.qubit,
         }
         self.qubit_remapping_dict.append(qubit_remapping_dict)
-        self.circuit = self.circuit.transform_qubits(
-            lambda q: qubit_remapping_dict.get(q, q)
-        )
+        self._remap_qubits(qubit_remapping_dict)
         return
 
     def force_measurement(
@@ -419,7 +1201,15 @@ class QuantumWorld:
         a post-selection criteria on it in order to force it
         to be a particular result.  A new qubit set to the initial
         state of the result.
+
+        If the object is tracked classically and already has the result
+        as its value, nothing needs to be done.
         """
+        post_selection = result.value if isinstance(result, enum.Enum) else result
+        if obj.qubit in self.classical_values:
+            if self.classical_values[obj.qubit] == post_selection:
+                return
+            self._materialize(obj.qubit)
         new_obj = self._add_ancilla(namespace=obj.name, value=result)
         # Swap the input and ancilla qubits using a remapping dict.
         qubit_remapping_dict = {obj.qubit: new_obj.qubit, new_obj.qubit: obj.qubit}
@@ -431,21 +1221,118 @@ class QuantumWorld:
                 {*zip(obj_qubits, new_obj_qubits), *zip(new_obj_qubits, obj_qubits)}
             )
         self.qubit_remapping_dict.append(qubit_remapping_dict)
-        self.circuit = self.circuit.transform_qubits(
-            lambda q: qubit_remapping_dict.get(q, q)
-        )
-        post_selection = result.value if isinstance(result, enum.Enum) else result
+        self._remap_qubits(qubit_remapping_dict)
         self.post_selection[new_obj] = post_selection
         if self.use_sparse:
             self._append_op(PostSelectOperation(new_obj.qubit, post_selection))
 
+    def _resolve_objects(
+        self, objects: Optional[Sequence[Union[QuantumObject, str]]]
+    ) -> List[QuantumObject]:
+        if objects is None:
+            return self.public_objects
+        return [
+            self[obj_or_str] if isinstance(obj_or_str, str) else obj_or_str
+            for obj_or_str in objects
+        ]
+
+    def _sample_batches(
+        self,
+        quantum_objects: Sequence[QuantumObject],
+        count: Optional[int],
+        batch_size: Optional[int] = None,
+    ) -> Iterator[np.ndarray]:
+        """Yields samples of the objects that pass post-selection.
+
+        Each batch of repetitions is sized to give about `batch_size`
+        accepted samples (or the number of samples still missing, if that
+        is smaller).  Sampling stops after `count` samples in total, or
+        never if `count` is None.
+
+        Yields:
+            Non-empty arrays with one row for each accepted repetition and
+            one column for each object.
+        """
+        collector = _SampleCollector(self, quantum_objects, count, batch_size)
+        while not collector.done:
+            num_reps = collector.num_reps()
+            results = None
+            if collector.circuit is not None:
+                if self.profiler is not None:
+                    t0 = time.perf_counter()
+                results = self.sampler.run(collector.circuit, repetitions=num_reps)
+                if self.profiler is not None:
+                    self.profiler.record_time("run", t0)
+            batch = collector.add_results(results, num_reps)
+            if len(batch):
+                yield batch
+
+    def _sample(
+        self, quantum_objects: Sequence[QuantumObject], count: int
+    ) -> np.ndarray:
+        """Samples the objects until `count` repetitions pass post-selection.
+
+        Returns:
+            An array with `count` rows and one column for each object.
+        """
+        batches = list(self._sample_batches(quantum_objects, count))
+        return _concatenate_samples(batches, len(quantum_objects))
+
+    async def _run_async(self, circuit: cirq.Circuit, repetitions: int) -> cirq.Result:
+        """Runs the sampler without blocking the asyncio event loop.
+
+        Samplers with native asynchronous support (such as engine samplers)
+        are run through `run_async`, and other samplers through `run`.  The
+        async methods of cirq samplers are driven by `duet` rather than
+        asyncio, so `duet.run` runs them to completion in an executor
+        thread, like the synchronous `run` of other samplers.
+        """
+        loop = asyncio.get_running_loop()
+        if type(self.sampler).run_sweep_async is not cirq.Sampler.run_sweep_async:
+            call = functools.partial(
+                duet.run, self.sampler.run_async, circuit, repetitions=repetitions
+            )
+        else:
+            call = functools.partial(self.sampler.run, circuit, repetitions=repetitions)
+        return await loop.run_in_executor(None, call)
+
+    async def _sample_async(
+        self, quantum_objects: Sequence[QuantumObject], count: int
+    ) -> np.ndarray:
+        """Asynchronous version of `_sample`."""
+        collector = _SampleCollector(self, quantum_objects, count)
+        batches = []
+        while not collector.done:
+            num_reps = collector.num_reps()
+            results = None
+            if collector.circuit is not None:
+                if self.profiler is not None:
+                    t0 = time.perf_counter()
+                results = await self._run_async(collector.circuit, num_reps)
+                if self.profiler is not None:
+                    self.profiler.record_time("run", t0)
+            batches.append(collector.add_results(results, num_reps))
+        return _concatenate_samples(batches, len(quantum_objects))
+
+    def _to_results(
+        self,
+        quantum_objects: Sequence[QuantumObject],
+        samples: np.ndarray,
+        convert_to_enum: bool,
+    ) -> List[List[Union[enum.Enum, int]]]:
+        rtn_list = samples.tolist()
+        if convert_to_enum:
+            rtn_list = [
+                [quantum_objects[idx].enum_type(meas) for idx, meas in enumerate(res)]
+                for res in rtn_list
+            ]
+        return rtn_list
+
     def peek(
         self,
         objects: Optional[Sequence[Union[QuantumObject, str]]] = None,
         count: int = 1,
         convert_to_enum: bool = True,
-        _existing_list: Optional[List[List[Union[enum.Enum, int]]]] = None,
-        _num_reps: Optional[int] = None,
     ) -> List[List[Union[enum.Enum, int]]]:
         """Measures the state of the system 'non-destructively'.
 
@@ -457,91 +1344,218 @@ class QuantumWorld:
            equal to the count parameter.  Each element will be a list
            of measurement results for each object.
         """
-        if _num_reps is None:
-            num_reps = self._suggest_num_reps(count)
-        else:
-            if _num_reps > 1e6:
-                raise RecursionError(
-                    f"Count {count} reached without sufficient results. "
-                    "Likely post-selection error"
-                )
-            num_reps = _num_reps
+        quantum_objects = self._resolve_objects(objects)
+        samples = self._sample(quantum_objects, count)
+        return self._to_results(quantum_objects, samples, convert_to_enum)
 
-        measure_circuit = self.circuit.copy()
-        if objects is None:
-            quantum_objects = self.public_objects
-        else:
-            quantum_objects = [
-                self[obj_or_str] if isinstance(obj_or_str, str) else obj_or_str
-                for obj_or_str in objects
-            ]
-        measure_set = set(quantum_objects)
-        measure_set.update(self.post_selection.keys())
-        measure_circuit.append(
-            [
-                cirq.measure(
-                    self.compiled_qubits.get(p.qubit, p.qubit), key=p.qubit.name
-                )
-                for p in measure_set
-            ]
+    def iter_samples(
+        self,
+        objects: Optional[Sequence[Union[QuantumObject, str]]] = None,
+        batch_size: int = 1000,
+        count: Optional[int] = None,
+        convert_to_enum: bool = False,
+    ) -> Iterator[np.ndarray]:
+        """Lazily measures the state of the system 'non-destructively'.
+
+        Like `peek`, but the results are generated in blocks as they are
+        consumed, so that memory use depends on `batch_size` rather than on
+        the total number of samples.  Post-selection is applied to each
+        block.  The samples reflect the state of the world when iteration
+        started.
+
+        Args:
+            objects: Objects (or their names) to measure.  Defaults to all
+                public objects.
+            batch_size: Target number of samples per block.
+            count: Total number of samples.  If None, samples are generated
+                until the iteration is stopped.
+            convert_to_enum: If set, blocks contain the enum values of the
+                objects instead of integers.
+
+        Yields:
+            Arrays with up to `batch_size` rows and one column per object.
+            The arrays have dtype int64, or object if `convert_to_enum` is
+            set.
+        """
+        quantum_objects = self._resolve_objects(objects)
+        enum_tables = None
+        if convert_to_enum:
+            enum_tables = []
+            for obj in quantum_objects:
+                table = np.empty(obj.num_states, dtype=object)
+                table[:] = [obj.enum_type(state) for state in range(obj.num_states)]
+                enum_tables.append(table)
+        for batch in self._sample_batches(quantum_objects, count, batch_size):
+            for start in range(0, len(batch), batch_size):
+                block = batch[start : start + batch_size]
+                if enum_tables:
+                    block = np.stack(
+                        [table[block[:, idx]] for idx, table in enumerate(enum_tables)],
+                        axis=1,
+                    )
+                yield block
+
+    def query(self, queries: Sequence[Query]) -> List:
+        """Answers several queries from a single round of sampling.
+
+        All objects of all queries are measured together, so the circuit is
+        only sampled once (or a few times if post-selection rejects too many
+        repetitions) for the largest count.  Queries of smaller counts use
+        the first repetitions.
+
+        Example:
+            peek, histogram = world.query([
+                alpha.Query("peek", [light1]),
+                alpha.Query(alpha.QueryType.HISTOGRAM, [light2], count=1000),
+            ])
+
+        Returns:
+            A list with the answer to each query, in the same format as the
+            result of the corresponding method (`peek`, `get_histogram`,
+            `get_correlated_histogram`, `get_probabilities` or
+            `get_binary_probabilities`).
+        """
+        all_objects, count = self._query_objects(queries)
+        return self._answer_queries(
+            queries, all_objects, self._sample(all_objects, count)
         )
-        results = self.sampler.run(measure_circuit, repetitions=num_reps)
-
-        # Perform post-selection
-        rtn_list = _existing_list or []
-        for rep in range(num_reps):
-            post_selected = True
-            for obj in self.post_selection.keys():
-                result = self._interpret_result(results.measurements[obj.name][rep])
-                if result != self.post_selection[obj]:
-                    post_selected = False
-                    break
-            if post_selected:
-                rtn_list.append(
-                    [
-                        self._interpret_result(results.measurements[obj.name][rep])
-                        for obj in quantum_objects
+
+    def evaluate_effects(
+        self,
+        candidates: Sequence[Callable[["QuantumWorld"], Any]],
+        queries: Sequence[Query],
+    ) -> List[List]:
+        """Answers queries about the world after each of several candidate effects.
+
+        Each candidate is called with its own copy of the world and applies
+        effects to it.  Objects of the copy can be found by name, e.g.
+        `lambda w: alpha.Split()(w["a"], w["b"], w["c"])`.  The world itself
+        is not modified.
+
+        The circuits of all candidates are sampled with batched calls to
+        the sampler of the world (see `run_worlds`).  `SparseSimulator`
+        simulates the part they have in common (the circuit of the world)
+        only once, so previewing several moves costs little more than
+        peeking the world.
+
+        Returns:
+            For each candidate, the list of answers to the queries (see
+            `query`).
+        """
+        # Objects of the copies are different objects with the same names.
+        named_queries = [
+            Query(
+                q.kind,
+                (
+                    None
+                    if q.objects is None
+                    else [
+                        obj.name if isinstance(obj, QuantumObject) else obj
+                        for obj in q.objects
                     ]
-                )
-                if len(rtn_list) == count:
-                    break
-        if len(rtn_list) < count:
-            # We post-selected too much, get more reps
-            return self.peek(
-                quantum_objects,
-                count,
-                convert_to_enum,
-                rtn_list,
-                _num_reps=num_reps * 10,
+                ),
+                q.count,
+                q.convert_to_enum,
             )
+            for q in queries
+        ]
+        requests = []
+        for candidate in candidates:
+            world = self.copy()
+            # Sharing the sampler lets all candidates be sampled in one batch.
+            world.sampler = self.sampler
+            candidate(world)
+            requests.append((world, named_queries))
+        return run_worlds(requests)
+
+    def _query_objects(
+        self, queries: Sequence[Query]
+    ) -> Tuple[List[QuantumObject], int]:
+        """Returns the union of the objects of the queries and the largest count."""
+        all_objects = [obj for q in queries for obj in self._resolve_objects(q.objects)]
+        count = max((q.count for q in queries), default=0)
+        return list(dict.fromkeys(all_objects)), count
+
+    def _answer_queries(
+        self,
+        queries: Sequence[Query],
+        all_objects: Sequence[QuantumObject],
+        samples: np.ndarray,
+    ) -> List:
+        """Answers the queries from samples of the objects from `_query_objects`."""
+        columns = {obj: idx for idx, obj in enumerate(all_objects)}
+        answers = []
+        for q in queries:
+            objs = self._resolve_objects(q.objects)
+            q_samples = samples[: q.count, [columns[obj] for obj in objs]]
+            if q.kind == QueryType.PEEK:
+                answers.append(self._to_results(objs, q_samples, q.convert_to_enum))
+            elif q.kind == QueryType.HISTOGRAM:
+                answers.append(_histogram(objs, q_samples))
+            elif q.kind == QueryType.CORRELATED_HISTOGRAM:
+                answers.append(_correlated_histogram(q_samples))
+            else:
+                probs = _probabilities(_histogram(objs, q_samples), q.count)
+                if q.kind == QueryType.BINARY_PROBABILITIES:
+                    probs = [1 - one_probs[0] for one_probs in probs]
+                answers.append(probs)
+        return answers
 
-        if convert_to_enum:
-            rtn_list = [
-                [quantum_objects[idx].enum_type(meas) for idx, meas in enumerate(res)]
-                for res in rtn_list
-            ]
+    async def peek_async(
+        self,
+        objects: Optional[Sequence[Union[QuantumObject, str]]] = None,
+        count: int = 1,
+        convert_to_enum: bool = True,
+    ) -> List[List[Union[enum.Enum, int]]]:
+        """Asynchronous version of `peek`.
 
-        return rtn_list
+        The sampler runs without blocking the event loop (see `_run_async`),
+        so that peeks of different worlds can overlap.  The world should not
+        be modified while the peek is pending.
+        """
+        quantum_objects = self._resolve_objects(objects)
+        samples = await self._sample_async(quantum_objects, count)
+        return self._to_results(quantum_objects, samples, convert_to_enum)
+
+    def _force_results(
+        self,
+        quantum_objects: Sequence[QuantumObject],
+        results: List[Union[enum.Enum, int]],
+    ) -> None:
+        """Forces the measurement of popped objects to their results."""
+        for idx, result in enumerate(results):
+            self.force_measurement(quantum_objects[idx], result)
+        if self.auto_reset:
+            values = self._definite_values()
+            if values is not None:
+                self._reset_to_values(values)
 
     def pop(
         self,
         objects: Optional[Sequence[Union[QuantumObject, str]]] = None,
         convert_to_enum: bool = True,
     ) -> List[Union[enum.Enum, int]]:
-        self.effect_history.append(
-            (self.circuit.copy(), copy.copy(self.post_selection))
-        )
-        if objects is None:
-            quantum_objects = self.public_objects
-        else:
-            quantum_objects = [
-                self[obj_or_str] if isinstance(obj_or_str, str) else obj_or_str
-                for obj_or_str in objects
-            ]
+        self._save_effect_history()
+        quantum_objects = self._resolve_objects(objects)
         results = self.peek(quantum_objects, convert_to_enum=convert_to_enum)
-        for idx, result in enumerate(results[0]):
-            self.force_measurement(quantum_objects[idx], result)
+        self._force_results(quantum_objects, results[0])
+        return results[0]
+
+    async def pop_async(
+        self,
+        objects: Optional[Sequence[Union[QuantumObject, str]]] = None,
+        convert_to_enum: bool = True,
+    ) -> List[Union[enum.Enum, int]]:
+        """Asynchronous version of `pop`.
 
+        The world should not be modified while the pop is pending.
+        """
+        self._save_effect_history()
+        quantum_objects = self._resolve_objects(objects)
+        results = await self.peek_async(
+            quantum_objects, convert_to_enum=convert_to_enum
+        )
+        self._force_results(quantum_objects, results[0])
         return results[0]
 
     def get_histogram(
@@ -559,14 +1573,7 @@ class QuantumWorld:
         """
         if not objects:
             objects = self.public_objects
-        peek_results = self.peek(objects=objects, convert_to_enum=False, count=count)
-        histogram = []
-        for obj in objects:
-            histogram.append({state: 0 for state in range(obj.num_states)})
-        for result in peek_results:
-            for idx in range(len(objects)):
-                histogram[idx][cast(int, result[idx])] += 1
-        return histogram
+        return _histogram(objects, self._sample(objects, count))
 
     def get_correlated_histogram(
         self, objects: Optional[Sequence[QuantumObject]] = None, count: int = 100
@@ -587,16 +1594,7 @@ class QuantumWorld:
         """
         if not objects:
             objects = self.public_objects
-        peek_results = self.peek(objects=objects, convert_to_enum=False, count=count)
-        histogram = {}
-        for result in peek_results:
-            # Convert the list to tuple so that it could be the key of a dictionary.
-            key = tuple(result)
-            if key not in histogram:
-                histogram[key] = 1
-            else:
-                histogram[key] += 1
-        return histogram
+        return _correlated_histogram(self._sample(objects, count))
 
     def get_probabilities(
         self, objects: Optional[Sequence[QuantumObject]] = None, count: int = 100
@@ -612,12 +1610,7 @@ class QuantumWorld:
             the probability for each state of the given object.
         """
         histogram = self.get_histogram(objects=objects, count=count)
-        probabilities = []
-        for obj_hist in histogram:
-            probabilities.append(
-                {state: obj_hist[state] / count for state in range(len(obj_hist))}
-            )
-        return probabilities
+        return _probabilities(histogram, count)
 
     def get_binary_probabilities(
         self, objects: Optional[Sequence[QuantumObject]] = None, count: int = 100
@@ -640,6 +1633,53 @@ class QuantumWorld:
             binary_probs.append(1 - one_probs[0])
         return binary_probs
 
+    def expectation(
+        self, observables: Union[cirq.PauliSumLike, List[cirq.PauliSumLike]]
+    ) -> Union[float, List[float]]:
+        """Computes expectation values of observables on the world.
+
+        The observables are Pauli sums (e.g. from
+        `quantum_chess.pauli_decomposition`) on the qubits of 2-state
+        objects, e.g. `cirq.Z(light.qubit) * cirq.Z(other.qubit)`.  They are
+        computed exactly from the state of the world simulated with
+        `SparseSimulator`, rather than estimated from samples in several
+        bases.  The sampler of the world is used if it is a
+        `SparseSimulator`.
+
+        Args:
+            observables: A Pauli sum or a list of Pauli sums.
+
+        Returns:
+            The expectation value of each of the observables, or of the
+            observable if a single one is given.
+        """
+        single = not isinstance(observables, list)
+        pauli_sums = [
+            cirq.PauliSum.wrap(obs)
+            for obs in ([observables] if single else observables)
+        ]
+        circuit = self.circuit.copy()
+        observed_qubits = {q for obs in pauli_sums for q in obs.qubits}
+        circuit.append(
+            cirq.X(q)
+            for q, value in self.classical_values.items()
+            if value and q in observed_qubits
+        )
+        if not self.use_sparse:
+            for obj, value in self.post_selection.items():
+                op = PostSelectOperation(obj.qubit, value)
+                circuit.append(self._compile_op(op) if self.compile_to_qubits else op)
+        simulator = (
+            self.sampler
+            if isinstance(self.sampler, SparseSimulator)
+            else SparseSimulator()
+        )
+        values = [
+            float(value.real)
+            for value in simulator.simulate_expectation_values(circuit, pauli_sums)
+        ]
+        return values[0] if single else values
+
     def density_matrix(
         self, objects: Optional[Sequence[QuantumObject]] = None, count: int = 1000
     ) -> np.ndarray:
@@ -733,3 +1773,85 @@ class QuantumWorld:
         state_vector = np.array([0.0] * (2**num))
         state_vector[index] = 1.0
         return state_vector
+
+
+def run_worlds(
+    requests: Sequence[Tuple[QuantumWorld, Sequence[Query]]],
+    executor: Optional[concurrent.futures.Executor] = None,
+) -> List[List]:
+    """Answers queries of many independent worlds with batched sampler calls.
+
+    The pending circuits of all worlds are gathered and dispatched together
+    in rounds.  Worlds that share a sampler are sampled with one `run_batch`
+    call per round, which lets samplers that support batching (such as
+    engine samplers) amortize their per-call overhead.  If an `executor` is
+    given, the circuits are instead sampled concurrently on it, e.g. on a
+    `concurrent.futures.ProcessPoolExecutor` for local simulators.  The
+    samplers and circuits then need to be picklable.  Each call gets a copy
+    of the sampler seeded from the random state of the sampler, so that
+    calls on different processes draw independent samples.
+
+    Further rounds are only needed for worlds whose post-selection rejected
+    too many repetitions.
+
+    Args:
+        requests: Pairs of a world and the queries to answer for it (see
+            `QuantumWorld.query`).
+        executor: Optional executor to run the sampler calls on.
+
+    Returns:
+        A list with, for each request, the list of answers to its queries.
+    """
+    collectors = []
+    query_objects = []
+    for world, queries in requests:
+        all_objects, count = world._query_objects(queries)
+        query_objects.append(all_objects)
+        collectors.append(_SampleCollector(world, all_objects, count))
+    batches: List[List[np.ndarray]] = [[] for _ in requests]
+
+    while True:
+        pending = [idx for idx, c in enumerate(collectors) if not c.done]
+        if not pending:
+            break
+        num_reps = {idx: collectors[idx].num_reps() for idx in pending}
+        results: Dict[int, Optional[cirq.Result]] = {}
+        by_sampler: Dict[int, List[int]] = {}
+        for idx in pending:
+            if collectors[idx].circuit is None:
+                results[idx] = None
+            else:
+                sampler = collectors[idx].world.sampler
+                by_sampler.setdefault(id(sampler), []).append(idx)
+        for indices in by_sampler.values():
+            sampler = collectors[indices[0]].world.sampler
+            circuits = [collectors[idx].circuit for idx in indices]
+            repetitions = [num_reps[idx] for idx in indices]
+            if executor is None:
+                batch_results = [
+                    sweep_results[0]
+                    for sweep_results in sampler.run_batch(
+                        circuits, repetitions=repetitions
+                    )
+                ]
+            else:
+                futures = [
+                    executor.submit(_reseeded(sampler).run, circuit, repetitions=reps)
+                    for circuit, reps in zip(circuits, repetitions)
+                ]
+                batch_results = [future.result() for future in futures]
+            results.update(zip(indices, batch_results))
+        for idx in pending:
+            batch = collectors[idx].add_results(results[idx], num_reps[idx])
+            batches[idx].append(batch)
+
+    return [
+        world._answer_queries(
+            queries,
+            all_objects,
+            _concatenate_samples(world_batches, len(all_objects)),
+        )
+        for (world, queries), all_objects, world_batches in zip(
+            requests, query_objects, batches
+        )
+    ]
@@ -12,8 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import concurrent.futures
 import enum
+import threading
 
+import duet
 import pytest
 
 import numpy as np
@@ -23,6 +27,7 @@ import cirq
 
 import unitary.alpha as alpha
 import unitary.alpha.qudit_gates as qudit_gates
+from unitary.alpha.sparse_vector_simulator import PostSelectOperation
 
 
 class Light(enum.Enum):
@@ -971,3 +976,755 @@ def test_measure_entanglement(simulator, compile_to_qubits):
     assert round(board.measure_entanglement(light1, light3), 1) == 0.0
     # S_1 + S_2 - S_12 = 1 + 1 - 0 = 2
     assert round(board.measure_entanglement(light2, light3), 1) == 2.0
+
+
+@pytest.mark.parametrize("simulator", [cirq.Simulator, alpha.SparseSimulator])
+def test_compact_circuit(simulator):
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    board = alpha.QuantumWorld([light1, light2, light3], sampler=simulator())
+    alpha.Flip(effect_fraction=0.25)(light2)
+    alpha.Flip(effect_fraction=0.25)(light2)
+    alpha.Phase(effect_fraction=0)(light3)
+    alpha.Move()(light1, light3)
+    alpha.Move()(light1, light3)
+    alpha.Move()(light3, light1)
+    alpha.PhasedMove()(light1, light2)
+    alpha.PhasedMove(-1)(light1, light2)
+    assert board.compact_circuit() == 6
+    assert len(list(board.circuit.all_operations())) == 3
+    results = board.peek(count=100, convert_to_enum=False)
+    assert all(result[0] == 0 and result[2] == 1 for result in results)
+    assert {result[1] for result in results} == {0, 1}
+    assert board.compact_circuit() == 0
+
+    # The effect history is untouched.
+    board.undo_last_effect()
+    assert len(list(board.circuit.all_operations())) == 8
+
+
+def test_compact_circuit_clifford():
+    light1 = alpha.QuantumObject("l1", Light.RED)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld([light1, light2], sampler=alpha.AutoSampler())
+    alpha.Superposition()(light1)
+    alpha.Phase(effect_fraction=0.5)(light1)
+    alpha.Flip(effect_fraction=0.5)(light2)
+    alpha.Flip(effect_fraction=0.5)(light2)
+    alpha.Flip()(light1)
+    alpha.Flip()(light1)
+    assert board.compact_circuit() == 2
+    ops = list(board.circuit.all_operations())
+    assert len(ops) == 4
+    assert all(cirq.has_stabilizer_effect(op) for op in ops)
+    sampler = alpha.AutoSampler(min_clifford_qubits=1)
+    assert sampler.choose(board.circuit) == "clifford"
+    assert board.peek([light2], count=10, convert_to_enum=False) == [[1]] * 10
+
+
+def test_post_selection_hoisting():
+    lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(4)]
+    board = alpha.QuantumWorld(lights, sampler=alpha.SparseSimulator())
+    alpha.Superposition()(lights[0])
+    alpha.Flip()(lights[0])
+    alpha.Phase(effect_fraction=0.5)(lights[0])
+    alpha.quantum_if(lights[0]).apply(alpha.Superposition())(lights[1])
+    alpha.quantum_if(lights[0]).apply(alpha.Flip(effect_fraction=0.5))(lights[2])
+    board.force_measurement(lights[0], Light.GREEN)
+    ops = list(board.circuit.all_operations())
+    post_selections = [op for op in ops if isinstance(op, PostSelectOperation)]
+    assert len(post_selections) == 1
+    # The post-selection is moved before the controlled operations, the
+    # phase and the flip, with the value before the flip.
+    assert post_selections[0].value == 0
+    assert ops.index(post_selections[0]) == 1
+    results = board.peek(lights[:2], count=100, convert_to_enum=False)
+    assert {tuple(result) for result in results} == {(1, 0), (1, 1)}
+
+    board.force_measurement(lights[1], Light.GREEN)
+    results = board.peek(lights[:2], count=20, convert_to_enum=False)
+    assert results == [[1, 1]] * 20
+    alpha.Flip()(lights[3])
+    alpha.Superposition()(lights[3])
+    board.force_measurement(lights[3], Light.GREEN)
+    ops = list(board.circuit.all_operations())
+    # Post-selections are not moved before operations they do not commute
+    # with.
+    assert isinstance(ops[-1], PostSelectOperation)
+    assert ops[-1].value == 1
+
+
+def test_post_selection_hoisting_state_size():
+    profiler = alpha.Profiler()
+    lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(8)]
+    board = alpha.QuantumWorld(lights, sampler=alpha.SparseSimulator(profiler=profiler))
+    alpha.Superposition()(lights[0])
+    for light in lights[1:]:
+        alpha.Superposition()(light)
+        alpha.quantum_if(lights[0]).apply(alpha.Flip())(light)
+    board.force_measurement(lights[0], Light.GREEN)
+    results = board.peek(count=100, convert_to_enum=False)
+    assert all(result[0] == 1 for result in results)
+    # Each light doubles the state, but the post-selection halves it before
+    # the first controlled flip.
+    assert max(max(sizes) for sizes in profiler.state_sizes.values()) == 2**7
+
+
+@pytest.mark.parametrize("simulator", [cirq.Simulator, alpha.SparseSimulator])
+def test_compact_circuit_post_selection(simulator):
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    board = alpha.QuantumWorld([light1, light2, light3], sampler=simulator())
+    alpha.Split()(light1, light2, light3)
+    popped = board.pop([light2])[0]
+    alpha.Flip()(light2)
+    alpha.Flip()(light2)
+    board.compact_circuit()
+    results = board.peek([light2, light3], count=100)
+    assert all(result[0] == popped for result in results)
+    assert all(result[1] != popped for result in results)
+
+
+def test_compact_every():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    board = alpha.QuantumWorld([light], compact_every=3)
+    alpha.Flip()(light)
+    assert len(list(board.circuit.all_operations())) == 2
+    alpha.Flip()(light)
+    assert board.circuit == cirq.Circuit(cirq.X(light.qubit))
+    assert board.copy().compact_every == 3
+
+
+@pytest.mark.parametrize("compile_to_qubits", [False, True])
+@pytest.mark.parametrize("simulator", [cirq.Simulator, alpha.SparseSimulator])
+def test_track_classical(simulator, compile_to_qubits):
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    light4 = alpha.QuantumObject("l4", Light.GREEN)
+    board = alpha.QuantumWorld(
+        [light1, light2, light3, light4],
+        sampler=simulator(),
+        compile_to_qubits=compile_to_qubits,
+        track_classical=True,
+    )
+    alpha.Flip()(light4)
+    alpha.Move()(light1, light2)
+    alpha.quantum_if(light2).apply(alpha.Flip())(light4)
+    assert board.circuit == cirq.Circuit()
+    assert board.peek(convert_to_enum=False) == [[0, 1, 0, 1]]
+
+    alpha.Split()(light2, light1, light3)
+    assert board.circuit == cirq.Circuit(
+        cirq.X(light2.qubit), alpha.Split().effect(light2, light1, light3)
+    )
+    assert light4.qubit in board.classical_values
+    alpha.quantum_if(light1).apply(alpha.Flip())(light4)
+    assert light4.qubit not in board.classical_values
+    results = board.peek(count=100, convert_to_enum=False)
+    assert all(result[0] != result[2] for result in results)
+    assert all(result[0] != result[3] for result in results)
+    assert all(result[1] == 0 for result in results)
+
+    popped = board.pop([light1])[0]
+    assert light1.qubit in board.classical_values
+    results = board.peek(count=100)
+    assert all(result[0] == popped for result in results)
+    assert all(result[2] != popped for result in results)
+
+    board.undo_last_effect()
+    assert light1.qubit not in board.classical_values
+
+
+@pytest.mark.parametrize("compile_to_qubits", [False, True])
+def test_track_classical_qudits(compile_to_qubits):
+    light = alpha.QuantumObject("l1", StopLight.GREEN)
+    light2 = alpha.QuantumObject("l2", StopLight.RED)
+    light3 = alpha.QuantumObject("l3", StopLight.RED)
+    board = alpha.QuantumWorld(
+        [light, light2, light3],
+        sampler=cirq.Simulator(),
+        compile_to_qubits=compile_to_qubits,
+        track_classical=True,
+    )
+    light2 += 1
+    assert board.classical_values == {light.qubit: 2, light2.qubit: 1, light3.qubit: 0}
+    assert board.circuit == cirq.Circuit()
+    QuditSplitEffect(3)(light, light2, light3)
+    results = board.peek([light, light2], count=100)
+    assert all(result[0] != StopLight.GREEN for result in results)
+    assert all(result[1] != StopLight.RED for result in results)
+
+
+def test_track_classical_pop_and_copy():
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld([light1, light2], track_classical=True)
+    assert board.pop() == [Light.GREEN, Light.RED]
+    # Nothing to post-select on, since the results are known classically.
+    assert board.post_selection == {}
+    assert board.circuit == cirq.Circuit()
+    alpha.Superposition()(light2)
+    board.unhook(light2)
+    assert board.classical_values[light2.qubit] == 0
+
+    board2 = board.copy()
+    assert board2.track_classical
+    assert board2.classical_values == board.classical_values
+    board2.undo_last_effect()
+    assert board2.peek([light2], count=10) == [[Light.RED]] * 10
+
+
+@pytest.mark.parametrize("track_classical", [False, True])
+@pytest.mark.parametrize("compile_to_qubits", [False, True])
+@pytest.mark.parametrize(
+    "simulator", [cirq.Simulator, alpha.SparseSimulator, alpha.MPSSimulator, "auto"]
+)
+def test_reset_if_classical(simulator, compile_to_qubits, track_classical):
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    board = alpha.QuantumWorld(
+        [light1, light2, light3],
+        sampler=simulator if simulator == "auto" else simulator(),
+        compile_to_qubits=compile_to_qubits,
+        track_classical=track_classical,
+    )
+    alpha.Split()(light1, light2, light3)
+    assert not board.reset_if_classical()
+    popped = board.pop([light2])[0]
+    # Popping light2 also determines light3 but only samplers simulating
+    # the state can tell.
+    assert board.reset_if_classical() == (simulator != cirq.Simulator)
+    board.pop([light1, light3])
+    circuit = board.circuit.copy()
+    post_selection = board.post_selection.copy()
+    objects = board.objects
+    if simulator == cirq.Simulator and not track_classical:
+        # Only classically tracked objects are known to be definite.
+        assert not board.reset_if_classical()
+        return
+    assert board.reset_if_classical()
+    assert board.post_selection == {}
+    assert len(list(board.circuit.all_operations())) <= 1
+    # The ancillas of the popped objects are dropped.
+    assert board.objects == [light1, light2, light3]
+    assert board.ancilla_names == set()
+    results = board.peek(count=10)
+    assert all(result[1] == popped for result in results)
+    assert all(result[2] != popped for result in results)
+    assert all(result[0] == Light.RED for result in results)
+
+    board.undo_last_effect()
+    assert board.circuit == circuit
+    assert board.post_selection == post_selection
+    assert sorted(board.objects, key=str) == sorted(objects, key=str)
+
+
+def test_noisy_pops():
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld(
+        [light1, light2],
+        sampler=alpha.SparseSimulator(seed=6, noise=cirq.bit_flip(0.05)),
+    )
+    for _ in range(3):
+        alpha.Superposition()(light1)
+        alpha.quantum_if(light1).apply(alpha.Flip())(light2)
+        popped = board.pop([light1])[0]
+        # Bit flips after the pop can still change the lights.
+        results = board.peek([light1], count=200)
+        assert sum(result == [popped] for result in results) > 100
+
+
+def test_reset_if_classical_qudits():
+    light1 = alpha.QuantumObject("l1", StopLight.GREEN)
+    light2 = alpha.QuantumObject("l2", StopLight.RED)
+    light3 = alpha.QuantumObject("l3", StopLight.RED)
+    board = alpha.QuantumWorld([light1, light2, light3], auto_reset=True)
+    QuditSplitEffect(3)(light1, light2, light3)
+    popped = board.pop([light2])[0]
+    assert board.post_selection == {}
+    results = board.peek(count=10)
+    assert all(result[1] == popped for result in results)
+    assert all(result[2] != popped for result in results)
+
+
+def test_reset_if_classical_qutrit_value():
+    light = alpha.QuantumObject("l1", StopLight.RED)
+    board = alpha.QuantumWorld(
+        [light], sampler=alpha.MPSSimulator(), compile_to_qubits=False
+    )
+    alpha.QuditFlip(3, StopLight.RED.value, StopLight.GREEN.value)(light)
+    assert board.reset_if_classical()
+    assert board.peek() == [[StopLight.GREEN]]
+
+
+def test_reset_if_classical_copy():
+    lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(3)]
+    board = alpha.QuantumWorld(lights)
+    alpha.Split()(*lights)
+    board.pop(lights[1:])
+    assert board.reset_if_classical()
+    assert board.ancilla_names == set()
+
+    board2 = board.copy()
+    board2.undo_last_effect()
+    board.undo_last_effect()
+    # The ancillas of the popped lights are back, as copies.
+    assert len(board2.post_selection) == 2
+    assert board2.ancilla_names == board.ancilla_names != set()
+    for name in board2.ancilla_names:
+        assert board2[name] is not board[name]
+        assert board2[name].world is board2
+    assert board2.peek(count=5) == board.peek(count=5)
+
+
+def test_reset_if_classical_compiled_qudits():
+    light1 = alpha.QuantumObject("l1", StopLight.GREEN)
+    light2 = alpha.QuantumObject("l2", StopLight.RED)
+    board = alpha.QuantumWorld(
+        [light1, light2],
+        sampler=alpha.SparseSimulator(),
+        compile_to_qubits=True,
+        auto_reset=True,
+    )
+    compiled_names = set(board.ancilla_names)
+    for _ in range(3):
+        alpha.QuditFlip(3, StopLight.GREEN.value, StopLight.YELLOW.value)(light1)
+        board.pop([light1, light2])
+    assert board.post_selection == {}
+    # Only the compiled qubits of the lights remain.
+    assert board.ancilla_names == compiled_names
+    assert len(board.objects) == 2 + len(compiled_names)
+    assert board.peek(count=3) == [[StopLight.YELLOW, StopLight.RED]] * 3
+    board.undo_last_effect()
+    assert len(board.objects) > 2 + len(compiled_names)
+    assert board.peek(count=3) == [[StopLight.YELLOW, StopLight.RED]] * 3
+
+
+@pytest.mark.parametrize("compile_to_qubits", [False, True])
+@pytest.mark.parametrize("simulator", [cirq.Simulator, alpha.SparseSimulator])
+def test_collect_ancillas(simulator, compile_to_qubits):
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    board = alpha.QuantumWorld(
+        [light1, light2, light3],
+        sampler=simulator(),
+        compile_to_qubits=compile_to_qubits,
+    )
+    for _ in range(5):
+        alpha.Superposition()(light1)
+        popped = board.pop([light1])[0]
+    if popped == Light.RED:
+        alpha.Flip()(light1)
+    alpha.Split()(light1, light2, light3)
+    popped = board.pop([light2])[0]
+    assert len(board.post_selection) == 6
+    num_ops = len(list(board.circuit.all_operations()))
+
+    is_sparse = simulator == alpha.SparseSimulator
+    assert board.collect_ancillas() == (6 if is_sparse else 5)
+    assert len(board.post_selection) == (0 if is_sparse else 1)
+    assert len(list(board.circuit.all_operations())) < num_ops
+    assert board.collect_ancillas() == 0
+    results = board.peek([light2, light3], count=100)
+    assert all(result[0] == popped for result in results)
+    assert all(result[1] != popped for result in results)
+
+
+def test_collect_ancillas_impossible_post_selection():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    board = alpha.QuantumWorld([light], sampler=cirq.Simulator())
+    board.force_measurement(light, Light.RED)
+    assert board.collect_ancillas() == 0
+    with pytest.raises(RecursionError):
+        board.peek()
+
+
+def test_ancilla_names():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    board = alpha.QuantumWorld([light, alpha.QuantumObject("ancilla_l1_1", 0)])
+    board.pop([light])
+    board.pop([light])
+    assert board.ancilla_names == {"ancilla_l1_0", "ancilla_l1_2"}
+    assert board.copy().ancilla_counts == {"l1": 3}
+
+
+class RepetitionCountingSimulator(cirq.Simulator):
+    """Simulator that records the repetitions of every run."""
+
+    def __init__(self):
+        super().__init__()
+        self.repetitions = []
+
+    def _run(self, circuit, param_resolver, repetitions):
+        self.repetitions.append(repetitions)
+        return super()._run(circuit, param_resolver, repetitions)
+
+
+def test_peek_estimates_post_selection_rate():
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    simulator = RepetitionCountingSimulator()
+    board = alpha.QuantumWorld([light1, light2], sampler=simulator)
+    alpha.Superposition()(light1)
+    board.pop([light1])
+    results = board.peek(count=1000)
+    assert len(results) == 1000
+    first_reps = sum(simulator.repetitions)
+
+    # The second peek uses the measured acceptance rate of about 1/2
+    # instead of the prior of 1/4 for a single post-selection.
+    simulator.repetitions.clear()
+    assert len(board.peek(count=1000)) == 1000
+    second_reps = sum(simulator.repetitions)
+    assert second_reps < first_reps
+    assert second_reps < 2500
+
+    # Changing the circuit discards the estimate.
+    alpha.Flip()(light2)
+    simulator.repetitions.clear()
+    board.peek(count=1000)
+    assert sum(simulator.repetitions) > 3000
+
+
+def test_peek_streams_batches():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    board = alpha.QuantumWorld([light], sampler=cirq.Simulator())
+    alpha.Superposition()(light)
+    board.pop([light])
+    alpha.Superposition()(light)
+    board.pop([light])
+    results = board.peek(count=5000, convert_to_enum=False)
+    assert len(results) == 5000
+    assert all(len(result) == 1 for result in results)
+
+
+@pytest.mark.parametrize(
+    ("simulator", "compile_to_qubits"),
+    [
+        (cirq.Simulator, False),
+        (cirq.Simulator, True),
+        (alpha.SparseSimulator, True),
+    ],
+)
+def test_query(simulator, compile_to_qubits):
+    l1 = alpha.QuantumObject("l1", Light.GREEN)
+    l2 = alpha.QuantumObject("l2", StopLight.YELLOW)
+    l3 = alpha.QuantumObject("l3", Light.RED)
+    world = alpha.QuantumWorld(
+        [l1, l2, l3], sampler=simulator(), compile_to_qubits=compile_to_qubits
+    )
+    alpha.Superposition()(l1)
+    alpha.Move()(l1, l3)
+    peek, hist, corr, probs, bin_probs = world.query(
+        [
+            alpha.Query("peek", [l2]),
+            alpha.Query(alpha.QueryType.HISTOGRAM, ["l2"]),
+            alpha.Query("correlated_histogram", [l1, l3], count=50),
+            alpha.Query(alpha.QueryType.PROBABILITIES, [l2]),
+            alpha.Query("binary_probabilities", [l1, l3], count=200),
+        ]
+    )
+    assert peek == [[StopLight.YELLOW]]
+    assert hist == [{0: 0, 1: 100, 2: 0}]
+    assert set(corr.keys()) <= {(0, 0), (0, 1)}
+    assert sum(corr.values()) == 50
+    assert probs == [{0: 0.0, 1: 1.0, 2: 0.0}]
+    assert bin_probs[0] == 0.0
+    assert 0.0 < bin_probs[1] < 1.0
+    assert world.query([]) == []
+
+
+def test_query_samples_once():
+    l1 = alpha.QuantumObject("l1", Light.GREEN)
+    l2 = alpha.QuantumObject("l2", Light.RED)
+    simulator = RepetitionCountingSimulator()
+    world = alpha.QuantumWorld([l1, l2], sampler=simulator)
+    alpha.Superposition()(l1)
+    world.query(
+        [
+            alpha.Query("peek", [l1]),
+            alpha.Query("histogram", [l2], count=500),
+            alpha.Query("correlated_histogram"),
+        ]
+    )
+    assert simulator.repetitions == [500]
+
+
+@pytest.mark.parametrize(
+    ("simulator", "compile_to_qubits"),
+    [
+        (cirq.Simulator, False),
+        (cirq.Simulator, True),
+        (alpha.SparseSimulator, True),
+    ],
+)
+def test_iter_samples(simulator, compile_to_qubits):
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", StopLight.YELLOW)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    board = alpha.QuantumWorld(
+        [light1, light2, light3],
+        sampler=simulator(),
+        compile_to_qubits=compile_to_qubits,
+    )
+    alpha.Superposition()(light1)
+    alpha.Move()(light1, light3)
+    popped = board.pop([light1])[0]
+
+    blocks = list(board.iter_samples([light1, "l2"], batch_size=64, count=300))
+    assert sum(len(block) for block in blocks) == 300
+    assert all(0 < len(block) <= 64 for block in blocks)
+    assert all(block.shape[1] == 2 for block in blocks)
+    samples = np.concatenate(blocks)
+    assert samples.dtype == np.int64
+    assert np.all(samples[:, 0] == popped.value)
+    assert np.all(samples[:, 1] == StopLight.YELLOW.value)
+
+    blocks = board.iter_samples([light2, light1], batch_size=10, convert_to_enum=True)
+    for _ in range(20):
+        block = next(blocks)
+        assert len(block) <= 10
+        assert all(row[0] == StopLight.YELLOW for row in block)
+        assert all(row[1] == popped for row in block)
+
+
+class AsyncSimulator(cirq.Simulator):
+    """Simulator with a native asynchronous sweep.
+
+    Like remote samplers, it waits for a future completed by another thread.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.async_calls = 0
+        self.threads = set()
+
+    async def _wait(self, delay):
+        future = duet.AwaitableFuture()
+        threading.Timer(delay, future.set_result, [None]).start()
+        await future
+
+    async def run_sweep_async(self, program, params, repetitions=1):
+        self.async_calls += 1
+        self.threads.add(threading.current_thread())
+        await duet.pmap_async(self._wait, [0.01, 0.02])
+        return self.run_sweep(program, params, repetitions)
+
+
+@pytest.mark.parametrize(
+    ("simulator", "compile_to_qubits"),
+    [
+        (cirq.Simulator, False),
+        (AsyncSimulator, False),
+        (alpha.SparseSimulator, True),
+    ],
+)
+def test_peek_and_pop_async(simulator, compile_to_qubits):
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld(
+        [light1, light2], sampler=simulator(), compile_to_qubits=compile_to_qubits
+    )
+    alpha.Superposition()(light1)
+    alpha.quantum_if(light1).apply(alpha.Flip())(light2)
+
+    async def play():
+        results = await board.peek_async(count=20, convert_to_enum=False)
+        assert len(results) == 20
+        assert all(result[0] == result[1] for result in results)
+        popped = await board.pop_async([light1])
+        assert await board.peek_async(["l2"], count=5) == [[popped[0]]] * 5
+        return popped
+
+    popped = asyncio.run(play())
+    assert board.pop([light2]) == popped
+    if simulator == AsyncSimulator:
+        assert board.sampler.async_calls == 3
+        # The sampler does not block the event loop.
+        assert threading.main_thread() not in board.sampler.threads
+
+
+def test_pop_async_concurrent_worlds():
+    worlds = []
+    for idx in range(4):
+        light = alpha.QuantumObject(f"l{idx}", Light.GREEN)
+        worlds.append(alpha.QuantumWorld([light], sampler=AsyncSimulator()))
+        alpha.Superposition()(light)
+
+    async def pop_all():
+        return await asyncio.gather(*[world.pop_async() for world in worlds])
+
+    results = asyncio.run(pop_all())
+    for world, result in zip(worlds, results):
+        assert world.peek(count=10) == [result] * 10
+
+
+class BatchCountingSimulator(cirq.Simulator):
+    """Simulator that records the sizes of batches it runs."""
+
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+
+    def run_batch(self, programs, params_list=None, repetitions=1):
+        self.batch_sizes.append(len(programs))
+        return super().run_batch(programs, params_list, repetitions)
+
+
+def test_run_worlds():
+    simulator = BatchCountingSimulator()
+    requests = []
+    for idx in range(5):
+        light1 = alpha.QuantumObject(f"a{idx}", Light.GREEN)
+        light2 = alpha.QuantumObject(f"b{idx}", Light.RED)
+        world = alpha.QuantumWorld([light1, light2], sampler=simulator)
+        alpha.Superposition()(light1)
+        alpha.quantum_if(light1).apply(alpha.Flip())(light2)
+        world.pop([light1])
+        requests.append(
+            (
+                world,
+                [
+                    alpha.Query("peek", [light1, light2]),
+                    alpha.Query("histogram", [light2], count=50),
+                ],
+            )
+        )
+    # A world with only classical objects does not need the sampler.
+    light = alpha.QuantumObject("c", Light.GREEN)
+    world = alpha.QuantumWorld([light], sampler=simulator, track_classical=True)
+    requests.append((world, [alpha.Query("peek", count=3)]))
+
+    answers = alpha.run_worlds(requests)
+    assert len(answers) == 6
+    for peek, histogram in answers[:5]:
+        light1, light2 = peek[0]
+        assert light1 == light2
+        assert histogram[0][light2.value] == 50
+    assert answers[5] == [[[Light.GREEN]] * 3]
+    assert simulator.batch_sizes[0] == 5
+
+
+@pytest.mark.parametrize(
+    "executor_type",
+    [concurrent.futures.ThreadPoolExecutor, concurrent.futures.ProcessPoolExecutor],
+)
+def test_run_worlds_executor(executor_type):
+    requests = []
+    for idx in range(3):
+        light = alpha.QuantumObject("l", StopLight.GREEN)
+        world = alpha.QuantumWorld([light], sampler=alpha.SparseSimulator())
+        alpha.Cycle(idx)(light)
+        requests.append((world, [alpha.Query("peek", count=2, convert_to_enum=False)]))
+    with executor_type(max_workers=2) as executor:
+        answers = alpha.run_worlds(requests, executor=executor)
+    expected = [(StopLight.GREEN.value + idx) % 3 for idx in range(3)]
+    assert answers == [[[[value]] * 2] for value in expected]
+    assert alpha.run_worlds([]) == []
+
+    # Worlds sharing a seeded sampler get independent samples.
+    sampler = alpha.SparseSimulator(seed=7)
+    requests = []
+    for _ in range(3):
+        lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(8)]
+        world = alpha.QuantumWorld(lights, sampler=sampler)
+        for light in lights:
+            alpha.Superposition()(light)
+        requests.append((world, [alpha.Query("peek", count=5, convert_to_enum=False)]))
+    with executor_type(max_workers=2) as executor:
+        first = alpha.run_worlds(requests, executor=executor)
+        second = alpha.run_worlds(requests, executor=executor)
+    samples = [answers[0] for answers in first + second]
+    assert all(a != b for idx, a in enumerate(samples) for b in samples[:idx])
+
+
+def test_evaluate_effects():
+    profiler = alpha.Profiler()
+    lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(3)]
+    world = alpha.QuantumWorld(
+        lights, sampler=alpha.SparseSimulator(seed=5, profiler=profiler)
+    )
+    alpha.Superposition()(lights[0])
+    alpha.quantum_if(lights[0]).apply(alpha.Flip())(lights[1])
+    circuit = world.circuit.copy()
+
+    answers = world.evaluate_effects(
+        [
+            lambda w: alpha.Flip()(w["l2"]),
+            lambda w: alpha.Move()(w["l1"], w["l2"]),
+            lambda w: alpha.quantum_if(w["l1"]).apply(alpha.Flip())(w["l2"]),
+        ],
+        [
+            alpha.Query("binary_probabilities", [lights[2]], count=200),
+            alpha.Query("correlated_histogram", ["l1", "l2"], count=200),
+        ],
+    )
+    assert world.circuit == circuit
+    assert answers[0][0] == [1.0]
+    assert set(answers[1][1]) == {(0, 0), (0, 1)}
+    assert set(answers[2][1]) == {(0, 0), (1, 1)}
+    # The superposition of the world is only simulated once.
+    assert len(profiler.state_sizes["HPowGate"]) == 1
+
+
+@pytest.mark.parametrize(
+    "sampler", [alpha.SparseSimulator(), cirq.Simulator()], ids=["sparse", "dense"]
+)
+def test_expectation(sampler):
+    lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(3)]
+    world = alpha.QuantumWorld(lights, sampler=sampler, track_classical=True)
+    alpha.Superposition()(lights[0])
+    alpha.quantum_if(lights[0]).apply(alpha.Flip())(lights[1])
+    alpha.Flip()(lights[2])
+    q0, q1, q2 = (light.qubit for light in lights)
+    assert world.expectation(cirq.Z(q0) * cirq.Z(q1)) == pytest.approx(1)
+    testing.assert_allclose(
+        world.expectation([cirq.X(q0) * cirq.X(q1), cirq.Z(q0), cirq.Z(q2)]),
+        [1, 0, -1],
+        atol=1e-8,
+    )
+    world.force_measurement(lights[1], Light.GREEN)
+    testing.assert_allclose(
+        world.expectation([cirq.Z(q0), 2 * cirq.Z(q1) + 1]), [-1, -1], atol=1e-8
+    )
+
+
+def _seeded_world(seed):
+    lights = [alpha.QuantumObject(f"l{idx}", Light.GREEN) for idx in range(4)]
+    world = alpha.QuantumWorld(lights, seed=seed)
+    for light in lights:
+        alpha.Superposition()(light)
+    return world
+
+
+@pytest.mark.parametrize(
+    "make_seed", [lambda: 1234, lambda: np.random.default_rng(1234)]
+)
+def test_seed(make_seed):
+    world1 = _seeded_world(make_seed())
+    world2 = _seeded_world(make_seed())
+    assert world1.peek(count=20) == world2.peek(count=20)
+    assert world1.pop() == world2.pop()
+
+    # Copies get independent streams that are reproducible.
+    copy1 = world1.copy()
+    copy2 = world2.copy()
+    assert copy1.sampler is not world1.sampler
+    results = copy1.peek(count=20)
+    assert results == copy2.peek(count=20)
+    assert world1.copy().peek(count=20) == world2.copy().peek(count=20)
+
+
+def test_seed_defaults():
+    world1 = alpha.QuantumWorld()
+    world2 = alpha.QuantumWorld()
+    assert world1.sampler is not world2.sampler
+    assert world1.copy().sampler is world1.sampler
+    with pytest.raises(ValueError, match="seed"):
+        alpha.QuantumWorld(sampler=cirq.Simulator(), seed=5)
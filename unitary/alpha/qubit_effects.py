@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Optional
+from typing import Hashable, Optional
 
 import cirq
 
@@ -54,6 +54,9 @@ class Phase(QuantumEffect):
         for q in objects:
             yield cirq.Z(q.qubit) ** self.effect_fraction
 
+    def cache_key(self) -> Optional[Hashable]:
+        return (self.effect_fraction,)
+
     def __str__(self):
         if self.effect_fraction == 1:
             return "Phase"
@@ -77,6 +80,9 @@ class Superposition(QuantumEffect):
             else:
                 yield QuditHadamardGate(dimension=q.qubit.dimension)(q.qubit)
 
+    def cache_key(self) -> Optional[Hashable]:
+        return ()
+
     def __eq__(self, other):
         return isinstance(other, Superposition) or NotImplemented
 
@@ -105,6 +111,9 @@ class Move(QuantumEffect):
     def effect(self, *objects):
         yield cirq.SWAP(objects[0].qubit, objects[1].qubit) ** self.effect_fraction
 
+    def cache_key(self) -> Optional[Hashable]:
+        return (self.effect_fraction,)
+
     def __eq__(self, other):
         return isinstance(other, Move) or NotImplemented
 
@@ -132,6 +141,9 @@ class PhasedMove(QuantumEffect):
     def effect(self, *objects):
         yield cirq.ISWAP(objects[0].qubit, objects[1].qubit) ** self.effect_fraction
 
+    def cache_key(self) -> Optional[Hashable]:
+        return (self.effect_fraction,)
+
     def __eq__(self, other):
         return isinstance(other, PhasedMove) or NotImplemented
 
@@ -150,6 +162,9 @@ class Split(QuantumEffect):
         yield cirq.SWAP(objects[0].qubit, objects[2].qubit) ** 0.5
         yield cirq.SWAP(objects[0].qubit, objects[2].qubit) ** 0.5
 
+    def cache_key(self) -> Optional[Hashable]:
+        return ()
+
     def __eq__(self, other):
         return isinstance(other, Split) or NotImplemented
 
@@ -168,5 +183,8 @@ class PhasedSplit(QuantumEffect):
         yield cirq.ISWAP(objects[0].qubit, objects[2].qubit) ** 0.5
         yield cirq.ISWAP(objects[0].qubit, objects[2].qubit) ** 0.5
 
+    def cache_key(self) -> Optional[Hashable]:
+        return ()
+
     def __eq__(self, other):
         return isinstance(other, PhasedSplit) or NotImplemented
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import Hashable, Optional
+
 import cirq
 
 from unitary.alpha.qudit_gates import QuditPlusGate, QuditXGate
@@ -38,6 +40,9 @@ class Cycle(QuantumEffect):
                     q.qubit
                 )
 
+    def cache_key(self) -> Optional[Hashable]:
+        return (self.addend,)
+
 
 class QuditCycle(Cycle):
     """Equivalent to Cycle.
@@ -98,6 +103,9 @@ class Flip(QuantumEffect):
                     destination_state=self.state1,
                 )(q.qubit)
 
+    def cache_key(self) -> Optional[Hashable]:
+        return (self.effect_fraction, self.state0, self.state1)
+
     def __str__(self):
         if self.effect_fraction == 1:
             return "Flip"
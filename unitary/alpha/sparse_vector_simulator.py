@@ -12,15 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Noiseless simulator using a sparse state vector.
+"""Simulator using a sparse state vector.
 
 Just enough features to support Unitary are implemented.
 
 Supports standard unitary Cirq gates, plus a post-selection operator.
+Noise (from a noise model or from channels in the circuit) is simulated
+by sampling quantum trajectories.
 
 Does not work with 3+-state qudits.
 """
 
+import atexit
+import collections
+import concurrent.futures
+import copy
+import time
+from multiprocessing import shared_memory
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
 import cirq
 import numpy as np
 
@@ -28,81 +38,362 @@ import numpy as np
 # TODO: Is this a good number?
 _EPSILON = 1e-14
 
+# Process pools used for parallel sampling, by number of workers.
+_PROCESS_POOLS: Dict[int, concurrent.futures.ProcessPoolExecutor] = {}
+
+
+def _shutdown_process_pools():
+    for pool in _PROCESS_POOLS.values():
+        pool.shutdown()
+    _PROCESS_POOLS.clear()
+
+
+atexit.register(_shutdown_process_pools)
+
+
+def _process_pool(max_workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    if max_workers not in _PROCESS_POOLS:
+        _PROCESS_POOLS[max_workers] = concurrent.futures.ProcessPoolExecutor(
+            max_workers
+        )
+    return _PROCESS_POOLS[max_workers]
+
+
+def _sample_share(cdf_name, num_states, indices_name, start, share, seed):
+    """Worker for `_parallel_indices`.
+
+    Samples `share` indices from the cumulative distribution in shared
+    memory and writes them from `start` on in the shared indices.
+    """
+    cdf_memory = shared_memory.SharedMemory(name=cdf_name)
+    indices_memory = shared_memory.SharedMemory(name=indices_name)
+    cdf = indices = None
+    try:
+        cdf = np.ndarray((num_states,), dtype=np.float64, buffer=cdf_memory.buf)
+        indices = np.ndarray(
+            (share,), dtype=np.int64, buffer=indices_memory.buf, offset=8 * start
+        )
+        draws = np.random.default_rng(seed).random(share) * cdf[-1]
+        np.minimum(np.searchsorted(cdf, draws, side="right"), num_states - 1, indices)
+    finally:
+        # Views must be released before closing the shared memory.
+        del cdf, indices
+        cdf_memory.close()
+        indices_memory.close()
+
+
+def _parallel_indices(probs, repetitions, prng, max_workers):
+    """Samples indices of basis states on a process pool.
+
+    The cumulative distribution is computed once and placed in shared
+    memory.  The repetitions are split evenly across the workers, and each
+    one only samples its share, by binary search in the cumulative
+    distribution, with an independent random stream spawned from a seed
+    drawn from `prng`.  The samples are written to shared memory as well,
+    so nothing but the arguments is sent between processes.
+    """
+    seeds = np.random.SeedSequence(prng.randint(0, 2**32, size=4)).spawn(max_workers)
+    shares = np.full(max_workers, repetitions // max_workers)
+    shares[: repetitions % max_workers] += 1
+    starts = np.cumsum(shares) - shares
+    pool = _process_pool(max_workers)
+    cdf_memory = shared_memory.SharedMemory(create=True, size=8 * len(probs))
+    indices_memory = shared_memory.SharedMemory(create=True, size=8 * repetitions)
+    cdf = indices = None
+    try:
+        cdf = np.ndarray((len(probs),), dtype=np.float64, buffer=cdf_memory.buf)
+        np.cumsum(probs, out=cdf)
+        futures = [
+            pool.submit(
+                _sample_share,
+                cdf_memory.name,
+                len(probs),
+                indices_memory.name,
+                int(start),
+                int(share),
+                seed,
+            )
+            for start, share, seed in zip(starts, shares, seeds)
+            if share
+        ]
+        for future in futures:
+            future.result()
+        indices = np.ndarray((repetitions,), dtype=np.int64, buffer=indices_memory.buf)
+        result = indices.copy()
+    finally:
+        # Views must be released before closing the shared memory.
+        del cdf, indices
+        for memory in (cdf_memory, indices_memory):
+            memory.close()
+            memory.unlink()
+    return result
+
+
+def _sample_indices(probs, repetitions, prng, max_workers, parallel_threshold):
+    """Samples indices of basis states with the given probabilities."""
+    if max_workers and repetitions >= parallel_threshold:
+        return _parallel_indices(probs, repetitions, prng, max_workers)
+    return prng.choice(len(probs), size=repetitions, p=probs)
+
+
+# Identifies buffers written by `SparseSimulationState.export_to`.
+_EXPORT_MAGIC = 0x5350415253455354  # "SPARSEST"
+_EXPORT_VERSION = 1
+
+# Magic, version, number of qubits and number of states.
+_EXPORT_HEADER_WORDS = 4
+
+_WORD_MASK = (1 << 64) - 1
+
+
+def _num_words(num_qubits):
+    return max(1, -(-num_qubits // 64))
+
 
 class SparseSimulationState(cirq.SimulationState):
     """Implements sparse state vector evolution and sampling.
 
     Uses object arrays to represent states so that circuits with more than 64
     qubits work.
+
+    If `max_workers` is set, sampling at least `parallel_threshold`
+    repetitions is spread across a pool of that many processes.
+
+    If a `Profiler` is given, the state size after each gate and the time
+    spent sampling are recorded in it.
     """
 
-    def __init__(self, qubits):
+    def __init__(
+        self, qubits, max_workers=None, parallel_threshold=100_000, profiler=None
+    ):
         super().__init__(qubits=qubits, state=None)
         self._states = np.array([0], dtype=object)
         self._amplitudes = np.array([1], dtype=np.complex128)
+        self.max_workers = max_workers
+        self.parallel_threshold = parallel_threshold
+        self.profiler = profiler
 
-    def copy(self):
-        raise NotImplementedError
+    def copy(self, deep_copy_buffers=True):
+        state = copy.copy(self)
+        state._classical_data = self._classical_data.copy()
+        state._states = self._states.copy()
+        state._amplitudes = self._amplitudes.copy()
+        return state
 
     def _act_on_fallback_(self, action, qubits, allow_decompose):
-        if action.gate is cirq.X:
+        if action.gate == cirq.X:
             self._states ^= 1 << self.qubit_map[qubits[0]]
+        elif action.gate == cirq.CNOT:
+            control = self.qubit_map[qubits[0]]
+            target = self.qubit_map[qubits[1]]
+            self._states ^= ((self._states >> control) & 1) << target
         else:
-            # Create a matrix (partitioned_state) where each nonzero entry corresponds
-            # to an element of the sparse state vector. The row indicates the value of
-            # the qubits acted on by the unitary, the column indicates the value of the
-            # remaining qubits, and the value there is the amplitude. Multiplying by
-            # the gate unitary then gives the resulting state in the same format.
-            # After filtering small entries it is then converted back to the lists
-            # of states and amplitudes.
-            #
-            # The basic algorithm here is short and simple, but we go through a lot of
-            # contortions to optimize it by using numpy operations instead of pure
-            # Python ones (even at the cost of performing a much greater number of
-            # mathematical operations).
-
-            # The nth element of dst_rows tells which row of partitioned_state the
-            # nth element of the state vector will go to.
-            dst_rows = np.zeros(len(self._states), dtype=int)
-            # reverse_affected maps row index of partitioned_state -> state with all
-            # qubits not acted on by the unitary masked out.
-            reverse_affected = np.zeros(1, dtype=object)
-            mask = ~0
-            for dst_bit, qubit in enumerate(qubits[::-1]):
-                src_bit = self.qubit_map[qubit]
-                bit = np.array((self._states >> src_bit) & 1, dtype=int)
-                dst_rows |= bit << dst_bit
-                reverse_affected = np.concatenate(
-                    (reverse_affected, reverse_affected | 1 << src_bit)
-                )
-                mask ^= 1 << src_bit
-            self._states &= mask
-            # unique_affected is the set of states after masking out the qubits acted
-            # on by the unitary.
-            # The nth element of dst_colls which column of partitioned_state the nth
-            # element of the state vector will go to.
-            unique_unaffected, dst_cols = np.unique(self._states, return_inverse=True)
-            partitioned_state = np.zeros(
-                (1 << len(qubits), len(unique_unaffected)), dtype=np.complex128
-            )
-            partitioned_state[dst_rows, dst_cols] = self._amplitudes
-            np.matmul(cirq.unitary(action), partitioned_state, out=partitioned_state)
-            nz_rows, nz_cols = np.nonzero(abs(partitioned_state) > _EPSILON)
-            self._states = reverse_affected[nz_rows] | unique_unaffected[nz_cols]
-            self._amplitudes = partitioned_state[nz_rows, nz_cols]
+            self.apply_matrix(cirq.unitary(action), qubits)
+        if self.profiler is not None:
+            gate = action.gate if action.gate is not None else action
+            self.profiler.record_state_size(type(gate).__name__, len(self._states))
         return True
 
+    def apply_matrix(self, matrix, qubits):
+        """Multiplies the state vector by a matrix acting on the given qubits.
+
+        The matrix does not have to be unitary (e.g. Kraus operators), so
+        the state is not normalized afterwards.
+        """
+        # Create a matrix (partitioned_state) where each nonzero entry corresponds
+        # to an element of the sparse state vector. The row indicates the value of
+        # the qubits acted on by the unitary, the column indicates the value of the
+        # remaining qubits, and the value there is the amplitude. Multiplying by
+        # the matrix then gives the resulting state in the same format.
+        # After filtering small entries it is then converted back to the lists
+        # of states and amplitudes.
+        #
+        # The basic algorithm here is short and simple, but we go through a lot of
+        # contortions to optimize it by using numpy operations instead of pure
+        # Python ones (even at the cost of performing a much greater number of
+        # mathematical operations).
+
+        # The nth element of dst_rows tells which row of partitioned_state the
+        # nth element of the state vector will go to.
+        dst_rows = np.zeros(len(self._states), dtype=int)
+        # reverse_affected maps row index of partitioned_state -> state with all
+        # qubits not acted on by the unitary masked out.
+        reverse_affected = np.zeros(1, dtype=object)
+        mask = ~0
+        for dst_bit, qubit in enumerate(qubits[::-1]):
+            src_bit = self.qubit_map[qubit]
+            bit = np.array((self._states >> src_bit) & 1, dtype=int)
+            dst_rows |= bit << dst_bit
+            reverse_affected = np.concatenate(
+                (reverse_affected, reverse_affected | 1 << src_bit)
+            )
+            mask ^= 1 << src_bit
+        self._states &= mask
+        # unique_affected is the set of states after masking out the qubits acted
+        # on by the unitary.
+        # The nth element of dst_colls which column of partitioned_state the nth
+        # element of the state vector will go to.
+        unique_unaffected, dst_cols = np.unique(self._states, return_inverse=True)
+        partitioned_state = np.zeros(
+            (1 << len(qubits), len(unique_unaffected)), dtype=np.complex128
+        )
+        partitioned_state[dst_rows, dst_cols] = self._amplitudes
+        np.matmul(matrix, partitioned_state, out=partitioned_state)
+        nz_rows, nz_cols = np.nonzero(abs(partitioned_state) > _EPSILON)
+        self._states = reverse_affected[nz_rows] | unique_unaffected[nz_cols]
+        self._amplitudes = partitioned_state[nz_rows, nz_cols]
+
+    def norm_squared(self):
+        """Returns the squared norm of the state vector."""
+        return float(np.sum(abs(self._amplitudes) ** 2))
+
+    def normalize(self):
+        """Rescales the state vector to norm 1."""
+        self._amplitudes /= np.sqrt(self.norm_squared())
+
     def _perform_measurement(self, qubits):
         raise NotImplementedError
 
     # abstract method of OperationTarget
     def sample(self, qubits, repetitions, prng):
+        if self.profiler is not None:
+            t0 = time.perf_counter()
         probs = abs(self._amplitudes) ** 2
-        samples = prng.choice(self._states, size=repetitions, p=probs)
-        out = np.empty((repetitions, len(qubits)), dtype=np.uint8)
+        probs /= probs.sum()
+        # Bits of the sampled qubits for each basis state in the state vector.
+        # Sampling indices into this table avoids operating on the Python
+        # ints of the states for every repetition.
+        bits = np.empty((len(self._states), len(qubits)), dtype=np.uint8)
         for j, q in enumerate(qubits):
-            out[:, j] = (samples >> self.qubit_map[q]) & 1
-        return out
+            bits[:, j] = (self._states >> self.qubit_map[q]) & 1
+        indices = _sample_indices(
+            probs, repetitions, prng, self.max_workers, self.parallel_threshold
+        )
+        if self.profiler is not None:
+            self.profiler.record_time("sample", t0)
+        return bits[indices]
+
+    def export_size(self):
+        """Number of bytes needed by `export_to`."""
+        num_words = _num_words(len(self.qubits))
+        num_states = len(self._states)
+        return 8 * (_EXPORT_HEADER_WORDS + num_states * num_words) + 16 * num_states
+
+    def export_to(self, buffer):
+        """Writes the state into a writable buffer of at least `export_size` bytes.
+
+        The buffer can for instance be the `buf` of a
+        `multiprocessing.shared_memory.SharedMemory` block or a memory-mapped
+        file, and can be read back without copying with `SparseStateView`.
+        Each basis state is stored as little-endian 64-bit words, followed by
+        the complex amplitudes.
+        """
+        num_words = _num_words(len(self.qubits))
+        num_states = len(self._states)
+        header = np.ndarray((_EXPORT_HEADER_WORDS,), dtype="<u8", buffer=buffer)
+        header[:] = [_EXPORT_MAGIC, _EXPORT_VERSION, len(self.qubits), num_states]
+        words = np.ndarray(
+            (num_states, num_words),
+            dtype="<u8",
+            buffer=buffer,
+            offset=8 * _EXPORT_HEADER_WORDS,
+        )
+        for w in range(num_words):
+            words[:, w] = ((self._states >> (64 * w)) & _WORD_MASK).astype(np.uint64)
+        amplitudes = np.ndarray(
+            (num_states,),
+            dtype="<c16",
+            buffer=buffer,
+            offset=8 * (_EXPORT_HEADER_WORDS + num_states * num_words),
+        )
+        amplitudes[:] = self._amplitudes
+
+    def save(self, path):
+        """Exports the state to a file that can be opened with `SparseStateView.open`."""
+        data = np.memmap(path, dtype=np.uint8, mode="w+", shape=(self.export_size(),))
+        self.export_to(data)
+        data.flush()
+
+    def _indices_of(self, states):
+        """Returns the index of each of the basis states in the state vector.
+
+        States that are not in the state vector get the index -1.
+        """
+        if len(self.qubits) < 63:
+            keys = self._states.astype(np.int64)
+            order = np.argsort(keys)
+            sorted_keys = keys[order]
+            targets = states.astype(np.int64)
+            positions = np.minimum(
+                np.searchsorted(sorted_keys, targets), len(sorted_keys) - 1
+            )
+            return np.where(sorted_keys[positions] == targets, order[positions], -1)
+        index = {state: idx for idx, state in enumerate(self._states)}
+        return np.array([index.get(state, -1) for state in states], dtype=np.int64)
+
+    def expectation_values(self, observables):
+        """Returns the expectation values of Pauli sums on the state.
+
+        Pauli strings are evaluated on the amplitudes directly: the X and Y
+        factors of a string map each basis state to another one, and the Z
+        and Y factors multiply it by a phase.  Strings flipping the same
+        qubits share the lookup of the flipped states.
+
+        Args:
+            observables: A list of `cirq.PauliSum`s.  Qubits of the
+                observables must be qubits of the state.
+
+        Returns:
+            The (complex) expectation value of each observable.
+        """
+        qubits = sorted({q for obs in observables for q in obs.qubits})
+        # Bits of the qubits of the observables for each basis state.
+        bits = np.empty((len(self._states), len(qubits)), dtype=np.uint8)
+        for j, q in enumerate(qubits):
+            bits[:, j] = (self._states >> self.qubit_map[q]) & 1
+        columns = {q: j for j, q in enumerate(qubits)}
+        # Terms of all observables, grouped by the qubits they flip.
+        terms_by_flips = collections.defaultdict(list)
+        for obs_idx, obs in enumerate(observables):
+            for term in obs:
+                flips = frozenset(q for q, pauli in term.items() if pauli != cirq.Z)
+                terms_by_flips[flips].append((obs_idx, term))
+        values = np.zeros(len(observables), dtype=np.complex128)
+        norm = np.sum(abs(self._amplitudes) ** 2)
+        for flips, terms in terms_by_flips.items():
+            mask = sum(1 << self.qubit_map[q] for q in flips)
+            if mask:
+                indices = self._indices_of(self._states ^ mask)
+                (sources,) = np.nonzero(indices >= 0)
+                targets = indices[sources]
+            else:
+                sources = targets = slice(None)
+            overlaps = np.conj(self._amplitudes[targets]) * self._amplitudes[sources]
+            source_bits = bits[sources]
+            for obs_idx, term in terms:
+                phased = [columns[q] for q, pauli in term.items() if pauli != cirq.X]
+                num_y = sum(1 for pauli in term.values() if pauli == cirq.Y)
+                parity = np.bitwise_xor.reduce(source_bits[:, phased], axis=1)
+                signs = 1 - 2 * parity.astype(np.int64)
+                values[obs_idx] += (
+                    term.coefficient * 1j**num_y * np.sum(signs * overlaps) / norm
+                )
+        return list(values)
+
+    def definite_value(self, qubit):
+        """Returns the value of the qubit if it is in a basis state, else None."""
+        if qubit not in self.qubit_map:
+            return 0
+        bits = (self._states >> self.qubit_map[qubit]) & 1
+        if np.any(bits != bits[0]):
+            return None
+        return int(bits[0])
+
+    def value_probability(self, qubit, value):
+        """Returns the probability that measuring the qubit gives the value."""
+        bits = (self._states >> self.qubit_map[qubit]) & 1
+        probs = abs(self._amplitudes) ** 2
+        return float(np.sum(probs[bits == value]) / np.sum(probs))
 
     def post_select(self, qubit, value):
         assert value in (0, 1)
@@ -114,11 +405,451 @@ class SparseSimulationState(cirq.SimulationState):
         self._states = self._states[nonzero_indices]
         self._amplitudes = self._amplitudes[nonzero_indices]
         self._amplitudes /= np.linalg.norm(self._amplitudes)
+        if self.profiler is not None:
+            self.profiler.record_state_size("PostSelectOperation", len(self._states))
+
+
+class SparseStateView:
+    """Read-only view of a sparse state exported by `SparseSimulationState.export_to`.
+
+    The basis states and amplitudes are numpy arrays backed by the buffer
+    itself, so attaching to shared memory or a memory-mapped file does not
+    copy the state.
+
+    Args:
+        buffer: The buffer the state was exported to.
+        qubits: The qubits of the exported state, in the same order.
+        max_workers: See `SparseSimulationState`.
+        parallel_threshold: See `SparseSimulationState`.
+    """
+
+    def __init__(self, buffer, qubits, max_workers=None, parallel_threshold=100_000):
+        magic, version, num_qubits, num_states = np.ndarray(
+            (_EXPORT_HEADER_WORDS,), dtype="<u8", buffer=buffer
+        ).tolist()
+        if magic != _EXPORT_MAGIC:
+            raise ValueError("Buffer does not contain an exported sparse state.")
+        if version != _EXPORT_VERSION:
+            raise ValueError(f"Unsupported sparse state version {version}.")
+        if num_qubits != len(qubits):
+            raise ValueError(
+                f"State has {num_qubits} qubits but {len(qubits)} were given."
+            )
+        num_words = _num_words(num_qubits)
+        self.qubits = tuple(qubits)
+        self.qubit_map = {q: i for i, q in enumerate(self.qubits)}
+        self.max_workers = max_workers
+        self.parallel_threshold = parallel_threshold
+        self.words = np.ndarray(
+            (num_states, num_words),
+            dtype="<u8",
+            buffer=buffer,
+            offset=8 * _EXPORT_HEADER_WORDS,
+        )
+        self.amplitudes = np.ndarray(
+            (num_states,),
+            dtype="<c16",
+            buffer=buffer,
+            offset=8 * (_EXPORT_HEADER_WORDS + num_states * num_words),
+        )
+
+    @classmethod
+    def open(cls, path, qubits, **kwargs):
+        """Memory-maps a state saved with `SparseSimulationState.save`."""
+        return cls(np.memmap(path, dtype=np.uint8, mode="r"), qubits, **kwargs)
+
+    def bits(self, qubit):
+        """Returns the value of the qubit in each basis state."""
+        index = self.qubit_map[qubit]
+        return ((self.words[:, index // 64] >> np.uint64(index % 64)) & 1).astype(
+            np.uint8
+        )
+
+    def sample(self, qubits, repetitions, prng=np.random):
+        """Samples the qubits like `SparseSimulationState.sample`."""
+        probs = abs(self.amplitudes) ** 2
+        probs /= probs.sum()
+        bits = np.stack([self.bits(q) for q in qubits], axis=1)
+        indices = _sample_indices(
+            probs, repetitions, prng, self.max_workers, self.parallel_threshold
+        )
+        return bits[indices]
+
+    def to_simulation_state(self):
+        """Copies the view into a `SparseSimulationState`."""
+        state = SparseSimulationState(
+            self.qubits, self.max_workers, self.parallel_threshold
+        )
+        states = np.zeros(len(self.words), dtype=object)
+        for w in range(self.words.shape[1]):
+            states |= self.words[:, w].astype(object) << (64 * w)
+        state._states = states
+        state._amplitudes = np.array(self.amplitudes, dtype=np.complex128)
+        return state
+
+
+def _observed_operations(ops: Sequence[cirq.Operation]) -> List[cirq.Operation]:
+    """Drops the operations that cannot affect any measurement.
+
+    An operation is kept if it is a measurement or a post-selection, or if
+    it acts on a qubit that is measured, post-selected or acted on by a kept
+    operation afterwards.  The other operations are trace preserving and
+    only act on qubits that are never observed later, e.g. the noise that
+    noise models add after the final measurements.
+    """
+    observed = set()
+    kept = []
+    for op in reversed(ops):
+        if (
+            cirq.is_measurement(op)
+            or isinstance(op, PostSelectOperation)
+            or observed.intersection(op.qubits)
+        ):
+            observed.update(op.qubits)
+            kept.append(op)
+    return kept[::-1]
 
 
-class SparseSimulator(cirq.SimulatesIntermediateStateVector):
-    def __init__(self):
-        super().__init__(split_untangled_states=False)
+def _shared_prefix(
+    circuits: Sequence[cirq.AbstractCircuit],
+    is_shareable: Callable[[cirq.Operation], bool],
+) -> Tuple[List[cirq.Operation], List[List[cirq.Operation]]]:
+    """Splits circuits into operations at the start of all of them and the rest.
+
+    The shared operations are those that start every circuit on each of
+    their qubits, and are shareable.  They do not need to be at the start of
+    the circuits as a whole: operations on other qubits may come earlier.
+    So applying the shared operations followed by the rest of a circuit has
+    the same effect as the circuit.
+
+    Returns:
+        The shared operations, and for each circuit, the rest of its
+        operations.
+    """
+    op_lists = [list(circuit.all_operations()) for circuit in circuits]
+    # For each circuit, the indices of the operations on each qid.
+    indices_on_qid = []
+    for ops in op_lists:
+        on_qid = collections.defaultdict(list)
+        for idx, op in enumerate(ops):
+            for qid in op.qubits:
+                on_qid[qid].append(idx)
+        indices_on_qid.append(on_qid)
+    # Number of operations of each circuit shared so far on each qid.
+    num_shared = [collections.defaultdict(int) for _ in circuits]
+    shared_indices: List[set] = [set() for _ in circuits]
+    shared = []
+    blocked = set()
+    for op in op_lists[0]:
+        if not op.qubits or blocked.intersection(op.qubits) or not is_shareable(op):
+            blocked.update(op.qubits)
+            continue
+        matches = []
+        for ops, on_qid, counts in zip(op_lists, indices_on_qid, num_shared):
+            next_indices = {
+                on_qid[qid][counts[qid]] if counts[qid] < len(on_qid[qid]) else None
+                for qid in op.qubits
+            }
+            if len(next_indices) != 1 or None in next_indices:
+                break
+            (idx,) = next_indices
+            if ops[idx] != op:
+                break
+            matches.append(idx)
+        if len(matches) < len(circuits):
+            blocked.update(op.qubits)
+            continue
+        shared.append(op)
+        for idx, counts, indices in zip(matches, num_shared, shared_indices):
+            indices.add(idx)
+            for qid in op.qubits:
+                counts[qid] += 1
+    rests = [
+        [op for idx, op in enumerate(ops) if idx not in indices]
+        for ops, indices in zip(op_lists, shared_indices)
+    ]
+    return shared, rests
+
+
+def _permutes_states(op: cirq.Operation) -> bool:
+    """Whether the sparse state applies the operation by permuting basis states."""
+    return op.gate == cirq.X or op.gate == cirq.CNOT
+
+
+def _fuse_operations(
+    ops: Iterable[cirq.Operation], max_qubits: int
+) -> List[cirq.Operation]:
+    """Merges consecutive unitary operations on a few qids into single operations.
+
+    Operations are fused into a block as long as the block acts on at most
+    `max_qubits` qids and no other operation on these qids comes in between.
+    Post-selections, measurements and other non-unitary operations are never
+    fused, and operations are not fused across them.  Neither are X and CNOT
+    gates, which permute basis states faster than a matrix would.  Blocks of
+    several operations are replaced by a `cirq.MatrixGate` on their qids.
+
+    Returns:
+        The operations, with the same effect as `ops`.
+    """
+    items: List[Optional[cirq.Operation]] = []
+    # Qids and operations of the blocks, by their index in items.
+    blocks: Dict[int, Tuple[List[cirq.Qid], List[cirq.Operation]]] = {}
+    # Index in items of the last block or operation on each qid.
+    last: Dict[cirq.Qid, int] = {}
+    for op in ops:
+        if (
+            op.qubits
+            and len(op.qubits) <= max_qubits
+            and not isinstance(op, PostSelectOperation)
+            and not _permutes_states(op)
+            and cirq.has_unitary(op)
+        ):
+            candidates = [last[q] for q in op.qubits if last.get(q) in blocks]
+            if candidates:
+                target = max(candidates)
+                qubits, block_ops = blocks[target]
+                new_qubits = [q for q in op.qubits if q not in qubits]
+                if len(qubits) + len(new_qubits) <= max_qubits and all(
+                    last[q] == target if q in qubits else last.get(q, -1) < target
+                    for q in op.qubits
+                ):
+                    qubits.extend(new_qubits)
+                    block_ops.append(op)
+                    last.update((q, target) for q in op.qubits)
+                    continue
+            blocks[len(items)] = (list(op.qubits), [op])
+            last.update((q, len(items)) for q in op.qubits)
+            items.append(None)
+        else:
+            last.update((q, len(items)) for q in op.qubits)
+            items.append(op)
+    fused = []
+    for idx, op in enumerate(items):
+        if op is None:
+            qubits, block_ops = blocks[idx]
+            if len(block_ops) == 1:
+                op = block_ops[0]
+            else:
+                qid_shape = cirq.qid_shape(qubits)
+                unitary = cirq.apply_unitaries(
+                    block_ops,
+                    qubits,
+                    cirq.ApplyUnitaryArgs.for_unitary(qid_shape=qid_shape),
+                )
+                size = np.prod(qid_shape, dtype=np.int64)
+                op = cirq.MatrixGate(
+                    unitary.reshape(size, size), qid_shape=qid_shape
+                ).on(*qubits)
+        fused.append(op)
+    return fused
+
+
+def _nontrivial_mixture(op):
+    """Returns the mixture of op, with None instead of identity unitaries.
+
+    Returns None if op is not a mixture of unitaries.
+    """
+    mixture = cirq.mixture(op, None)
+    if mixture is None:
+        return None
+    return [
+        (
+            p,
+            (
+                None
+                if cirq.equal_up_to_global_phase(unitary, np.eye(len(unitary)))
+                else unitary
+            ),
+        )
+        for p, unitary in mixture
+    ]
+
+
+def _random_state(seed):
+    """Converts a seed to a random state accepted by cirq simulators.
+
+    In addition to the seeds accepted by cirq, supports
+    `np.random.SeedSequence` and `np.random.Generator` seeds.
+    """
+    if isinstance(seed, np.random.Generator):
+        seed = np.random.SeedSequence(seed.integers(0, 2**32, size=4))
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.RandomState(np.random.MT19937(seed))
+    return seed
+
+
+class SparseSimulator(
+    cirq.SimulatesIntermediateStateVector, cirq.SimulatesExpectationValues
+):
+    """Simulator using a sparse state vector.
+
+    Args:
+        seed: Seed of the random state used for sampling.  Can be anything
+            accepted by cirq simulators, a `np.random.SeedSequence` or a
+            `np.random.Generator` (from which a seed is drawn).
+        max_workers: If set, large numbers of repetitions are sampled in
+            parallel on a pool of this many processes.
+        parallel_threshold: Minimum number of repetitions for which
+            sampling is done in parallel.
+        profiler: If set, a `Profiler` recording the size of the state after
+            each gate and the time spent sampling.
+        noise: A noise model (or anything accepted by cirq simulators) to
+            apply to the circuits.
+        max_fused_qubits: If set, consecutive unitary operations acting on
+            at most this many qubits in total are fused into one operation
+            before simulation (see below).
+
+    Circuits with noise, from the noise model or from channels in the
+    circuit, are simulated by sampling quantum trajectories.  Rather than
+    simulating every repetition on its own, the repetitions are split into
+    groups sharing a trajectory: at each channel, the repetitions of every
+    group are distributed over the Kraus operators of the channel, and
+    each Kraus operator drawn gets its own copy of the state.  With weak
+    noise most repetitions stay in a few groups, so the cost grows with the
+    number of distinct trajectories rather than with the repetitions.
+    Measurements must be the last operations on their qubits (apart from
+    operations that cannot affect any measurement, which are dropped).
+
+    Without noise, `run_sweep` and `run_batch` simulate the operations that
+    all circuits and parameter values have in common only once: the state
+    after the unparameterized operations at the start of all circuits is
+    copied for each circuit and parameter resolver, and only the remaining
+    operations are applied to the copy.  E.g. trying out several values of
+    a parameter of the last effect of a world costs one simulation of the
+    world plus one of the last effect per value.
+
+    Every gate is a full pass over the state.  Effects such as `PhasedSplit`
+    or fractional `Flip`s create long runs of small gates on the same
+    qubits, so with `max_fused_qubits` set, runs of unitary operations on at
+    most that many qubits are multiplied into a single `cirq.MatrixGate`
+    and applied in one pass.  Operations are not fused across
+    post-selections, measurements or channels, and X and CNOT gates, which
+    only permute the basis states, are left as they are.  A profiler then
+    records fused operations as `MatrixGate`.
+    """
+
+    # `PostSelectOperation`s are applied to the state vector, so
+    # `QuantumWorld` can add them to circuits.
+    supports_post_selection = True
+
+    def __init__(
+        self,
+        seed=None,
+        max_workers=None,
+        parallel_threshold=100_000,
+        profiler=None,
+        noise=None,
+        max_fused_qubits=None,
+    ):
+        super().__init__(
+            seed=_random_state(seed), noise=noise, split_untangled_states=False
+        )
+        self.max_workers = max_workers
+        self.parallel_threshold = parallel_threshold
+        self.profiler = profiler
+        self.max_fused_qubits = max_fused_qubits
+
+    def __getstate__(self):
+        # Without a seed, cirq samples from the global `np.random` module,
+        # which cannot be pickled (e.g. to send the simulator to a worker
+        # process).
+        state = self.__dict__.copy()
+        if state["_prng"] is np.random:
+            state["_prng"] = None
+        return state
+
+    def __setstate__(self, state):
+        # Unpickled copies of unseeded simulators get their own random state,
+        # so that copies sent to different worker processes do not share the
+        # random stream of the global state copied from the parent process.
+        if state["_prng"] is None:
+            state["_prng"] = np.random.RandomState()
+        self.__dict__.update(state)
+
+    def simulate_state(self, program, qubit_order=cirq.QubitOrder.DEFAULT):
+        """Simulates a circuit without measurements and returns the sparse state.
+
+        Args:
+            program: The circuit to simulate.  It may contain post-selections
+                but no measurements.
+            qubit_order: Determines the canonical ordering of the qubits.
+
+        Returns:
+            The `SparseSimulationState` at the end of the circuit.
+        """
+        qubits = cirq.QubitOrder.as_qubit_order(qubit_order).order_for(
+            program.all_qubits()
+        )
+        state = self._create_partial_simulation_state(0, qubits)
+        for op in self._fused(program.all_operations()):
+            cirq.act_on(op, state)
+        return state
+
+    def _fused(self, ops):
+        """Fuses the operations if `max_fused_qubits` is set."""
+        if not self.max_fused_qubits:
+            return list(ops)
+        return _fuse_operations(ops, self.max_fused_qubits)
+
+    def simulate_expectation_values_sweep_iter(
+        self,
+        program,
+        observables,
+        params,
+        qubit_order=cirq.QubitOrder.DEFAULT,
+        initial_state=None,
+        permit_terminal_measurements=False,
+    ):
+        """Computes expectation values from the sparse state.
+
+        See `cirq.SimulatesExpectationValues`.  The values are computed
+        exactly by `SparseSimulationState.expectation_values`.  Qubits of
+        the observables that are not in the circuit are in state 0.
+
+        Raises:
+            ValueError: if the initial state is not the index of a basis
+                state (big endian in the qubit order), or if the circuit has
+                terminal measurements that are not permitted.
+        """
+        if initial_state is None:
+            initial_state = 0
+        if not isinstance(initial_state, (int, np.integer)):
+            raise ValueError(
+                f"Unsupported initial state {initial_state!r}; only indices "
+                "of basis states are supported."
+            )
+        if not permit_terminal_measurements and program.are_any_measurements_terminal():
+            raise ValueError(
+                "Provided circuit has terminal measurements, which may "
+                "skew expectation values. If this is intentional, set "
+                "permit_terminal_measurements=True."
+            )
+        if not isinstance(observables, list):
+            observables = [observables]
+        pauli_sums = [cirq.PauliSum.wrap(obs) for obs in observables]
+        observed_qubits = {q for obs in pauli_sums for q in obs.qubits}
+        # Qubits of the observables are added to the circuit.
+        extra_ops = [cirq.I(q) for q in observed_qubits - program.all_qubits()]
+        for resolver in cirq.to_resolvers(params):
+            circuit = cirq.resolve_parameters(
+                program.unfreeze(copy=False), resolver
+            ).copy()
+            if permit_terminal_measurements:
+                circuit = cirq.drop_terminal_measurements(circuit)
+            circuit.append(extra_ops)
+            if initial_state:
+                qubits = cirq.QubitOrder.as_qubit_order(qubit_order).order_for(
+                    circuit.all_qubits()
+                )
+                if not 0 <= initial_state < 2 ** len(qubits):
+                    raise ValueError(
+                        f"Initial state {initial_state} out of range for "
+                        f"{len(qubits)} qubits."
+                    )
+                bits = cirq.big_endian_int_to_bits(initial_state, bit_count=len(qubits))
+                circuit.insert(0, [cirq.X(q) for q, bit in zip(qubits, bits) if bit])
+            state = self.simulate_state(circuit, qubit_order)
+            yield state.expectation_values(pauli_sums)
 
     # override
     def _can_be_in_run_prefix(self, val):
@@ -126,18 +857,244 @@ class SparseSimulator(cirq.SimulatesIntermediateStateVector):
             val, PostSelectOperation
         )
 
+    # override
+    def run_sweep(self, program, params, repetitions=1):
+        return self.run_batch([program], [params], repetitions)[0]
+
+    # override
+    def run_batch(self, programs, params_list=None, repetitions=1):
+        params_list, repetitions = self._normalize_batch_args(
+            programs, params_list, repetitions
+        )
+        resolvers = [list(cirq.to_resolvers(params)) for params in params_list]
+        if self.noise != cirq.NO_NOISE or sum(map(len, resolvers)) < 2:
+            results = []
+            for program, params, reps in zip(programs, params_list, repetitions):
+                results.append(super().run_sweep(program, params, reps))
+            return results
+        for program in programs:
+            if not program.has_measurements():
+                raise ValueError("Circuit has no measurements to sample.")
+        prefix, suffixes = _shared_prefix(
+            programs,
+            lambda op: not cirq.is_parameterized(op) and self._can_be_in_run_prefix(op),
+        )
+        qubits = sorted(set().union(*(program.all_qubits() for program in programs)))
+        state = self._create_partial_simulation_state(0, qubits)
+        for op in self._fused(prefix):
+            cirq.act_on(op, state)
+        results = []
+        for program, suffix, program_resolvers, reps in zip(
+            programs, suffixes, resolvers, repetitions
+        ):
+            program_results = []
+            for resolver in program_resolvers:
+                records = self._run_suffix(state, suffix, resolver, reps)
+                if records is None:
+                    records = self._run(program, resolver, reps)
+                program_results.append(
+                    cirq.ResultDict(params=resolver, records=records)
+                )
+            results.append(program_results)
+        return results
+
+    def _run_suffix(self, state, suffix, resolver, repetitions):
+        """Samples the rest of a circuit, starting from a copy of a state.
+
+        Returns:
+            The measurement records, or None if the rest of the circuit is not
+            made of unitary operations and post-selections followed by
+            terminal measurements.
+        """
+        ops = [cirq.resolve_parameters(op, resolver) for op in suffix]
+        measurements = []
+        measured = set()
+        for op in ops:
+            if isinstance(op.gate, cirq.MeasurementGate):
+                measurements.append(op)
+                measured.update(op.qubits)
+            elif measured.intersection(op.qubits) or not self._can_be_in_run_prefix(op):
+                return None
+        state = state.copy()
+        for op in self._fused(
+            op for op in ops if not isinstance(op.gate, cirq.MeasurementGate)
+        ):
+            cirq.act_on(op, state)
+        return SparseSimulatorStep(sim_state=state).sample_measurement_ops(
+            measurements, repetitions, seed=self._prng, _allow_repeated=True
+        )
+
+    # override
+    def _run(self, circuit, param_resolver, repetitions):
+        resolved_circuit = cirq.resolve_parameters(
+            circuit, param_resolver or cirq.ParamResolver({})
+        )
+        if self.noise == cirq.NO_NOISE and all(
+            self._can_be_in_run_prefix(op) or cirq.is_measurement(op)
+            for op in resolved_circuit.all_operations()
+        ):
+            if self.max_fused_qubits:
+                resolved_circuit = cirq.Circuit(
+                    self._fused(resolved_circuit.all_operations())
+                )
+            return super()._run(resolved_circuit, None, repetitions)
+        return self._run_trajectories(resolved_circuit, repetitions)
+
+    def _run_trajectories(self, circuit, repetitions):
+        """Samples the circuit with noise, see the class docstring."""
+        qubits = tuple(sorted(circuit.all_qubits()))
+        noisy_circuit = cirq.Circuit(self.noise.noisy_moments(circuit, qubits))
+        groups = [(self._create_partial_simulation_state(0, qubits), repetitions)]
+        mixtures: Dict[cirq.Gate, Optional[List[Tuple[float, np.ndarray]]]] = {}
+        measurements = []
+        measured = set()
+        for op in self._fused(
+            _observed_operations(list(noisy_circuit.all_operations()))
+        ):
+            if cirq.is_measurement(op):
+                measurements.append(op)
+                measured.update(op.qubits)
+                continue
+            if measured.intersection(op.qubits):
+                raise ValueError(
+                    f"Operation {op} acts on a measured qubit. Only terminal "
+                    "measurements are supported."
+                )
+            if isinstance(op, PostSelectOperation):
+                groups = self._post_select(op, groups)
+                continue
+            if self._can_be_in_run_prefix(op):
+                for state, _ in groups:
+                    cirq.act_on(op, state)
+                continue
+            # Noise models apply the same channels over and over.
+            key = op.gate if op.gate is not None else op
+            if key not in mixtures:
+                mixtures[key] = _nontrivial_mixture(op)
+            if mixtures[key] is not None:
+                groups = self._apply_mixture(mixtures[key], op.qubits, groups)
+            else:
+                groups = self._apply_kraus(cirq.kraus(op), op.qubits, groups)
+        records: Dict[str, List[np.ndarray]] = {}
+        for state, count in groups:
+            step = SparseSimulatorStep(sim_state=state)
+            samples = step.sample_measurement_ops(
+                measurements, count, seed=self._prng, _allow_repeated=True
+            )
+            for key, bits in samples.items():
+                records.setdefault(key, []).append(bits)
+        # Repetitions of the same group are contiguous, so they are shuffled.
+        order = self._prng.permutation(repetitions)
+        return {key: np.concatenate(bits)[order] for key, bits in records.items()}
+
+    def _apply_mixture(self, mixture, qubits, groups):
+        """Distributes the repetitions of the groups over the unitaries of a mixture.
+
+        The probabilities of the unitaries do not depend on the state, so they
+        are drawn for all repetitions at once.
+
+        Returns:
+            The states and number of repetitions of the new groups.
+        """
+        probs = np.array([p for p, _ in mixture])
+        group_ids = np.repeat(np.arange(len(groups)), [count for _, count in groups])
+        drawn = self._prng.choice(
+            len(probs), size=len(group_ids), p=probs / probs.sum()
+        )
+        counts = np.bincount(
+            group_ids * len(probs) + drawn, minlength=len(groups) * len(probs)
+        ).reshape(len(groups), len(probs))
+        # Most groups only draw the identity with weak noise, and are kept.
+        identities = np.array([unitary is None for _, unitary in mixture])
+        main_branch = counts.argmax(axis=1)
+        unchanged = identities[main_branch] & (
+            counts[np.arange(len(groups)), main_branch] == counts.sum(axis=1)
+        )
+        new_groups = [group for group, keep in zip(groups, unchanged) if keep]
+        for group_id in np.flatnonzero(~unchanged):
+            state = groups[group_id][0]
+            group_counts = counts[group_id]
+            branches = np.flatnonzero(group_counts)
+            for idx in branches:
+                # The last branch reuses the state of the group.
+                branch = state if idx == branches[-1] else state.copy()
+                unitary = mixture[idx][1]
+                if unitary is not None:
+                    branch.apply_matrix(unitary, qubits)
+                new_groups.append((branch, group_counts[idx]))
+        return new_groups
+
+    def _post_select(self, op, groups):
+        """Conditions the groups on a post-selection.
+
+        The repetitions are redistributed over the groups in proportion to
+        their number of repetitions times the probability of the
+        post-selected value, so groups where it is impossible are dropped.
+
+        Returns:
+            The states and number of repetitions of the new groups.
+
+        Raises:
+            InvalidPostSelectionError: if the value is impossible in all groups.
+        """
+        weights = np.array(
+            [
+                count * state.value_probability(op.qubit, op.value)
+                for state, count in groups
+            ]
+        )
+        if not np.any(weights > 0):
+            raise InvalidPostSelectionError(
+                f"No trajectories where {op.qubit} equals {op.value}"
+            )
+        repetitions = sum(count for _, count in groups)
+        counts = self._prng.multinomial(repetitions, weights / weights.sum())
+        new_groups = []
+        for (state, _), count in zip(groups, counts):
+            if count:
+                cirq.act_on(op, state)
+                new_groups.append((state, count))
+        return new_groups
+
+    def _apply_kraus(self, kraus, qubits, groups):
+        """Distributes the repetitions of the groups over Kraus operators.
+
+        Returns:
+            The states and number of repetitions of the new groups.
+        """
+        new_groups = []
+        for state, count in groups:
+            branches = []
+            for operator in kraus:
+                branch = state.copy()
+                branch.apply_matrix(operator, qubits)
+                branches.append(branch)
+            probs = np.array([branch.norm_squared() for branch in branches])
+            counts = self._prng.multinomial(count, probs / probs.sum())
+            for branch, branch_count in zip(branches, counts):
+                if branch_count:
+                    branch.normalize()
+                    new_groups.append((branch, branch_count))
+        return new_groups
+
     # abstract method of SimulatorBase
     def _create_partial_simulation_state(
         self, initial_state, qubits, logs=None, classical_data=None
     ):
         assert initial_state == 0
-        return SparseSimulationState(qubits=qubits)
+        return SparseSimulationState(
+            qubits=qubits,
+            max_workers=self.max_workers,
+            parallel_threshold=self.parallel_threshold,
+            profiler=self.profiler,
+        )
 
     # abstract method of SimulatorBase
     def _create_step_result(self, sim_state):
         return SparseSimulatorStep(sim_state=sim_state)
 
 
+@cirq.value_equality
 class PostSelectOperation(cirq.Operation):
     """Prunes states where self.qubit is not equal to self.value from the state vector.
 
@@ -160,10 +1117,18 @@ class PostSelectOperation(cirq.Operation):
     def with_qubits(self, new_qubit):
         return PostSelectOperation(new_qubit, self.value)
 
+    def _value_equality_values_(self):
+        return self.qubit, self.value
+
 
 class InvalidPostSelectionError(Exception):
     """When a qubit state with zero amplitude is post-selected for."""
 
 
 class SparseSimulatorStep(cirq.StepResultBase):
-    pass
+    # override
+    def _confuse_results(self, bits, qubits, confusion_map, seed=None):
+        # The base implementation loops over every repetition in Python, even
+        # without a confusion map, which dominates the time of large samples.
+        if confusion_map:
+            super()._confuse_results(bits, qubits, confusion_map, seed)
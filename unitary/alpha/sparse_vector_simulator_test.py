@@ -12,14 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import pickle
+from multiprocessing import shared_memory
+
 import pytest
 
 import cirq
+import numpy as np
+import sympy
 from cirq.testing import random_circuit
 from unitary.alpha import qudit_gates
 
+from unitary.alpha.profiler import Profiler
 from unitary.alpha.sparse_vector_simulator import (
+    _fuse_operations,
+    _shared_prefix,
     SparseSimulator,
+    SparseStateView,
     PostSelectOperation,
     InvalidPostSelectionError,
 )
@@ -99,3 +108,497 @@ def test_impossible_post_selection():
     circuit = cirq.Circuit(PostSelectOperation(qubit, 1), cirq.measure(qubit))
     with pytest.raises(InvalidPostSelectionError):
         sim.run(circuit, repetitions=100)
+
+
+def test_simulate_state():
+    sim = SparseSimulator()
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    circuit = cirq.Circuit(
+        cirq.H(q0), cirq.CNOT(q0, q1), cirq.X(q2), PostSelectOperation(q1, 1)
+    )
+    state = sim.simulate_state(circuit)
+    assert state.definite_value(q0) == 1
+    assert state.definite_value(q1) == 1
+    assert state.definite_value(q2) == 1
+    assert state.definite_value(cirq.LineQubit(3)) == 0
+    state = sim.simulate_state(circuit[:-1])
+    assert state.definite_value(q0) is None
+    assert state.definite_value(q2) == 1
+
+
+def test_pickle():
+    q0, q1 = cirq.LineQubit.range(2)
+    circuit = cirq.Circuit(cirq.H(q0), cirq.CNOT(q0, q1), cirq.measure(q0, q1, key="m"))
+    sim = pickle.loads(pickle.dumps(SparseSimulator()))
+    result = sim.run(circuit, repetitions=100)
+    assert all(a == b for a, b in result.measurements["m"])
+    assert pickle.loads(pickle.dumps(sim))._prng is not sim._prng
+
+
+def test_parallel_sampling():
+    qubits = cirq.LineQubit.range(4)
+    circuit = cirq.Circuit(
+        cirq.H(qubits[0]),
+        [cirq.CNOT(qubits[0], q) for q in qubits[1:]],
+        cirq.H(qubits[3]),
+        cirq.measure(*qubits, key="m"),
+    )
+    sim = SparseSimulator(max_workers=2, parallel_threshold=1000)
+    result = sim.run(circuit, repetitions=4000)
+    measurements = result.measurements["m"]
+    assert measurements.shape == (4000, 4)
+    assert all(row[0] == row[1] == row[2] for row in measurements)
+    histogram = result.histogram(key="m")
+    assert set(histogram.keys()) <= {0b0000, 0b0001, 0b1110, 0b1111}
+    assert all(800 < histogram[key] < 1200 for key in (0b0000, 0b0001, 0b1110))
+    # Samples are independent: the first rows are not all the same outcome.
+    assert len(set(map(tuple, measurements[:100]))) > 1
+
+
+def test_confusion_map():
+    q0 = cirq.LineQubit(0)
+    flip = {(0,): np.array([[0.0, 1.0], [1.0, 0.0]])}
+    circuit = cirq.Circuit(cirq.measure(q0, key="m", confusion_map=flip))
+    result = SparseSimulator().run(circuit, repetitions=10)
+    assert all(result.measurements["m"][:, 0] == 1)
+
+
+@pytest.mark.parametrize("num_qubits", [3, 70])
+def test_export_shared_memory(num_qubits):
+    qubits = cirq.LineQubit.range(num_qubits)
+    circuit = cirq.Circuit(
+        cirq.H(qubits[0]), cirq.CNOT(qubits[0], qubits[-1]), cirq.X(qubits[1])
+    )
+    state = SparseSimulator().simulate_state(circuit, qubit_order=qubits)
+    shm = shared_memory.SharedMemory(create=True, size=state.export_size())
+    try:
+        state.export_to(shm.buf)
+        view = SparseStateView(shm.buf, state.qubits)
+        assert view.words.shape == (2, 1 if num_qubits <= 64 else 2)
+        np.testing.assert_allclose(abs(view.amplitudes) ** 2, [0.5, 0.5])
+        assert all(view.bits(qubits[1]) == 1)
+        np.testing.assert_array_equal(view.bits(qubits[0]), view.bits(qubits[-1]))
+        samples = view.sample([qubits[0], qubits[1], qubits[-1]], 100)
+        assert all(row[0] == row[2] and row[1] == 1 for row in samples)
+
+        copied = view.to_simulation_state()
+        del view
+        assert list(copied._states) == list(state._states)
+        np.testing.assert_allclose(copied._amplitudes, state._amplitudes)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_save_and_open(tmp_path):
+    qubits = cirq.LineQubit.range(3)
+    circuit = cirq.Circuit(cirq.H(qubits[0]), cirq.CNOT(qubits[0], qubits[2]))
+    state = SparseSimulator().simulate_state(circuit, qubit_order=qubits)
+    path = tmp_path / "state.bin"
+    state.save(path)
+    view = SparseStateView.open(path, qubits)
+    assert isinstance(view.words, np.memmap) or isinstance(view.words.base, np.memmap)
+    samples = view.sample(qubits, 100)
+    assert all(row[0] == row[2] and row[1] == 0 for row in samples)
+    with pytest.raises(ValueError, match="qubits"):
+        SparseStateView.open(path, qubits[:2])
+    with pytest.raises(ValueError, match="exported sparse state"):
+        SparseStateView(bytes(64), qubits)
+
+
+@pytest.mark.parametrize(
+    "make_seed",
+    [lambda: 5, lambda: np.random.SeedSequence(5), lambda: np.random.default_rng(5)],
+)
+def test_seed(make_seed):
+    q0, q1 = cirq.LineQubit.range(2)
+    circuit = cirq.Circuit(cirq.H(q0), cirq.H(q1), cirq.measure(q0, q1, key="m"))
+    result1 = SparseSimulator(seed=make_seed()).run(circuit, repetitions=50)
+    result2 = SparseSimulator(seed=make_seed()).run(circuit, repetitions=50)
+    np.testing.assert_array_equal(result1.measurements["m"], result2.measurements["m"])
+
+
+def _exact_distribution(circuit, qubits):
+    """Probabilities of the outcomes of a circuit of channels, without measurements."""
+    rho = cirq.DensityMatrixSimulator(dtype=np.complex128).simulate(
+        circuit, qubit_order=qubits
+    )
+    return np.real(np.diag(rho.final_density_matrix))
+
+
+def test_noise_model():
+    qubits = cirq.LineQubit.range(4)
+    noise = cirq.ConstantQubitNoiseModel(cirq.depolarize(0.05))
+    circuit = cirq.Circuit(
+        cirq.H(qubits[0]),
+        cirq.CNOT(qubits[0], qubits[1]),
+        cirq.CNOT(qubits[1], qubits[2]),
+    )
+    expected = _exact_distribution(
+        cirq.Circuit(noise.noisy_moments(circuit, qubits)), qubits
+    )
+    circuit.append(cirq.measure(*qubits, key="m"))
+    repetitions = 20000
+    sim = SparseSimulator(seed=1, noise=noise)
+    samples = sim.run(circuit, repetitions=repetitions).measurements["m"]
+    counts = np.bincount([cirq.big_endian_bits_to_int(bits) for bits in samples])
+    np.testing.assert_allclose(counts / repetitions, expected[: len(counts)], atol=0.01)
+
+
+def test_channels():
+    """Channels in the circuit are simulated, including non-unitary ones."""
+    qubits = cirq.LineQubit.range(4)
+    circuit = cirq.Circuit(
+        cirq.H(qubits[0]),
+        cirq.CNOT(qubits[0], qubits[1]),
+        cirq.amplitude_damp(0.3)(qubits[1]),
+        cirq.bit_flip(0.2)(qubits[2]),
+        cirq.CNOT(qubits[1], qubits[3]),
+    )
+    expected = _exact_distribution(circuit, qubits)
+    circuit.append(cirq.measure(*qubits, key="m"))
+    repetitions = 20000
+    samples = SparseSimulator(seed=2).run(circuit, repetitions=repetitions)
+    counts = np.bincount(
+        [cirq.big_endian_bits_to_int(bits) for bits in samples.measurements["m"]],
+        minlength=16,
+    )
+    np.testing.assert_allclose(counts / repetitions, expected, atol=0.01)
+
+
+def test_channels_post_selection():
+    """Post-selections condition the noisy trajectories on their value."""
+    qubits = cirq.LineQubit.range(3)
+    q0, q1, q2 = qubits
+    before = cirq.Circuit(
+        cirq.H(q0),
+        cirq.CNOT(q0, q1),
+        cirq.bit_flip(0.3)(q0),
+        cirq.amplitude_damp(0.4)(q1),
+        cirq.ry(0.7)(q2),
+        cirq.CNOT(q2, q0),
+    )
+    after = cirq.Circuit(cirq.depolarize(0.1)(q1), cirq.CNOT(q1, q2))
+    density_matrix = cirq.DensityMatrixSimulator(dtype=np.complex128)
+    rho = density_matrix.simulate(before, qubit_order=qubits).final_density_matrix
+    projector = np.kron(np.diag([0, 1]), np.eye(4))
+    rho = projector @ rho @ projector
+    rho /= np.trace(rho)
+    rho = density_matrix.simulate(
+        after, qubit_order=qubits, initial_state=rho
+    ).final_density_matrix
+    expected = np.real(np.diag(rho))
+
+    circuit = before + cirq.Circuit(PostSelectOperation(q0, 1)) + after
+    circuit.append(cirq.measure(*qubits, key="m"))
+    repetitions = 20000
+    samples = SparseSimulator(seed=4).run(circuit, repetitions=repetitions)
+    counts = np.bincount(
+        [cirq.big_endian_bits_to_int(bits) for bits in samples.measurements["m"]],
+        minlength=8,
+    )
+    np.testing.assert_allclose(counts / repetitions, expected, atol=0.01)
+
+
+def test_channels_post_selection_drops_trajectories():
+    q0 = cirq.LineQubit(0)
+    circuit = cirq.Circuit(
+        cirq.bit_flip(0.5)(q0), PostSelectOperation(q0, 1), cirq.measure(q0, key="m")
+    )
+    samples = SparseSimulator(seed=5).run(circuit, repetitions=100)
+    assert np.all(samples.measurements["m"] == 1)
+
+    # Amplitude damping always resets the qubit to 0.
+    circuit = cirq.Circuit(
+        cirq.X(q0),
+        cirq.amplitude_damp(1)(q0),
+        PostSelectOperation(q0, 1),
+        cirq.measure(q0, key="m"),
+    )
+    with pytest.raises(InvalidPostSelectionError):
+        SparseSimulator().run(circuit)
+
+
+def test_noise_many_qubits():
+    qubits = cirq.LineQubit.range(30)
+    circuit = cirq.Circuit(
+        cirq.H(qubits[0]),
+        [cirq.CNOT(q0, q1) for q0, q1 in zip(qubits, qubits[1:])],
+        cirq.measure(*qubits, key="m"),
+    )
+    noise = cirq.ConstantQubitNoiseModel(cirq.bit_flip(0.001))
+    sim = SparseSimulator(seed=3, noise=noise)
+    samples = sim.run(circuit, repetitions=200).measurements["m"]
+    assert samples.shape == (200, 30)
+    errors = np.minimum(samples.sum(axis=1), 30 - samples.sum(axis=1))
+    assert 0 < np.count_nonzero(errors) < 200
+
+
+def test_noise_non_terminal_measurement():
+    q0 = cirq.LineQubit(0)
+    circuit = cirq.Circuit(
+        cirq.measure(q0, key="a"), cirq.X(q0), cirq.measure(q0, key="b")
+    )
+    sim = SparseSimulator(noise=cirq.depolarize(0.01))
+    with pytest.raises(ValueError, match="Only terminal measurements"):
+        sim.run(circuit)
+
+
+def test_copy():
+    q0, q1 = cirq.LineQubit.range(2)
+    state = SparseSimulator().simulate_state(cirq.Circuit(cirq.H(q0), cirq.I(q1)))
+    copy = state.copy()
+    cirq.act_on(cirq.CNOT(q0, q1), copy)
+    assert state.definite_value(q1) == 0
+    assert copy.definite_value(q1) is None
+
+
+def test_shared_prefix():
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    circuit1 = cirq.Circuit(cirq.H(q0), cirq.CNOT(q0, q1), cirq.X(q2), cirq.H(q2))
+    circuit2 = cirq.Circuit(cirq.X(q2), cirq.H(q0), cirq.Y(q2), cirq.CNOT(q0, q1))
+    shared, rests = _shared_prefix([circuit1, circuit2], lambda op: True)
+    assert shared == [cirq.H(q0), cirq.X(q2), cirq.CNOT(q0, q1)]
+    assert rests == [[cirq.H(q2)], [cirq.Y(q2)]]
+
+    shared, rests = _shared_prefix(
+        [circuit1], lambda op: op.gate != cirq.CNOT and op.gate != cirq.X
+    )
+    assert shared == [cirq.H(q0)]
+    assert rests == [[cirq.X(q2), cirq.CNOT(q0, q1), cirq.H(q2)]]
+
+
+def test_run_sweep_shared_prefix():
+    profiler = Profiler()
+    qubits = cirq.LineQubit.range(4)
+    t = sympy.Symbol("t")
+    circuit = cirq.Circuit(
+        cirq.H.on_each(*qubits[:3]),
+        [cirq.CNOT(q0, q1) for q0, q1 in zip(qubits, qubits[1:])],
+        cirq.X(qubits[3]) ** t,
+        cirq.measure(*qubits, key="m"),
+    )
+    sweep = cirq.Linspace(t, 0, 1, 3)
+    results = SparseSimulator(seed=1, profiler=profiler).run_sweep(
+        circuit, sweep, repetitions=5000
+    )
+    expected = cirq.Simulator(seed=1).run_sweep(circuit, sweep, repetitions=5000)
+    for result, expected_result in zip(results, expected):
+        assert result.params == expected_result.params
+        counts = np.bincount(result.data["m"], minlength=16)
+        expected_counts = np.bincount(expected_result.data["m"], minlength=16)
+        assert np.max(abs(counts - expected_counts)) < 300
+    # The operations before the parameterized gate are only applied once.
+    assert len(profiler.state_sizes["HPowGate"]) == 3
+    assert len(profiler.state_sizes["CXPowGate"]) == 3
+    assert len(profiler.state_sizes["XPowGate"]) == 3
+
+
+def test_run_batch_shared_prefix():
+    profiler = Profiler()
+    q0, q1 = cirq.LineQubit.range(2)
+    prefix = cirq.Circuit(cirq.H(q0), cirq.CNOT(q0, q1))
+    circuits = [
+        prefix + cirq.Circuit(cirq.X(q1), cirq.measure(q0, q1, key="m")),
+        prefix + cirq.Circuit(cirq.measure(q0, q1, key="m")),
+        prefix + cirq.Circuit(PostSelectOperation(q0, 1), cirq.measure(q1, key="m")),
+    ]
+    results = SparseSimulator(profiler=profiler).run_batch(circuits, repetitions=100)
+    assert set(map(tuple, results[0][0].measurements["m"])) == {(0, 1), (1, 0)}
+    assert set(map(tuple, results[1][0].measurements["m"])) == {(0, 0), (1, 1)}
+    assert set(map(tuple, results[2][0].measurements["m"])) == {(1,)}
+    assert len(profiler.state_sizes["HPowGate"]) == 1
+
+
+def test_expectation_values():
+    qubits = cirq.LineQubit.range(6)
+    circuit = random_circuit(
+        qubits=qubits, n_moments=15, op_density=0.7, random_state=4
+    )
+    prng = np.random.default_rng(0)
+    observables = []
+    for _ in range(5):
+        observable = cirq.PauliSum()
+        for _ in range(6):
+            observable += complex(prng.normal()) * cirq.PauliString(
+                {q: [cirq.X, cirq.Y, cirq.Z][prng.integers(3)] for q in qubits[:4]}
+            )
+        observables.append(observable)
+    result = SparseSimulator().simulate_expectation_values(
+        circuit, observables, qubit_order=qubits
+    )
+    expected = cirq.Simulator(dtype=np.complex128).simulate_expectation_values(
+        circuit, observables, qubit_order=qubits
+    )
+    np.testing.assert_allclose(result, expected, atol=1e-8)
+
+
+def test_expectation_values_post_selection():
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    circuit = cirq.Circuit(
+        cirq.H(q0), cirq.H(q1), cirq.CCX(q0, q1, q2), PostSelectOperation(q2, 0)
+    )
+    values = SparseSimulator().simulate_expectation_values(
+        circuit, [cirq.Z(q0) * cirq.Z(q1), cirq.X(q0), cirq.Z(q2), cirq.Z(q2) + 2]
+    )
+    np.testing.assert_allclose(values, [-1 / 3, 2 / 3, 1, 3], atol=1e-8)
+
+
+def test_expectation_values_terminal_measurements():
+    q0, q1 = cirq.LineQubit.range(2)
+    circuit = cirq.Circuit(cirq.H(q0), cirq.measure(q0, key="m"))
+    with pytest.raises(ValueError, match="terminal measurements"):
+        SparseSimulator().simulate_expectation_values(circuit, cirq.X(q0))
+    values = SparseSimulator().simulate_expectation_values(
+        circuit, [cirq.X(q0), cirq.Z(q1)], permit_terminal_measurements=True
+    )
+    np.testing.assert_allclose(values, [1, 1], atol=1e-8)
+
+
+@pytest.mark.parametrize("initial_state", [0, 1, 5, 6])
+def test_expectation_values_initial_state(initial_state):
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    circuit = cirq.Circuit(cirq.H(q0), cirq.CNOT(q0, q1), cirq.ry(0.4)(q2))
+    observables = [cirq.Z(q0), cirq.Z(q1) * cirq.Z(q2), cirq.X(q0) * cirq.X(q1)]
+    values = SparseSimulator().simulate_expectation_values(
+        circuit, observables, initial_state=initial_state
+    )
+    expected = cirq.Simulator().simulate_expectation_values(
+        circuit, observables, initial_state=initial_state
+    )
+    np.testing.assert_allclose(values, expected, atol=1e-6)
+
+    with pytest.raises(ValueError, match="out of range"):
+        SparseSimulator().simulate_expectation_values(
+            circuit, observables, initial_state=8
+        )
+    with pytest.raises(ValueError, match="Unsupported initial state"):
+        SparseSimulator().simulate_expectation_values(
+            circuit, observables, initial_state=np.eye(8)[initial_state]
+        )
+
+
+@pytest.mark.parametrize("max_qubits", [1, 2, 3])
+def test_fuse_operations(max_qubits):
+    qubits = cirq.LineQubit.range(6)
+    for seed in range(5):
+        circuit = random_circuit(
+            qubits=qubits, n_moments=20, op_density=0.6, random_state=seed
+        )
+        ops = list(circuit.all_operations())
+        fused = _fuse_operations(ops, max_qubits)
+        assert len(fused) < len(ops)
+        for op in fused:
+            if isinstance(op.gate, cirq.MatrixGate):
+                assert len(op.qubits) <= max_qubits
+        np.testing.assert_allclose(
+            cirq.Circuit(fused).unitary(qubit_order=qubits),
+            circuit.unitary(qubit_order=qubits),
+            atol=1e-8,
+        )
+
+
+def test_fuse_operations_barriers():
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    ops = [
+        cirq.H(q0),
+        cirq.CZ(q0, q1),
+        PostSelectOperation(q1, 1),
+        cirq.H(q1),
+        cirq.X(q0) ** 0.5,
+        cirq.measure(q0, key="m"),
+        cirq.Y(q0),
+        cirq.CCX(q0, q1, q2),
+        cirq.Z(q2),
+    ]
+    fused = _fuse_operations(ops, 2)
+    assert fused[1:] == ops[2:4] + ops[5:]
+    assert fused[0].qubits == (q0, q1)
+    np.testing.assert_allclose(
+        cirq.unitary(fused[0]), cirq.Circuit(ops[:2], ops[4]).unitary(), atol=1e-8
+    )
+
+
+def test_fuse_operations_permutations():
+    q0, q1 = cirq.LineQubit.range(2)
+    ops = [
+        cirq.H(q0),
+        cirq.X(q0),
+        cirq.H(q0),
+        cirq.CNOT(q0, q1),
+        cirq.CNOT(q1, q0),
+        cirq.X(q1) ** 1.0,
+        cirq.S(q1),
+        cirq.T(q1),
+    ]
+    # X and CNOT keep their fast path instead of being fused.
+    fused = _fuse_operations(ops, 2)
+    assert fused[:6] == ops[:6]
+    assert len(fused) == 7
+    np.testing.assert_allclose(
+        cirq.unitary(fused[6]), cirq.unitary(cirq.Circuit(ops[6:])), atol=1e-8
+    )
+    assert _fuse_operations(ops[1:6], 2) == ops[1:6]
+
+
+def _sorted_state(state):
+    order = np.argsort(state._states)
+    return state._states[order], state._amplitudes[order]
+
+
+def test_gate_fusion():
+    qubits = cirq.LineQubit.range(8)
+    circuit = random_circuit(
+        qubits=qubits, n_moments=20, op_density=0.6, random_state=8
+    )
+    circuit.append(
+        [
+            cirq.H(qubits[0]),
+            PostSelectOperation(qubits[0], 1),
+            cirq.CNOT(qubits[0], qubits[1]),
+            cirq.H(qubits[1]),
+        ]
+    )
+    profiler = Profiler()
+    simulator = SparseSimulator(profiler=profiler, max_fused_qubits=2)
+    states, amplitudes = _sorted_state(simulator.simulate_state(circuit, qubits))
+    expected_states, expected_amplitudes = _sorted_state(
+        SparseSimulator().simulate_state(circuit, qubits)
+    )
+    np.testing.assert_array_equal(states, expected_states)
+    np.testing.assert_allclose(amplitudes, expected_amplitudes, atol=1e-8)
+    # X and CNOT gates permute the basis states, the others need a matrix
+    # multiplication.
+    unfused_profiler = Profiler()
+    SparseSimulator(profiler=unfused_profiler).simulate_state(circuit, qubits)
+    for name in ("_PauliX", "CXPowGate"):
+        assert len(profiler.state_sizes[name]) == len(
+            unfused_profiler.state_sizes[name]
+        )
+    num_passes = sum(map(len, profiler.state_sizes.values()))
+    num_unfused_passes = sum(map(len, unfused_profiler.state_sizes.values()))
+    assert num_passes < 0.7 * num_unfused_passes
+
+
+def test_gate_fusion_run():
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    t = sympy.Symbol("t")
+    circuit = cirq.Circuit(
+        cirq.H(q0),
+        cirq.X(q1) ** t,
+        cirq.CNOT(q0, q1),
+        cirq.ISWAP(q0, q1) ** 0.5,
+        cirq.H(q0),
+        cirq.CNOT(q1, q2),
+        cirq.measure(q0, key="a"),
+        cirq.measure(q0, q1, q2, key="b"),
+    )
+    sweep = cirq.Points("t", [0, 0.5])
+    simulator = SparseSimulator(seed=3, max_fused_qubits=2)
+    results = simulator.run_sweep(circuit, sweep, repetitions=4000)
+    expected = cirq.Simulator(seed=3).run_sweep(circuit, sweep, repetitions=4000)
+    for result, expected_result in zip(results, expected):
+        for key in ("a", "b"):
+            counts = np.bincount(result.data[key], minlength=8)
+            expected_counts = np.bincount(expected_result.data[key], minlength=8)
+            assert np.max(abs(counts - expected_counts)) < 250
@@ -0,0 +1,166 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stabilizer simulator for Clifford circuits with post-selection.
+
+Clifford circuits (e.g. of `Superposition`, `Flip`, `Move`, `PhasedMove` and
+`quantum_if` effects with integer exponents) are simulated in polynomial time
+with a Clifford tableau, so worlds with hundreds of entangled qubits remain
+tractable.
+
+Does not work with non-Clifford gates or qudits.
+"""
+
+import cirq
+import numpy as np
+
+from unitary.alpha.sparse_vector_simulator import (
+    InvalidPostSelectionError,
+    PostSelectOperation,
+    SparseSimulatorStep,
+    _random_state,
+)
+
+
+class _ForcedOutcome:
+    """Stands in for the random state of a tableau measurement.
+
+    Measurements with a random outcome draw it with `randint`, so this
+    forces the outcome to the given value.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def randint(self, *args, **kwargs):
+        return self.value
+
+
+class StabilizerSimulationState(cirq.CliffordTableauSimulationState):
+    """Clifford tableau simulation supporting post-selection.
+
+    Sampling does not measure a copy of the tableau for every repetition.
+    The outcomes of measuring a stabilizer state in the computational basis
+    are uniformly distributed over an affine subspace: one outcome plus the
+    span of the X parts of the stabilizers.  So the tableau is measured once
+    and the other repetitions are random combinations of the stabilizers.
+    """
+
+    def __init__(self, qubits, prng=None, classical_data=None, initial_state=0):
+        super().__init__(
+            tableau=cirq.CliffordTableau(len(qubits), initial_state=initial_state),
+            prng=prng,
+            qubits=qubits,
+            classical_data=classical_data,
+        )
+
+    def post_select(self, qubit, value):
+        outcome = self.tableau._measure(self.qubit_map[qubit], _ForcedOutcome(value))
+        if outcome != value:
+            raise InvalidPostSelectionError(f"No states where {qubit} equals {value}")
+
+    def definite_value(self, qubit):
+        """Returns the value of the qubit if it is in a basis state, else None."""
+        if qubit not in self.qubit_map:
+            return 0
+        axis = self.qubit_map[qubit]
+        n = self.tableau.n
+        # The outcome is random if a stabilizer anticommutes with Z.
+        if np.any(self.tableau.xs[n : 2 * n, axis]):
+            return None
+        return int(self.tableau.copy()._measure(axis, _ForcedOutcome(0)))
+
+    def sample(self, qubits, repetitions=1, seed=None):
+        prng = cirq.value.parse_random_state(seed)
+        axes = self.get_axes(qubits)
+        tableau = self.tableau.copy()
+        offset = np.array(
+            [tableau._measure(axis, _ForcedOutcome(0)) for axis in axes],
+            dtype=np.int64,
+        )
+        n = self.tableau.n
+        directions = self.tableau.xs[n : 2 * n][:, axes].astype(np.int64)
+        coefficients = prng.randint(2, size=(repetitions, n))
+        return ((coefficients @ directions + offset) & 1).astype(np.uint8)
+
+
+class StabilizerSimulator(cirq.CliffordSimulator):
+    """Simulator for Clifford circuits that supports `PostSelectOperation`.
+
+    Can be used as the sampler of a `QuantumWorld` whose effects are all
+    Clifford.
+
+    Args:
+        seed: Seed of the random state used for sampling.  Can be anything
+            accepted by `SparseSimulator`.
+    """
+
+    # `PostSelectOperation`s are applied to the tableau, so `QuantumWorld`
+    # can add them to circuits.
+    supports_post_selection = True
+
+    def __init__(self, seed=None):
+        super().__init__(seed=_random_state(seed))
+
+    def simulate_state(self, program, qubit_order=cirq.QubitOrder.DEFAULT):
+        """Simulates a circuit without measurements and returns the final state.
+
+        Args:
+            program: The circuit to simulate.  It may contain post-selections
+                but no measurements.
+            qubit_order: Determines the canonical ordering of the qubits.
+
+        Returns:
+            The `StabilizerSimulationState` at the end of the circuit.
+        """
+        qubits = cirq.QubitOrder.as_qubit_order(qubit_order).order_for(
+            program.all_qubits()
+        )
+        state = self._create_partial_simulation_state(
+            0, qubits, cirq.ClassicalDataDictionaryStore()
+        )
+        for op in program.all_operations():
+            cirq.act_on(op, state)
+        return state
+
+    @staticmethod
+    def is_supported_operation(op: cirq.Operation) -> bool:
+        return isinstance(
+            op, PostSelectOperation
+        ) or cirq.CliffordSimulator.is_supported_operation(op)
+
+    # override
+    def _can_be_in_run_prefix(self, val):
+        return super()._can_be_in_run_prefix(val) or isinstance(
+            val, PostSelectOperation
+        )
+
+    # override
+    def _create_partial_simulation_state(self, initial_state, qubits, classical_data):
+        if isinstance(initial_state, StabilizerSimulationState):
+            return initial_state
+        return StabilizerSimulationState(
+            qubits=qubits,
+            prng=self._prng,
+            classical_data=classical_data,
+            initial_state=initial_state,
+        )
+
+    # override
+    def _create_step_result(self, sim_state):
+        return StabilizerSimulatorStep(sim_state=sim_state)
+
+
+class StabilizerSimulatorStep(SparseSimulatorStep):
+    """Step result of `StabilizerSimulator`."""
@@ -0,0 +1,148 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import enum
+
+import cirq
+import numpy as np
+import pytest
+from cirq.testing import random_circuit
+
+import unitary.alpha as alpha
+from unitary.alpha.sparse_vector_simulator import (
+    InvalidPostSelectionError,
+    PostSelectOperation,
+)
+from unitary.alpha.stabilizer_simulator import StabilizerSimulator
+
+
+class Light(enum.Enum):
+    RED = 0
+    GREEN = 1
+
+
+def _distribution(samples):
+    counts = collections.Counter(map(tuple, samples))
+    return {outcome: count / len(samples) for outcome, count in counts.items()}
+
+
+def test_simulation_fidelity():
+    """Check that the outcome distribution is the same as the Cirq simulator's."""
+    qubits = cirq.LineQubit.range(6)
+    circuit = random_circuit(
+        qubits=qubits,
+        n_moments=20,
+        op_density=0.5,
+        gate_domain={
+            cirq.X: 1,
+            cirq.H: 1,
+            cirq.S: 1,
+            cirq.Z: 1,
+            cirq.CNOT: 2,
+            cirq.SWAP: 2,
+            cirq.ISWAP: 2,
+            cirq.CZ: 2,
+        },
+        random_state=3,
+    )
+    circuit.append(cirq.measure(*qubits, key="m"))
+    repetitions = 20000
+    test_data = StabilizerSimulator(seed=1).run(circuit, repetitions=repetitions)
+    expected = abs(cirq.final_state_vector(circuit[:-1], qubit_order=qubits)) ** 2
+    distribution = _distribution(test_data.measurements["m"])
+    for outcome, probability in distribution.items():
+        index = cirq.big_endian_bits_to_int(outcome)
+        assert abs(probability - expected[index]) < 0.02
+    assert abs(sum(expected[expected > 1e-8]) - 1) < 1e-6
+    assert len(distribution) == np.count_nonzero(expected > 1e-8)
+
+
+def test_post_selection():
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    circuit = cirq.Circuit(
+        cirq.H(q0),
+        cirq.CNOT(q0, q1),
+        cirq.H(q2),
+        PostSelectOperation(q0, 1),
+        cirq.H(q0),
+        cirq.CNOT(q2, q0),
+        PostSelectOperation(q2, 1),
+        cirq.measure(q0, q1, q2, key="m"),
+    )
+    samples = StabilizerSimulator(seed=2).run(circuit, repetitions=1000)
+    distribution = _distribution(samples.measurements["m"])
+    assert set(distribution) == {(0, 1, 1), (1, 1, 1)}
+    assert abs(distribution[(0, 1, 1)] - 0.5) < 0.1
+
+
+def test_definite_value():
+    q0, q1, q2, q3 = cirq.LineQubit.range(4)
+    circuit = cirq.Circuit(
+        cirq.X(q0), cirq.H(q1), cirq.CNOT(q1, q2), PostSelectOperation(q2, 1)
+    )
+    state = StabilizerSimulator().simulate_state(circuit)
+    assert state.definite_value(q0) == 1
+    assert state.definite_value(q1) == 1
+    assert state.definite_value(q2) == 1
+    assert state.definite_value(q3) == 0
+
+    state = StabilizerSimulator().simulate_state(
+        cirq.Circuit(cirq.H(q1), cirq.CNOT(q1, q2))
+    )
+    assert state.definite_value(q1) is None
+    assert state.definite_value(q2) is None
+
+
+def test_invalid_post_selection():
+    q0 = cirq.LineQubit(0)
+    circuit = cirq.Circuit(
+        cirq.X(q0), PostSelectOperation(q0, 0), cirq.measure(q0, key="m")
+    )
+    with pytest.raises(InvalidPostSelectionError):
+        StabilizerSimulator().run(circuit)
+
+
+def test_seed():
+    qubits = cirq.LineQubit.range(10)
+    circuit = cirq.Circuit(cirq.H.on_each(*qubits), cirq.measure(*qubits, key="m"))
+    results = [
+        StabilizerSimulator(seed=np.random.SeedSequence(4))
+        .run(circuit, repetitions=5)
+        .measurements["m"]
+        for _ in range(2)
+    ]
+    np.testing.assert_array_equal(*results)
+
+
+def test_large_world():
+    """Entangle many pairs of objects, as in a BB84 key exchange."""
+    alice = [alpha.QuantumObject(f"a{idx}", Light.RED) for idx in range(100)]
+    bob = [alpha.QuantumObject(f"b{idx}", Light.RED) for idx in range(100)]
+    world = alpha.QuantumWorld(alice + bob, sampler=StabilizerSimulator(seed=5))
+    assert world.use_sparse
+    for a, b in zip(alice, bob):
+        alpha.Superposition()(a)
+        alpha.quantum_if(a).apply(alpha.Flip())(b)
+    alpha.PhasedMove()(alice[0], alice[1])
+    world.force_measurement(alice[2], Light.GREEN)
+
+    results = np.array(world.peek(count=50, convert_to_enum=False))
+    assert results.shape == (50, 200)
+    a_values = results[:, :100]
+    b_values = results[:, 100:]
+    np.testing.assert_array_equal(a_values[:, 2:], b_values[:, 2:])
+    assert (a_values[:, 2] == 1).all()
+    assert sorted(set(a_values[:, 3])) == [0, 1]
+    assert world.pop([bob[2]]) == [Light.GREEN]
@@ -0,0 +1,1018 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact binary save format for `QuantumWorld`.
+
+A saved world is a short header followed by length-prefixed sections, each
+identified by a four-letter tag:
+
+    CONF  options of the world
+    SAMP  kind of sampler of the world
+    QIDS  table of all qids, referenced by index everywhere else
+    OBJS  quantum objects
+    CIRC  circuit, as an operation log of gate-type codes and parameters
+    POST  post-selections
+    CLAS  classically tracked values
+    ANCI  ancilla names and counters
+    COMP  compiled qubits of qudits
+    REMP  qubit remapping history
+    HIST  effect history (optional)
+    DROP  ancillas dropped by resets, restored by undo (with the history)
+    STAT  sparse simulator state (optional)
+
+Common cirq and qudit gates are stored as a code and their numeric
+parameters.  Other cirq gates and operations fall back to `cirq.to_json`.
+Saving any other gate or operation raises an error: save files may come
+from untrusted players, so they never contain pickled objects.  Unknown
+sections are skipped, so that later versions can add sections without
+breaking older readers.
+
+The effect history is stored as differences: each entry only stores the
+moments and values that differ from the next entry (or from the world,
+for the last entry), so its size grows with the number of effects rather
+than with its square.
+"""
+
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+)
+import difflib
+import enum
+import io
+import os
+import struct
+
+import cirq
+import numpy as np
+
+from unitary.alpha import qudit_gates
+from unitary.alpha.auto_sampler import AutoSampler
+from unitary.alpha.mps_simulator import MPSSimulator
+from unitary.alpha.quantum_object import QuantumObject
+from unitary.alpha.quantum_world import QuantumWorld
+from unitary.alpha.sparse_vector_simulator import (
+    PostSelectOperation,
+    SparseSimulator,
+    SparseStateView,
+)
+from unitary.alpha.stabilizer_simulator import StabilizerSimulator
+
+_MAGIC = b"UQWORLD\x00"
+_VERSION = 1
+
+_SECTION_HEADER = struct.Struct("<4sQ")
+
+# Samplers recreated for loaded worlds, by the name stored in saves.
+_SAMPLERS: Dict[str, Callable[[], Union[str, cirq.Sampler]]] = {
+    "sparse": SparseSimulator,
+    "auto": lambda: "auto",
+    "mps": MPSSimulator,
+    "stabilizer": StabilizerSimulator,
+    "dense": cirq.Simulator,
+    "density_matrix": cirq.DensityMatrixSimulator,
+}
+_SAMPLER_NAMES = {
+    SparseSimulator: "sparse",
+    AutoSampler: "auto",
+    MPSSimulator: "mps",
+    StabilizerSimulator: "stabilizer",
+    cirq.Simulator: "dense",
+    cirq.DensityMatrixSimulator: "density_matrix",
+}
+
+# Kinds of qids in the qid table.
+_NAMED_QUBIT = 0
+_NAMED_QID = 1
+_LINE_QUBIT = 2
+_LINE_QID = 3
+_GRID_QUBIT = 4
+_GRID_QID = 5
+_JSON_QID = 255
+
+# Kinds of operations in the operation log.
+_GATE_OP = 0
+_CONTROLLED_OP = 1
+_POST_SELECT_OP = 2
+_JSON_OP = 3
+
+# Gates with special encodings.
+_MATRIX_GATE = 100
+_CONTROLLED_GATE = 101
+_JSON_GATE = 254
+
+
+def _qudit_rz_gate(dimension: int, exponent: float, phased_state: int):
+    return qudit_gates.QuditRzGate(dimension, exponent * np.pi, phased_state)
+
+
+# Gate code -> (gate type, struct format and attributes of the parameters,
+# factory taking the parameters as keyword arguments).
+_GATE_TYPES: Dict[int, Tuple[type, str, Tuple[str, ...], Callable[..., cirq.Gate]]] = {
+    1: (cirq.XPowGate, "<dd", ("exponent", "global_shift"), cirq.XPowGate),
+    2: (cirq.YPowGate, "<dd", ("exponent", "global_shift"), cirq.YPowGate),
+    3: (cirq.ZPowGate, "<dd", ("exponent", "global_shift"), cirq.ZPowGate),
+    4: (cirq.HPowGate, "<dd", ("exponent", "global_shift"), cirq.HPowGate),
+    5: (cirq.CXPowGate, "<dd", ("exponent", "global_shift"), cirq.CXPowGate),
+    6: (cirq.CZPowGate, "<dd", ("exponent", "global_shift"), cirq.CZPowGate),
+    7: (cirq.SwapPowGate, "<dd", ("exponent", "global_shift"), cirq.SwapPowGate),
+    8: (cirq.ISwapPowGate, "<dd", ("exponent", "global_shift"), cirq.ISwapPowGate),
+    9: (
+        cirq.PhasedISwapPowGate,
+        "<dd",
+        ("phase_exponent", "exponent"),
+        cirq.PhasedISwapPowGate,
+    ),
+    20: (
+        qudit_gates.QuditXGate,
+        "<III",
+        ("dimension", "source_state", "destination_state"),
+        qudit_gates.QuditXGate,
+    ),
+    21: (
+        qudit_gates.QuditPlusGate,
+        "<Ii",
+        ("dimension", "addend"),
+        qudit_gates.QuditPlusGate,
+    ),
+    22: (
+        qudit_gates.QuditHadamardGate,
+        "<I",
+        ("dimension",),
+        qudit_gates.QuditHadamardGate,
+    ),
+    23: (
+        qudit_gates.QuditControlledXGate,
+        "<III",
+        ("dimension", "control_state", "state"),
+        qudit_gates.QuditControlledXGate,
+    ),
+    24: (
+        qudit_gates.QuditSwapPowGate,
+        "<Id",
+        ("dimension", "exponent"),
+        qudit_gates.QuditSwapPowGate,
+    ),
+    25: (
+        qudit_gates.QuditISwapPowGate,
+        "<Id",
+        ("dimension", "exponent"),
+        qudit_gates.QuditISwapPowGate,
+    ),
+    26: (
+        qudit_gates.QuditRzGate,
+        "<IdI",
+        ("dimension", "exponent", "phased_state"),
+        _qudit_rz_gate,
+    ),
+}
+_GATE_CODES = {gate_type: code for code, (gate_type, *_) in _GATE_TYPES.items()}
+# The Pauli gates are subclasses of the corresponding power gates.
+_GATE_CODES.update({type(cirq.X): 1, type(cirq.Y): 2, type(cirq.Z): 3})
+
+# Decoded gates equal to these are replaced by them, so that checks such as
+# `op.gate is cirq.X` behave the same on loaded worlds.
+_CANONICAL_GATES = {
+    gate: gate
+    for gate in (
+        cirq.X,
+        cirq.Y,
+        cirq.Z,
+        cirq.H,
+        cirq.S,
+        cirq.T,
+        cirq.CNOT,
+        cirq.CZ,
+        cirq.SWAP,
+        cirq.ISWAP,
+    )
+}
+
+
+class _Writer:
+    """Appends little-endian values to a buffer."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def pack(self, fmt: str, *values) -> None:
+        self.buffer += struct.pack(fmt, *values)
+
+    def u8(self, value: int) -> None:
+        self.pack("<B", value)
+
+    def u32(self, value: int) -> None:
+        self.pack("<I", value)
+
+    def i64(self, value: int) -> None:
+        self.pack("<q", value)
+
+    def bytes(self, value: bytes) -> None:
+        self.u32(len(value))
+        self.buffer += value
+
+    def str(self, value: str) -> None:
+        self.bytes(value.encode())
+
+
+class _Reader:
+    """Reads values written by `_Writer` from a buffer."""
+
+    def __init__(self, buffer: bytes):
+        self.buffer = memoryview(buffer)
+        self.pos = 0
+
+    def unpack(self, fmt: str) -> Tuple:
+        values = struct.unpack_from(fmt, self.buffer, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def u8(self) -> int:
+        return self.unpack("<B")[0]
+
+    def u32(self) -> int:
+        return self.unpack("<I")[0]
+
+    def i64(self) -> int:
+        return self.unpack("<q")[0]
+
+    def bytes(self) -> bytes:
+        size = self.u32()
+        self.pos += size
+        return self.buffer[self.pos - size : self.pos].tobytes()
+
+    def str(self) -> str:
+        return self.bytes().decode()
+
+
+class _QidTable:
+    """Assigns indices to qids while writing."""
+
+    def __init__(self):
+        self.indices: Dict[cirq.Qid, int] = {}
+
+    def __call__(self, qid: cirq.Qid) -> int:
+        if qid not in self.indices:
+            self.indices[qid] = len(self.indices)
+        return self.indices[qid]
+
+    def encode(self) -> bytes:
+        w = _Writer()
+        w.u32(len(self.indices))
+        for qid in self.indices:
+            if type(qid) is cirq.NamedQubit:
+                w.u8(_NAMED_QUBIT)
+                w.str(qid.name)
+            elif type(qid) is cirq.NamedQid:
+                w.u8(_NAMED_QID)
+                w.str(qid.name)
+                w.u32(qid.dimension)
+            elif type(qid) is cirq.LineQubit:
+                w.u8(_LINE_QUBIT)
+                w.i64(qid.x)
+            elif type(qid) is cirq.LineQid:
+                w.u8(_LINE_QID)
+                w.i64(qid.x)
+                w.u32(qid.dimension)
+            elif type(qid) is cirq.GridQubit:
+                w.u8(_GRID_QUBIT)
+                w.pack("<qq", qid.row, qid.col)
+            elif type(qid) is cirq.GridQid:
+                w.u8(_GRID_QID)
+                w.pack("<qq", qid.row, qid.col)
+                w.u32(qid.dimension)
+            else:
+                w.u8(_JSON_QID)
+                w.str(cirq.to_json(qid))
+        return bytes(w.buffer)
+
+
+def _decode_qids(payload: bytes) -> List[cirq.Qid]:
+    r = _Reader(payload)
+    qids: List[cirq.Qid] = []
+    for _ in range(r.u32()):
+        kind = r.u8()
+        if kind == _NAMED_QUBIT:
+            qids.append(cirq.NamedQubit(r.str()))
+        elif kind == _NAMED_QID:
+            name = r.str()
+            qids.append(cirq.NamedQid(name, dimension=r.u32()))
+        elif kind == _LINE_QUBIT:
+            qids.append(cirq.LineQubit(r.i64()))
+        elif kind == _LINE_QID:
+            x = r.i64()
+            qids.append(cirq.LineQid(x, dimension=r.u32()))
+        elif kind == _GRID_QUBIT:
+            qids.append(cirq.GridQubit(*r.unpack("<qq")))
+        elif kind == _GRID_QID:
+            row, col = r.unpack("<qq")
+            qids.append(cirq.GridQid(row, col, dimension=r.u32()))
+        elif kind == _JSON_QID:
+            qids.append(cirq.read_json(json_text=r.str()))
+        else:
+            raise ValueError(f"Unknown qid kind {kind}.")
+    return qids
+
+
+def _encode_control_values(w: _Writer, control_values: cirq.ProductOfSums):
+    values = list(control_values)
+    w.u32(len(values))
+    for value in values:
+        w.u32(len(value))
+        for v in value:
+            w.u32(v)
+
+
+def _decode_control_values(r: _Reader) -> List[Tuple[int, ...]]:
+    return [tuple(r.u32() for _ in range(r.u32())) for _ in range(r.u32())]
+
+
+def _encode_gate(w: _Writer, gate: cirq.Gate) -> None:
+    code = _GATE_CODES.get(type(gate))
+    if code is not None:
+        _, fmt, attrs, _ = _GATE_TYPES[code]
+        try:
+            params = struct.pack(fmt, *[getattr(gate, attr) for attr in attrs])
+        except (struct.error, TypeError):
+            # Symbolic parameters.
+            pass
+        else:
+            w.u8(code)
+            w.buffer += params
+            return
+    if type(gate) is cirq.MatrixGate:
+        w.u8(_MATRIX_GATE)
+        qid_shape = cirq.qid_shape(gate)
+        w.u32(len(qid_shape))
+        for dim in qid_shape:
+            w.u32(dim)
+        w.buffer += np.asarray(cirq.unitary(gate), dtype="<c16").tobytes()
+    elif type(gate) is cirq.ControlledGate and isinstance(
+        gate.control_values, cirq.ProductOfSums
+    ):
+        w.u8(_CONTROLLED_GATE)
+        _encode_gate(w, gate.sub_gate)
+        _encode_control_values(w, gate.control_values)
+        for dim in gate.control_qid_shape:
+            w.u32(dim)
+    elif type(gate).__module__.startswith("cirq"):
+        w.u8(_JSON_GATE)
+        w.str(cirq.to_json(gate))
+    else:
+        raise ValueError(
+            f"Cannot save gate {gate!r} of type {type(gate).__name__}: only "
+            "cirq gates and the gates of unitary.alpha.qudit_gates can be saved."
+        )
+
+
+def _decode_gate(r: _Reader) -> cirq.Gate:
+    code = r.u8()
+    if code in _GATE_TYPES:
+        _, fmt, attrs, factory = _GATE_TYPES[code]
+        gate = factory(**dict(zip(attrs, r.unpack(fmt))))
+        return _CANONICAL_GATES.get(gate, gate)
+    if code == _MATRIX_GATE:
+        qid_shape = tuple(r.u32() for _ in range(r.u32()))
+        size = int(np.prod(qid_shape))
+        matrix = np.frombuffer(r.buffer, dtype="<c16", count=size * size, offset=r.pos)
+        r.pos += 16 * size * size
+        return cirq.MatrixGate(matrix.reshape(size, size), qid_shape=qid_shape)
+    if code == _CONTROLLED_GATE:
+        sub_gate = _decode_gate(r)
+        control_values = _decode_control_values(r)
+        control_qid_shape = tuple(r.u32() for _ in control_values)
+        return cirq.ControlledGate(
+            sub_gate,
+            num_controls=len(control_values),
+            control_values=control_values,
+            control_qid_shape=control_qid_shape,
+        )
+    if code == _JSON_GATE:
+        return cirq.read_json(json_text=r.str())
+    raise ValueError(f"Unknown gate code {code}.")
+
+
+def _encode_op(w: _Writer, op: cirq.Operation, qid_index: _QidTable) -> None:
+    if isinstance(op, PostSelectOperation):
+        w.u8(_POST_SELECT_OP)
+        w.u32(qid_index(op.qubit))
+        w.u32(op.value)
+    elif type(op) is cirq.GateOperation:
+        w.u8(_GATE_OP)
+        _encode_gate(w, op.gate)
+        w.u32(len(op.qubits))
+        for q in op.qubits:
+            w.u32(qid_index(q))
+    elif type(op) is cirq.ControlledOperation and isinstance(
+        op.control_values, cirq.ProductOfSums
+    ):
+        w.u8(_CONTROLLED_OP)
+        w.u32(len(op.controls))
+        for q in op.controls:
+            w.u32(qid_index(q))
+        _encode_control_values(w, op.control_values)
+        _encode_op(w, op.sub_operation, qid_index)
+    elif type(op).__module__.startswith("cirq"):
+        w.u8(_JSON_OP)
+        w.str(cirq.to_json(op))
+    else:
+        raise ValueError(
+            f"Cannot save operation {op!r} of type {type(op).__name__}: only "
+            "cirq operations and post-selections can be saved."
+        )
+
+
+def _decode_op(r: _Reader, qids: Sequence[cirq.Qid]) -> cirq.Operation:
+    kind = r.u8()
+    if kind == _POST_SELECT_OP:
+        qubit = qids[r.u32()]
+        return PostSelectOperation(qubit, r.u32())
+    if kind == _GATE_OP:
+        gate = _decode_gate(r)
+        return gate.on(*[qids[r.u32()] for _ in range(r.u32())])
+    if kind == _CONTROLLED_OP:
+        controls = [qids[r.u32()] for _ in range(r.u32())]
+        control_values = _decode_control_values(r)
+        sub_operation = _decode_op(r, qids)
+        return cirq.ControlledOperation(controls, sub_operation, control_values)
+    if kind == _JSON_OP:
+        return cirq.read_json(json_text=r.str())
+    raise ValueError(f"Unknown operation kind {kind}.")
+
+
+def _encode_circuit(w: _Writer, circuit: cirq.Circuit, qid_index: _QidTable) -> None:
+    w.u32(len(circuit))
+    for moment in circuit:
+        w.u32(len(moment))
+        for op in moment:
+            _encode_op(w, op, qid_index)
+
+
+def _decode_circuit(r: _Reader, qids: Sequence[cirq.Qid]) -> cirq.Circuit:
+    moments = []
+    for _ in range(r.u32()):
+        moments.append(cirq.Moment(_decode_op(r, qids) for _ in range(r.u32())))
+    return cirq.Circuit(moments)
+
+
+def _encode_circuit_delta(
+    w: _Writer,
+    circuit: cirq.Circuit,
+    reference: cirq.Circuit,
+    remaps: Sequence[Dict[cirq.Qid, cirq.Qid]],
+    remap_idx: Optional[int],
+    qid_index: _QidTable,
+) -> bool:
+    """Encodes a circuit as runs of moments copied from a reference and new moments.
+
+    Effects usually append moments to the circuit or change a few of them,
+    but remapping qubits changes every moment on the remapped qubits.  So
+    the reference may first be remapped with `remaps[remap_idx]`, if that
+    leaves fewer moments to store.
+
+    Returns:
+        Whether the remapping was used.
+    """
+    best = None
+    for idx in [None] if remap_idx is None else [None, remap_idx]:
+        moments = reference.moments
+        if idx is not None:
+            remap = remaps[idx]
+            moments = reference.transform_qubits(lambda q: remap.get(q, q)).moments
+        matcher = difflib.SequenceMatcher(None, moments, circuit.moments, False)
+        blocks = matcher.get_matching_blocks()
+        num_copied = sum(block.size for block in blocks)
+        if best is None or num_copied > best[0]:
+            best = (num_copied, idx, blocks)
+        if num_copied == len(circuit):
+            break
+    _, remap_idx, blocks = best
+    w.u32(0 if remap_idx is None else remap_idx + 1)
+    # Pairs of (start in the reference, number of moments to copy), or
+    # (None, moments to store).
+    runs: List[Tuple[Optional[int], Any]] = []
+    pos = 0
+    for block in blocks:
+        if block.b > pos:
+            runs.append((None, circuit[pos : block.b]))
+        if block.size:
+            runs.append((block.a, block.size))
+        pos = block.b + block.size
+    w.u32(len(runs))
+    for start, run in runs:
+        if start is None:
+            w.u8(1)
+            _encode_circuit(w, run, qid_index)
+        else:
+            w.u8(0)
+            w.pack("<II", start, run)
+    return remap_idx is not None
+
+
+def _decode_circuit_delta(
+    r: _Reader,
+    reference: cirq.Circuit,
+    remaps: Sequence[Dict[cirq.Qid, cirq.Qid]],
+    qids: Sequence[cirq.Qid],
+) -> cirq.Circuit:
+    remap_idx = r.u32()
+    if remap_idx:
+        remap = remaps[remap_idx - 1]
+        reference = reference.transform_qubits(lambda q: remap.get(q, q))
+    moments: List[cirq.Moment] = []
+    for _ in range(r.u32()):
+        if r.u8():
+            moments.extend(_decode_circuit(r, qids).moments)
+        else:
+            start, size = r.unpack("<II")
+            moments.extend(reference.moments[start : start + size])
+    return cirq.Circuit(moments)
+
+
+def _encode_values_delta(
+    w: _Writer,
+    values: Dict[Any, int],
+    reference: Dict[Any, int],
+    index: Callable[[Any], int],
+) -> None:
+    """Encodes values as the changes to make to a reference."""
+    _encode_values(
+        w,
+        {key: value for key, value in values.items() if reference.get(key) != value},
+        index,
+    )
+    removed = [key for key in reference if key not in values]
+    w.u32(len(removed))
+    for key in removed:
+        w.u32(index(key))
+
+
+def _decode_values_delta(
+    r: _Reader, reference: Dict[Any, int], keys: Sequence[Any]
+) -> Dict[Any, int]:
+    values = dict(reference)
+    values.update((keys[idx], value) for idx, value in _decode_values(r))
+    for _ in range(r.u32()):
+        del values[keys[r.u32()]]
+    return values
+
+
+def _encode_values(
+    w: _Writer, values: Dict[Any, int], index: Callable[[Any], int]
+) -> None:
+    w.u32(len(values))
+    for key, value in values.items():
+        w.pack("<Ii", index(key), value)
+
+
+def _decode_values(r: _Reader) -> List[Tuple[int, int]]:
+    return [r.unpack("<Ii") for _ in range(r.u32())]
+
+
+def _enum_path(enum_type: type) -> str:
+    if enum_type is int:
+        return ""
+    return f"{enum_type.__module__}:{enum_type.__qualname__}"
+
+
+def _enum_types_by_path(
+    enum_types: Iterable[Type[enum.Enum]],
+) -> Dict[str, Type[enum.Enum]]:
+    """Indexes the allowed enum types by the path stored in saved worlds.
+
+    Saved worlds only name the enum types of their objects.  They are never
+    imported from the file, which may come from an untrusted player, but
+    looked up among the types given by the caller.
+    """
+    types = {}
+    for enum_type in enum_types:
+        if not (isinstance(enum_type, type) and issubclass(enum_type, enum.Enum)):
+            raise TypeError(f"{enum_type!r} is not an enum type.")
+        types[_enum_path(enum_type)] = enum_type
+    return types
+
+
+def save_world(
+    world: QuantumWorld,
+    file: Union[str, os.PathLike, BinaryIO],
+    include_history: bool = True,
+    include_state: bool = False,
+) -> None:
+    """Saves a world in the binary format of this module.
+
+    The kind of sampler of the world is saved, but not its state (such as
+    its seed).
+
+    Args:
+        world: The world to save.
+        file: Path or binary file object to write to.
+        include_history: Whether to save the effect history needed to undo
+            effects.
+        include_state: Whether to save the final state of the circuit, which
+            requires the sampler of the world to be a `SparseSimulator`.  The
+            state can be read back with `WorldReader.state`.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "wb") as f:
+            save_world(world, f, include_history, include_state)
+        return
+
+    qid_index = _QidTable()
+    objects = list(world.object_name_dict.values())
+    if include_history:
+        # The effect history can refer to ancillas dropped by resets.
+        for _, ancillas, _ in world.dropped_ancillas:
+            objects.extend(ancillas)
+    names = {obj: idx for idx, obj in enumerate(objects)}
+    sections: List[Tuple[bytes, bytes]] = []
+
+    w = _Writer()
+    w.u32(len(names))
+    for obj in names:
+        w.str(obj.name)
+        w.u32(qid_index(obj.qubit))
+        w.pack("<II", obj.initial_state, obj.num_states)
+        w.str(_enum_path(obj.enum_type))
+    sections.append((b"OBJS", w.buffer))
+
+    w = _Writer()
+    _encode_circuit(w, world.circuit, qid_index)
+    sections.append((b"CIRC", w.buffer))
+
+    w = _Writer()
+    _encode_values(w, world.post_selection, names.__getitem__)
+    sections.append((b"POST", w.buffer))
+
+    w = _Writer()
+    _encode_values(w, world.classical_values, qid_index)
+    sections.append((b"CLAS", w.buffer))
+
+    w = _Writer()
+    w.u32(len(world.ancilla_names))
+    for name in sorted(world.ancilla_names):
+        w.str(name)
+    w.u32(len(world.ancilla_counts))
+    for namespace, count in world.ancilla_counts.items():
+        w.str(namespace)
+        w.u32(count)
+    sections.append((b"ANCI", w.buffer))
+
+    w = _Writer()
+    w.u32(len(world.compiled_qubits))
+    for qid, compiled in world.compiled_qubits.items():
+        w.u32(qid_index(qid))
+        w.u32(len(compiled))
+        for q in compiled:
+            w.u32(qid_index(q))
+    sections.append((b"COMP", w.buffer))
+
+    w = _Writer()
+    w.u32(len(world.qubit_remapping_dict))
+    for remap in world.qubit_remapping_dict:
+        _encode_values(w, {qid_index(k): qid_index(v) for k, v in remap.items()}, int)
+    w.u32(len(world.qubit_remapping_dict_length))
+    for length in world.qubit_remapping_dict_length:
+        w.u32(length)
+    sections.append((b"REMP", w.buffer))
+
+    if include_history:
+        w = _Writer()
+        w.u32(len(world.effect_history))
+        # Entries are stored from the last one, each relative to the next.
+        reference = (world.circuit, world.post_selection, world.classical_values)
+        # Remappings are undone in the reverse order of the effects.
+        remap_idx = len(world.qubit_remapping_dict) - 1
+        for entry in reversed(world.effect_history):
+            circuit, post_selection, classical_values = entry
+            if _encode_circuit_delta(
+                w,
+                circuit,
+                reference[0],
+                world.qubit_remapping_dict,
+                remap_idx if remap_idx >= 0 else None,
+                qid_index,
+            ):
+                remap_idx -= 1
+            _encode_values_delta(w, post_selection, reference[1], names.__getitem__)
+            _encode_values_delta(w, classical_values, reference[2], qid_index)
+            reference = entry
+        w.u32(len(world.effect_history_length))
+        for length in world.effect_history_length:
+            w.u32(length)
+        sections.append((b"HIST", w.buffer))
+
+        if world.dropped_ancillas:
+            w = _Writer()
+            w.u32(len(world.dropped_ancillas))
+            for history_length, ancillas, compiled_qubits in world.dropped_ancillas:
+                w.u32(history_length)
+                w.u32(len(ancillas))
+                for obj in ancillas:
+                    w.u32(names[obj])
+                w.u32(len(compiled_qubits))
+                for qid, compiled in compiled_qubits.items():
+                    w.u32(qid_index(qid))
+                    w.u32(len(compiled))
+                    for q in compiled:
+                        w.u32(qid_index(q))
+            sections.append((b"DROP", w.buffer))
+
+    if include_state:
+        if not isinstance(world.sampler, SparseSimulator):
+            raise ValueError("Saving the state requires a SparseSimulator sampler.")
+        state = world.sampler.simulate_state(world.circuit)
+        w = _Writer()
+        w.u32(len(state.qubits))
+        for q in state.qubits:
+            w.u32(qid_index(q))
+        exported = np.zeros(state.export_size(), dtype=np.uint8)
+        state.export_to(exported)
+        w.buffer += exported.tobytes()
+        sections.append((b"STAT", w.buffer))
+
+    conf = _Writer()
+    conf.pack(
+        "<BBBBiI",
+        world.compile_to_qubits,
+        world.track_classical,
+        world.auto_reset,
+        world.compact_every is not None,
+        world.compact_every or 0,
+        world.effects_since_compaction,
+    )
+    samp = _Writer()
+    samp.u8(world.use_sparse)
+    samp.str(_SAMPLER_NAMES.get(type(world.sampler), ""))
+    sections = [
+        (b"CONF", conf.buffer),
+        (b"SAMP", samp.buffer),
+        (b"QIDS", qid_index.encode()),
+    ] + sections
+
+    file.write(_MAGIC)
+    file.write(struct.pack("<I", _VERSION))
+    for tag, payload in sections:
+        file.write(_SECTION_HEADER.pack(tag, len(payload)))
+        file.write(payload)
+
+
+class WorldReader:
+    """Reads a world saved by `save_world`.
+
+    Only the section headers are read when the reader is created.  Each
+    section is read and decoded when it is first needed, so for instance the
+    effect history or the simulator state are never loaded if they are not
+    used.  When reading from a path, the simulator state is memory-mapped
+    instead of read.
+
+    Args:
+        file: Path or seekable binary file object to read from.  A file
+            object is read from its current position and must stay open
+            while the reader is used.
+    """
+
+    def __init__(self, file: Union[str, os.PathLike, BinaryIO]):
+        self._path: Optional[Union[str, os.PathLike]] = None
+        if isinstance(file, (str, os.PathLike)):
+            self._path = file
+            file = open(file, "rb")
+        self._file = file
+        if file.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("Not a saved QuantumWorld.")
+        (self.version,) = struct.unpack("<I", file.read(4))
+        if self.version > _VERSION:
+            raise ValueError(f"Unsupported QuantumWorld save version {self.version}.")
+        self._sections: Dict[str, Tuple[int, int]] = {}
+        while True:
+            header = file.read(_SECTION_HEADER.size)
+            if not header:
+                break
+            tag, size = _SECTION_HEADER.unpack(header)
+            self._sections[tag.decode()] = (file.tell(), size)
+            file.seek(size, io.SEEK_CUR)
+        self._qids: Optional[List[cirq.Qid]] = None
+
+    def close(self) -> None:
+        if self._path is not None:
+            self._file.close()
+
+    def __enter__(self) -> "WorldReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def sections(self) -> List[str]:
+        """Tags of the sections in the file."""
+        return list(self._sections)
+
+    def _reader(self, tag: str) -> _Reader:
+        offset, size = self._sections[tag]
+        self._file.seek(offset)
+        return _Reader(self._file.read(size))
+
+    def _qid_table(self) -> List[cirq.Qid]:
+        if self._qids is None:
+            offset, size = self._sections["QIDS"]
+            self._file.seek(offset)
+            self._qids = _decode_qids(self._file.read(size))
+        return self._qids
+
+    def circuit(self) -> cirq.Circuit:
+        """Returns the circuit of the world."""
+        return _decode_circuit(self._reader("CIRC"), self._qid_table())
+
+    def state(self, **kwargs) -> Optional[SparseStateView]:
+        """Returns the saved simulator state, or None if it was not saved.
+
+        Keyword arguments are passed to `SparseStateView`.
+        """
+        if "STAT" not in self._sections:
+            return None
+        qids = self._qid_table()
+        offset, size = self._sections["STAT"]
+        self._file.seek(offset)
+        (num_qubits,) = struct.unpack("<I", self._file.read(4))
+        index_size = 4 * num_qubits
+        indices = struct.unpack(f"<{num_qubits}I", self._file.read(index_size))
+        qubits = [qids[idx] for idx in indices]
+        state_offset = offset + 4 + index_size
+        state_size = size - 4 - index_size
+        if self._path is not None:
+            buffer = np.memmap(
+                self._path,
+                dtype=np.uint8,
+                mode="r",
+                offset=state_offset,
+                shape=(state_size,),
+            )
+        else:
+            buffer = self._file.read(state_size)
+        return SparseStateView(buffer, qubits, **kwargs)
+
+    def world(
+        self,
+        sampler: Optional[cirq.Sampler] = None,
+        include_history: bool = True,
+        enum_types: Iterable[Type[enum.Enum]] = (),
+    ) -> QuantumWorld:
+        """Builds the saved world.
+
+        Objects whose enum type is not in `enum_types` are restored with
+        integer states.
+
+        Args:
+            sampler: Sampler of the world.  Defaults to a new sampler of the
+                kind the world was saved with (`SparseSimulator` or
+                `cirq.Simulator` for other samplers, depending on whether
+                they support post-selection).  A given sampler must support
+                post-selection if and only if the saved sampler did, since
+                this decides whether post-selections are in the circuit.
+            include_history: Whether to restore the effect history, if saved.
+            enum_types: Enum types of the objects of the world.
+        """
+        types_by_path = _enum_types_by_path(enum_types)
+        qids = self._qid_table()
+        (
+            compile_to_qubits,
+            track_classical,
+            auto_reset,
+            has_compact_every,
+            compact_every,
+            effects_since_compaction,
+        ) = self._reader("CONF").unpack("<BBBBiI")
+        r = self._reader("SAMP")
+        use_sparse = bool(r.u8())
+        if sampler is None:
+            factory = _SAMPLERS.get(r.str())
+            if factory is not None:
+                sampler = factory()
+            else:
+                sampler = SparseSimulator() if use_sparse else cirq.Simulator()
+        elif getattr(sampler, "supports_post_selection", False) != use_sparse:
+            raise ValueError(
+                "The sampler must support post-selection if and only if the "
+                "sampler of the saved world did."
+            )
+        world = QuantumWorld(
+            sampler=sampler,
+            compile_to_qubits=bool(compile_to_qubits),
+            compact_every=compact_every if has_compact_every else None,
+            track_classical=bool(track_classical),
+            auto_reset=bool(auto_reset),
+        )
+        world.effects_since_compaction = effects_since_compaction
+
+        r = self._reader("OBJS")
+        objects = []
+        for _ in range(r.u32()):
+            name = r.str()
+            qid = qids[r.u32()]
+            initial_state, num_states = r.unpack("<II")
+            enum_type = types_by_path.get(r.str())
+            if enum_type is not None:
+                obj = QuantumObject(name, enum_type(initial_state))
+            else:
+                obj = QuantumObject(name, initial_state)
+                obj.num_states = num_states
+            obj.qubit = qid
+            obj.world = world
+            world.object_name_dict[name] = obj
+            objects.append(obj)
+
+        world.circuit = self.circuit()
+        r = self._reader("POST")
+        world.post_selection = {objects[idx]: value for idx, value in _decode_values(r)}
+        r = self._reader("CLAS")
+        world.classical_values = {qids[idx]: value for idx, value in _decode_values(r)}
+
+        r = self._reader("ANCI")
+        world.ancilla_names = {r.str() for _ in range(r.u32())}
+        for _ in range(r.u32()):
+            namespace = r.str()
+            world.ancilla_counts[namespace] = r.u32()
+
+        r = self._reader("COMP")
+        for _ in range(r.u32()):
+            qid = qids[r.u32()]
+            world.compiled_qubits[qid] = [qids[r.u32()] for _ in range(r.u32())]
+
+        r = self._reader("REMP")
+        for _ in range(r.u32()):
+            world.qubit_remapping_dict.append(
+                {qids[k]: qids[v] for k, v in _decode_values(r)}
+            )
+        world.qubit_remapping_dict_length = [r.u32() for _ in range(r.u32())]
+
+        if include_history and "HIST" in self._sections:
+            r = self._reader("HIST")
+            reference = (world.circuit, world.post_selection, world.classical_values)
+            for _ in range(r.u32()):
+                reference = (
+                    _decode_circuit_delta(
+                        r, reference[0], world.qubit_remapping_dict, qids
+                    ),
+                    _decode_values_delta(r, reference[1], objects),
+                    _decode_values_delta(r, reference[2], qids),
+                )
+                world.effect_history.append(reference)
+            world.effect_history.reverse()
+            world.effect_history_length = [r.u32() for _ in range(r.u32())]
+
+        if "DROP" in self._sections:
+            r = self._reader("DROP")
+            for _ in range(r.u32()):
+                history_length = r.u32()
+                ancillas = [objects[r.u32()] for _ in range(r.u32())]
+                compiled_qubits = {}
+                for _ in range(r.u32()):
+                    qid = qids[r.u32()]
+                    compiled_qubits[qid] = [qids[r.u32()] for _ in range(r.u32())]
+                for obj in ancillas:
+                    del world.object_name_dict[obj.name]
+                if include_history and "HIST" in self._sections:
+                    world.dropped_ancillas.append(
+                        (history_length, ancillas, compiled_qubits)
+                    )
+        return world
+
+
+def load_world(
+    file: Union[str, os.PathLike, BinaryIO],
+    sampler: Optional[cirq.Sampler] = None,
+    include_history: bool = True,
+    enum_types: Iterable[Type[enum.Enum]] = (),
+) -> QuantumWorld:
+    """Loads a world saved by `save_world`.
+
+    See `WorldReader.world` for the arguments, and `WorldReader` to only
+    read parts of a saved world.
+    """
+    reader = WorldReader(file)
+    try:
+        return reader.world(
+            sampler=sampler, include_history=include_history, enum_types=enum_types
+        )
+    finally:
+        reader.close()
@@ -0,0 +1,320 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import enum
+import io
+import os
+
+import cirq
+import numpy as np
+import pytest
+
+import unitary.alpha as alpha
+from unitary.alpha import qudit_gates
+
+
+class Light(enum.Enum):
+    RED = 0
+    GREEN = 1
+
+
+class StopLight(enum.Enum):
+    RED = 0
+    YELLOW = 1
+    GREEN = 2
+
+
+class CustomGate(cirq.Gate):
+    """Gate that is neither coded nor a cirq gate."""
+
+    def _num_qubits_(self):
+        return 1
+
+    def _unitary_(self):
+        return cirq.unitary(cirq.Y)
+
+
+def _assert_same_circuit(actual, expected):
+    assert len(actual) == len(expected)
+    for moment, expected_moment in zip(actual, expected):
+        assert len(moment) == len(expected_moment)
+        for op, expected_op in zip(moment, expected_moment):
+            assert type(op) == type(expected_op)
+            assert op.qubits == expected_op.qubits
+            if isinstance(op, alpha.sparse_vector_simulator.PostSelectOperation):
+                assert op.value == expected_op.value
+            else:
+                np.testing.assert_allclose(
+                    cirq.unitary(op), cirq.unitary(expected_op), atol=1e-8
+                )
+
+
+def _save_and_load(world, **kwargs):
+    buffer = io.BytesIO()
+    alpha.save_world(world, buffer)
+    buffer.seek(0)
+    return alpha.load_world(buffer, enum_types=[Light, StopLight], **kwargs)
+
+
+@pytest.mark.parametrize(
+    ("simulator", "compile_to_qubits"),
+    [
+        (cirq.Simulator, False),
+        (cirq.Simulator, True),
+        (alpha.SparseSimulator, True),
+    ],
+)
+def test_round_trip(simulator, compile_to_qubits):
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", StopLight.YELLOW)
+    light4 = alpha.QuantumObject("l4", Light.RED)
+    world = alpha.QuantumWorld(
+        [light1, light2, light3, light4],
+        sampler=simulator(),
+        compile_to_qubits=compile_to_qubits,
+    )
+    alpha.Superposition()(light1)
+    alpha.quantum_if(light1).equals(0).apply(alpha.Flip())(light2)
+    alpha.PhasedSplit()(light2, light1, light4)
+    alpha.Cycle()(light3)
+    world.pop([light1])
+    world.unhook(light2)
+    world.add_effect([cirq.PhasedXPowGate(phase_exponent=0.5).on(light2.qubit)])
+
+    loaded = _save_and_load(world, sampler=simulator())
+    assert loaded.compile_to_qubits == compile_to_qubits
+    assert [obj.name for obj in loaded.objects] == [obj.name for obj in world.objects]
+    assert loaded["l3"].enum_type == StopLight
+    assert loaded.ancilla_names == world.ancilla_names
+    assert loaded.ancilla_counts == world.ancilla_counts
+    assert {obj.name: v for obj, v in loaded.post_selection.items()} == {
+        obj.name: v for obj, v in world.post_selection.items()
+    }
+    assert loaded.compiled_qubits == world.compiled_qubits
+    assert loaded.qubit_remapping_dict == world.qubit_remapping_dict
+    assert len(loaded.effect_history) == len(world.effect_history)
+    _assert_same_circuit(loaded.circuit, world.circuit)
+    assert loaded.peek(["l1", "l2", "l3"], count=20) == world.peek(
+        [light1, light2, light3], count=20
+    )
+
+    loaded.undo_last_effect()
+    world.undo_last_effect()
+    _assert_same_circuit(loaded.circuit, world.circuit)
+    assert loaded.pop([light3.name]) == [StopLight.GREEN]
+
+
+@pytest.mark.parametrize(
+    "sampler",
+    [None, "auto", cirq.Simulator(), alpha.MPSSimulator(), alpha.StabilizerSimulator()],
+)
+def test_sampler(sampler):
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    world = alpha.QuantumWorld([light1, light2], sampler=sampler)
+    alpha.Superposition()(light1)
+    alpha.quantum_if(light1).apply(alpha.Flip())(light2)
+    popped = world.pop([light1])
+
+    loaded = _save_and_load(world)
+    assert type(loaded.sampler) == type(world.sampler)
+    assert loaded.use_sparse == world.use_sparse
+    assert loaded.peek([light2.name], count=10) == [popped] * 10
+
+    other = alpha.SparseSimulator() if not world.use_sparse else cirq.Simulator()
+    with pytest.raises(ValueError, match="post-selection"):
+        _save_and_load(world, sampler=other)
+
+
+def test_gate_encoding():
+    q0, q1, q2 = cirq.LineQubit.range(3)
+    t0 = cirq.LineQid(3, dimension=3)
+    t1 = cirq.NamedQid("t", dimension=3)
+    circuit = cirq.Circuit(
+        cirq.X(q0) ** 0.5,
+        cirq.ZPowGate(exponent=0.25, global_shift=-0.5).on(q1),
+        cirq.CNOT(q0, q1),
+        cirq.ISWAP(q1, q2) ** 0.5,
+        cirq.PhasedISwapPowGate(phase_exponent=0.25, exponent=0.5).on(q0, q2),
+        cirq.MatrixGate(cirq.unitary(cirq.H)).on(q2),
+        cirq.H(q2).controlled_by(q0, q1, control_values=[0, 1]),
+        cirq.ControlledGate(cirq.Y, control_values=[0]).on(q0, q2),
+        cirq.CCZ(q0, q1, q2),
+        qudit_gates.QuditPlusGate(3, 2).on(t0),
+        qudit_gates.QuditRzGate(3, 0.5, 1).on(t1),
+        qudit_gates.QuditSwapPowGate(3, 0.5).on(t0, t1),
+        alpha.sparse_vector_simulator.PostSelectOperation(q2, 1),
+    )
+    world = alpha.QuantumWorld(sampler=cirq.Simulator())
+    world.circuit = circuit
+    loaded = _save_and_load(world)
+    _assert_same_circuit(loaded.circuit, circuit)
+
+
+def test_canonical_gates():
+    q0, q1 = cirq.LineQubit.range(2)
+    circuit = cirq.Circuit(
+        cirq.X(q0),
+        cirq.H(q1),
+        cirq.CNOT(q0, q1),
+        cirq.XPowGate(exponent=1.0).on(q1),
+        cirq.X(q0) ** 0.5,
+    )
+    world = alpha.QuantumWorld(sampler=cirq.Simulator())
+    world.circuit = circuit
+    gates = [op.gate for op in _save_and_load(world).circuit.all_operations()]
+    assert gates[0] is cirq.X
+    assert gates[1] is cirq.H
+    assert gates[2] is cirq.CNOT
+    assert gates[3] is cirq.X
+    assert gates[4] == cirq.X**0.5
+
+
+def test_unsupported_gate():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    world = alpha.QuantumWorld([light], sampler=cirq.Simulator())
+    world.add_effect([CustomGate().on(light.qubit)])
+    with pytest.raises(ValueError, match="Cannot save gate"):
+        alpha.save_world(world, io.BytesIO())
+
+
+def test_history_size():
+    def history_size(num_effects):
+        lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(4)]
+        world = alpha.QuantumWorld(lights, sampler=alpha.SparseSimulator())
+        for idx in range(num_effects):
+            alpha.Flip(effect_fraction=0.5)(lights[idx % 4])
+            if idx % 10 == 0:
+                world.force_measurement(lights[idx % 4], Light.GREEN)
+        buffer = io.BytesIO()
+        alpha.save_world(world, buffer)
+        buffer.seek(0)
+        loaded = alpha.load_world(buffer, enum_types=[Light])
+        assert len(loaded.effect_history) == len(world.effect_history)
+        for entry, expected in zip(loaded.effect_history, world.effect_history):
+            _assert_same_circuit(entry[0], expected[0])
+            assert {obj.name: v for obj, v in entry[1].items()} == {
+                obj.name: v for obj, v in expected[1].items()
+            }
+            assert entry[2] == expected[2]
+        for _ in range(num_effects // 2):
+            loaded.undo_last_effect()
+            world.undo_last_effect()
+        _assert_same_circuit(loaded.circuit, world.circuit)
+        return len(buffer.getvalue())
+
+    assert history_size(80) < 2.5 * history_size(40)
+
+
+def test_dropped_ancillas():
+    lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(3)]
+    world = alpha.QuantumWorld(lights, sampler=alpha.SparseSimulator(), auto_reset=True)
+    alpha.Split()(*lights)
+    world.pop(lights[1:])
+    assert world.ancilla_names == set()
+
+    loaded = _save_and_load(world, include_history=False)
+    assert [obj.name for obj in loaded.objects] == ["l0", "l1", "l2"]
+    assert loaded.effect_history == []
+
+    loaded = _save_and_load(world)
+    assert [obj.name for obj in loaded.objects] == ["l0", "l1", "l2"]
+    loaded.undo_last_effect()
+    world.undo_last_effect()
+    assert sorted(loaded.ancilla_names) == sorted(world.ancilla_names)
+    assert len(loaded.ancilla_names) == 2
+    assert {obj.name: v for obj, v in loaded.post_selection.items()} == {
+        obj.name: v for obj, v in world.post_selection.items()
+    }
+
+
+def test_save_state(tmp_path):
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", 0)
+    world = alpha.QuantumWorld([light1, light2, light3])
+    alpha.Split()(light1, light2, light3)
+    path = tmp_path / "world.bin"
+    alpha.save_world(world, path, include_history=False, include_state=True)
+
+    with alpha.WorldReader(path) as reader:
+        assert "STAT" in reader.sections
+        assert "HIST" not in reader.sections
+        state = reader.state()
+        samples = state.sample(
+            [light1.qubit, light2.qubit, light3.qubit], repetitions=100
+        )
+        assert all(sum(row) == 1 and row[0] == 0 for row in samples)
+        loaded = reader.world(enum_types=[Light])
+        assert loaded.effect_history == []
+
+    with pytest.raises(ValueError, match="SparseSimulator"):
+        alpha.save_world(
+            alpha.QuantumWorld(sampler=cirq.Simulator()),
+            io.BytesIO(),
+            include_state=True,
+        )
+
+
+def test_lazy_reader():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    world = alpha.QuantumWorld([light], track_classical=True, compact_every=10)
+    alpha.Flip()(light)
+    buffer = io.BytesIO()
+    alpha.save_world(world, buffer)
+    buffer.seek(0)
+    reader = alpha.WorldReader(buffer)
+    assert reader.sections[:3] == ["CONF", "SAMP", "QIDS"]
+    assert reader.state() is None
+    loaded = reader.world(include_history=False, enum_types=[Light])
+    assert loaded.effect_history == []
+    assert loaded.track_classical
+    assert loaded.compact_every == 10
+    assert loaded.classical_values == {light.qubit: 0}
+    assert loaded.peek() == [[Light.RED]]
+
+    with pytest.raises(ValueError, match="Not a saved QuantumWorld"):
+        alpha.WorldReader(io.BytesIO(b"not a world"))
+
+
+def test_unknown_enum():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    world = alpha.QuantumWorld([light])
+    buffer = io.BytesIO()
+    alpha.save_world(world, buffer)
+    data = buffer.getvalue().replace(b"Light", b"Ghost")
+    loaded = alpha.load_world(io.BytesIO(data), enum_types=[Light])
+    assert loaded["l1"].enum_type == int
+    assert loaded.peek() == [[1]]
+
+    with pytest.raises(TypeError, match="enum"):
+        alpha.load_world(io.BytesIO(buffer.getvalue()), enum_types=[os._exit])
+
+
+def test_enum_types_not_imported():
+    class Exit(enum.Enum):
+        ZERO = 0
+        ONE = 1
+
+    # A save file naming a function instead of an enum type.
+    Exit.__module__ = "os"
+    Exit.__qualname__ = "_exit"
+    world = alpha.QuantumWorld([alpha.QuantumObject("l1", Exit.ONE)])
+    buffer = io.BytesIO()
+    alpha.save_world(world, buffer)
+    buffer.seek(0)
+    loaded = alpha.load_world(buffer)
+    assert loaded["l1"].enum_type == int
+    assert loaded.peek() == [[1]]
@@ -27,6 +27,8 @@ import cirq_google as cg
 from cirq import work, study, circuits, ops
 from cirq_google.engine.engine_job import TERMINAL_STATES
 
+from unitary.alpha.sparse_vector_simulator import SparseSimulator
+
 
 def _get_program_id(program: Any):
     """Get a program id from program.program_id.
@@ -325,6 +327,19 @@ QUANTUM_PROCESSORS = {
             )
         ),
     ),
+    "Syc54-trajectories": QuantumProcessor(
+        # Same noise as Syc54-simulator, sampled with quantum trajectories so
+        # that boards with many qubits remain tractable.
+        name="Syc54-trajectories",
+        device_obj=cg.Sycamore,
+        processor_id=None,
+        is_simulator=True,
+        _get_sampler_func=lambda x, gs: SparseSimulator(
+            noise=cirq.ConstantQubitNoiseModel(
+                qubit_noise_gate=cirq.DepolarizingChannel(0.005)
+            )
+        ),
+    ),
     "Syc54-zeros": QuantumProcessor(
         name="Syc54-zeros",
         device_obj=cg.Sycamore,
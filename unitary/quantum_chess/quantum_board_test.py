@@ -30,6 +30,7 @@ from unitary.quantum_chess.test_utils import (
     assert_prob_about,
     assert_fifty_fifty,
 )
+from unitary.alpha.sparse_vector_simulator import SparseSimulator
 from unitary.quantum_chess.bit_utils import bit_to_qubit, square_to_bit, nth_bit_of
 from unitary.quantum_chess.caching_utils import CacheKey
 
@@ -66,6 +67,21 @@ def syc23_noisy(state):
     )
 
 
+def syc54_noisy(state):
+    return qb.CirqBoard(
+        state,
+        sampler=SparseSimulator(
+            noise=cirq.ConstantQubitNoiseModel(
+                qubit_noise_gate=cirq.DepolarizingChannel(0.005)
+            ),
+            seed=get_seed(),
+        ),
+        device=utils.get_device_obj_by_name("Syc54-trajectories"),
+        error_mitigation=enums.ErrorMitigation.Correct,
+        noise_mitigation=0.10,
+    )
+
+
 def syc23_noiseless(state):
     np.random.seed(get_seed())
     return qb.CirqBoard(
@@ -97,6 +113,7 @@ BIG_CIRQ_BOARDS = (
 ALL_CIRQ_BOARDS = BIG_CIRQ_BOARDS + (
     syc23_noiseless,
     syc23_noisy,
+    syc54_noisy,
 )
 
 